@@ -0,0 +1,162 @@
+"""
+admission - Ramdisk-capacity-aware admission of files to be processed.
+
+Each file processed by `transfer` needs space in the temp folder (ramdisk)
+for the copy of the data file and for the Photon-HDF5 file (plus the raw
+temporary file when converting with the tempfile notebook). Before starting
+a job, `RamdiskScheduler` reserves the estimated peak footprint; the
+reservation is released when the temp files are removed.
+
+Pending jobs are admitted smallest first, so that the largest number of
+files fit in the ramdisk at once. A job skipped too many times while
+smaller jobs were admitted gets priority, so that large files are not
+starved.
+"""
+
+import shutil
+import threading
+from pathlib import Path
+
+
+# Peak ramdisk footprint as a multiple of the data file size.
+# - inplace: data file + Photon-HDF5 file
+# - tempfile: data file + raw temp file (blosc) + Photon-HDF5 file (zlib)
+# - singlespot: SM file + Photon-HDF5 file
+footprint_factors = dict(inplace=2.2, tempfile=3.2, singlespot=2.5)
+min_footprint = 16 * 1024**2     # YAML file, notebooks and HDF5 overhead
+
+
+def conversion_mode(inplace=True, singlespot=False):
+    if singlespot:
+        return 'singlespot'
+    return 'inplace' if inplace else 'tempfile'
+
+
+def estimate_footprint(datafile, inplace=True, singlespot=False, size=None):
+    """Return the estimated peak ramdisk usage (bytes) for `datafile`.
+
+    Arguments:
+        datafile (Path): data file (DAT or SM) to be processed.
+        inplace (bool): conversion without the temporary raw HDF5 file.
+        singlespot (bool): us-ALEX SM file conversion.
+        size (int or None): size of the data file. If None, the size
+            is read from the file system.
+    """
+    if size is None:
+        size = Path(datafile).stat().st_size
+    factor = footprint_factors[conversion_mode(inplace, singlespot)]
+    return int(size * factor) + min_footprint
+
+
+def ramdisk_capacity(path, margin=0.05):
+    """Return the free space in `path` minus a `margin` fraction of total."""
+    usage = shutil.disk_usage(str(path))
+    return max(0, int(usage.free - usage.total * margin))
+
+
+class RamdiskScheduler:
+    """Admit jobs only when their footprint fits in the available capacity.
+
+    Arguments:
+        capacity (int): bytes available in the temp folder for the jobs.
+        max_jobs (int or None): max number of jobs admitted at the same
+            time (e.g. the number of workers). No limit if None.
+        max_skips (int): a job skipped this many times while other jobs
+            were admitted blocks admission of other jobs until it fits.
+
+    Jobs larger than `capacity` are admitted only when no other job is
+    running.
+    """
+
+    def __init__(self, capacity, max_jobs=None, max_skips=10):
+        self.capacity = capacity
+        self.max_jobs = max_jobs
+        self.max_skips = max_skips
+        self._pending = {}     # key -> [footprint, skips, insertion order]
+        self._reserved = {}    # key -> footprint
+        self._counter = 0
+        self.reclaimed_bytes = 0   # bytes removed from the temp folder
+        self.kept_bytes = 0        # bytes left in the temp folder by jobs
+        self._lock = threading.Lock()
+
+    @property
+    def reserved(self):
+        """Total bytes currently reserved."""
+        return sum(self._reserved.values())
+
+    @property
+    def num_pending(self):
+        return len(self._pending)
+
+    @property
+    def num_running(self):
+        return len(self._reserved)
+
+    def add(self, key, footprint):
+        """Add a job identified by `key` to the pending queue."""
+        with self._lock:
+            if key in self._pending or key in self._reserved:
+                return
+            self._pending[key] = [footprint, 0, self._counter]
+            self._counter += 1
+
+    def _fits(self, footprint):
+        if self.max_jobs is not None and len(self._reserved) >= self.max_jobs:
+            return False
+        if len(self._reserved) == 0:
+            return True
+        return footprint <= self.capacity - self.reserved
+
+    def _reserve(self, key):
+        footprint, _, _ = self._pending.pop(key)
+        self._reserved[key] = footprint
+
+    def admit(self):
+        """Reserve space for the pending jobs which fit and return their keys.
+        """
+        admitted = []
+        with self._lock:
+            starving = [k for k, v in self._pending.items()
+                        if v[1] >= self.max_skips]
+            if starving:
+                key = max(starving, key=lambda k: (self._pending[k][1],
+                                                   -self._pending[k][2]))
+                if not self._fits(self._pending[key][0]):
+                    return admitted
+                self._reserve(key)
+                admitted.append(key)
+            skipped = []
+            order = sorted(self._pending.items(),
+                           key=lambda item: (item[1][0], item[1][2]))
+            for key, (footprint, _, _) in order:
+                if self._fits(footprint):
+                    self._reserve(key)
+                    admitted.append(key)
+                else:
+                    skipped.append(key)
+            if admitted:
+                for key in skipped:
+                    self._pending[key][1] += 1
+        return admitted
+
+    def release(self, key, reclaimed=None, kept=None):
+        """Release the space reserved for job `key` (no-op if not reserved).
+
+        `reclaimed` is the number of bytes actually removed from the temp
+        folder for the job (if known). `kept` is the number of bytes of
+        temp files of the job left in the temp folder (if any): they are
+        subtracted from `capacity`.
+        """
+        with self._lock:
+            if reclaimed is not None:
+                self.reclaimed_bytes += reclaimed
+            footprint = self._reserved.pop(key, None)
+            if kept is not None and footprint is not None:
+                self.kept_bytes += kept
+                full = self.capacity < min_footprint
+                self.capacity = max(0, self.capacity - kept)
+                if self.capacity < min_footprint and not full:
+                    print('WARNING: Ramdisk space used up by kept temp files '
+                          '(%.1f GB): files are processed one at a time.' %
+                          (self.kept_bytes / 1024**3), flush=True)
+            return footprint
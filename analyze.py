@@ -2,12 +2,35 @@
 
 from pathlib import Path
 import nbrun
+import kernelpool
+import htmlexport
+import manifest
+import nbslim
+import sharding
+import cachestore
 
 default_notebook_name = 'smFRET-Quick-Test-Server.ipynb'
 
 
+def analysis_notebooks(input_notebook=None, shards=None):
+    """Return the list of notebooks executed by `run_analysis`."""
+    if shards:
+        return [sharding.default_shard_notebook,
+                sharding.default_report_notebook]
+    return [input_notebook or default_notebook_name]
+
+
+def get_inputs(data_filename, input_notebook=None, shards=None):
+    """Return the dict of inputs of the analysis (see `manifest`)."""
+    return manifest.get_inputs(datafiles=[data_filename],
+                               notebooks=analysis_notebooks(input_notebook,
+                                                            shards),
+                               packages=manifest.analysis_packages)
+
+
 def run_analysis(data_filename, input_notebook=None, save_html=False,
-                 working_dir=None, dry_run=False):
+                 working_dir=None, dry_run=False, slim=False, shards=None,
+                 cache_dir=None, cache_size=None, profile_cells=False):
     """
     Run analysis notebook on the passed data file.
 
@@ -15,10 +38,33 @@ def run_analysis(data_filename, input_notebook=None, save_html=False,
         data_filename (Path): path data file to be analyzed.
         input_notebook (Path): path of the analysis notebook.
         save_html (bool): if True save a copy of the output notebook in HTML.
+            If the process has an export queue (see `htmlexport`), the HTML
+            is rendered in background.
         working_dir (Path or None): working dir the kernel is started into.
             If None (default), use the same folder as the data file.
         dry_run (bool): just pretenting. Do not run or save any notebook.
+        slim (bool or dict): if True, slim the output notebook with the
+            options `nbslim.default_options`. If a dict, slim with these
+            options (see `nbslim.slim_notebook`).
+        shards (int or None): if not None, split the spots of the file in
+            `shards` kernels running in parallel, see `sharding`
+            (`input_notebook` is ignored).
+        cache_dir (Path or None): if not None, the analysis cache of the
+            data file is kept in the `cachestore.CacheStore` in this folder.
+        cache_size (int or None): size budget (bytes) of the cache store.
+            If None, use `cachestore.default_max_bytes`.
+        profile_cells (bool): if True, save the execution profile of each
+            cell of the notebooks (see `cellprofile`).
     """
+    if slim is True:
+        slim = nbslim.default_options
+    if shards:
+        sharding.run_sharded_analysis(data_filename, num_shards=shards,
+                                      save_html=save_html,
+                                      working_dir=working_dir,
+                                      dry_run=dry_run, slim=slim or None,
+                                      profile_cells=profile_cells)
+        return
     if input_notebook is None:
         input_notebook = default_notebook_name
     print(' * Running analysis for %s' % (data_filename.stem), flush=True)
@@ -28,11 +74,16 @@ def run_analysis(data_filename, input_notebook=None, save_html=False,
                          data_filename.stem + '.html')
     out_path_html.parent.mkdir(exist_ok=True, parents=True)
     if not dry_run:
-        nbrun.run_notebook(input_notebook, display_links=False,
-                           out_path_ipynb=data_filename.with_suffix('.ipynb'),
-                           out_path_html=out_path_html,
-                           nb_kwargs={'fname': str(data_filename)},
-                           save_html=save_html, working_dir=working_dir)
+        with cachestore.checkout(data_filename, cache_dir, cache_size):
+            nbrun.run_notebook(
+                input_notebook, display_links=False,
+                out_path_ipynb=data_filename.with_suffix('.ipynb'),
+                out_path_html=out_path_html,
+                nb_kwargs={'fname': str(data_filename)},
+                save_html=save_html, working_dir=working_dir,
+                kernel_pool=kernelpool.worker_pool(),
+                html_queue=htmlexport.export_queue(), slim=slim or None,
+                profile=profile_cells)
     print('   [COMPLETED ANALYSIS] %s' % (data_filename.stem), flush=True)
 
 
@@ -53,6 +104,27 @@ if __name__ == '__main__':
                         help='Save a copy of the output notebooks in HTML.')
     parser.add_argument('--working-dir', metavar='PATH', default=None,
                         help='Working dir for the kernel executing the notebook.')
+    parser.add_argument('--slim', action='store_true',
+                        help='Move the images of the output notebooks to the '
+                             'sidecar folder "%s" and truncate very large '
+                             'outputs (see nbslim.py).'
+                             % nbslim.default_images_folder)
+    parser.add_argument('--shards', metavar='N', type=int, default=None,
+                        help='Analyze the spots of a 48-spot file in N '
+                             'kernels in parallel (see sharding.py).')
+    parser.add_argument('--cache-dir', metavar='PATH', default=None,
+                        help='Keep the analysis caches (_cache.hdf5) in this '
+                             'folder instead of next to the data files '
+                             '(see cachestore.py). Suggested: "%s".'
+                             % cachestore.default_cache_dir)
+    parser.add_argument('--cache-size', metavar='GB', type=float,
+                        default=cachestore.default_max_bytes / 1024**3,
+                        help='Size budget of the cache folder (least '
+                             'recently used caches are removed). '
+                             'Default %(default)g.')
+    parser.add_argument('--profile-cells', action='store_true',
+                        help='Save wall time, CPU time and peak memory of '
+                             'each cell of the notebook (see cellprofile.py).')
     args = parser.parse_args()
 
     datafile = Path(args.datafile)
@@ -60,4 +132,8 @@ if __name__ == '__main__':
     notebook = Path(args.notebook)
     assert notebook.is_file(), 'Notebook not found: %s' % notebook
     run_analysis(datafile, input_notebook=notebook,
-                 save_html=args.save_html, working_dir=args.working_dir)
+                 save_html=args.save_html, working_dir=args.working_dir,
+                 slim=args.slim, shards=args.shards,
+                 cache_dir=args.cache_dir,
+                 cache_size=int(args.cache_size * 1024**3),
+                 profile_cells=args.profile_cells)
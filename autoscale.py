@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+autoscale - Adapt the number of concurrent jobs to the CPU and memory use.
+
+The Pool of the batch scripts is created with the maximum number of
+workers (`ceiling`), but an `Autoscaler` decides how many of them can run
+a job at the same time. Every `interval` seconds it samples:
+
+- the CPU time and RSS of the process tree of the main process, which
+  includes the workers and their children (Jupyter kernels, conversion
+  processes). From these it estimates the CPU (cores) and memory used by
+  each running job;
+- the CPU use and the available memory of the whole machine.
+
+The job limit grows by one when all the allowed jobs are running and both
+the idle CPUs and the available memory can take one more job (as estimated
+from the running ones). It shrinks by one (down to `floor`) when the CPUs
+are saturated and the jobs are slowed down by the contention, or when the
+available memory would not fit one more job. When the available memory
+drops below `min_free`, no new job is started (pause) until it is back
+above `resume_free`. Jobs already running are never stopped.
+
+Each decision (including 'hold') is appended with the samples and the
+reason to a JSON lines file (`default_log_path`); changes are also
+printed. Linux only (the samples are read from /proc).
+"""
+
+import os
+import time
+from pathlib import Path
+
+import metrics
+from cluster import memory_info
+
+
+default_log_path = Path('~', '.transfer_convert',
+                        'autoscale.jsonl').expanduser()
+default_interval = 10           # seconds between decisions
+default_min_free = 4 * 1024**3  # pause starting jobs below this (bytes)
+cpu_high = 0.95     # machine CPU fraction considered saturated
+cpu_starved = 0.5   # jobs using less than this (cores) are slowed down
+
+
+def machine_cpu_times():
+    """Return busy and total CPU time (in ticks) of the machine."""
+    try:
+        with open('/proc/stat') as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle = values[3] + (values[4] if len(values) > 4 else 0)   # + iowait
+    return sum(values) - idle, sum(values)
+
+
+class Autoscaler:
+    """Number of jobs allowed to run concurrently, adapted to the load.
+
+    Arguments:
+        floor (int): min number of concurrent jobs (when not paused).
+        ceiling (int): max number of concurrent jobs (number of workers).
+        interval (float): seconds between two decisions.
+        min_free (int): do not start new jobs when the available memory
+            (bytes) is below this value.
+        resume_free (int or None): start jobs again when the available
+            memory is above this value. Default 1.5 * `min_free`.
+        log_path (Path or None): JSON lines file where the decisions are
+            appended. If None, decisions are not logged.
+        start (int or None): initial limit. Default `floor`.
+    """
+
+    def __init__(self, floor=1, ceiling=4, interval=default_interval,
+                 min_free=default_min_free, resume_free=None,
+                 log_path=default_log_path, start=None):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.interval = interval
+        self.min_free = min_free
+        self.resume_free = (int(1.5 * min_free) if resume_free is None
+                            else resume_free)
+        self.log_path = None if log_path is None else Path(log_path)
+        if self.log_path is not None:
+            self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        self.limit = self.floor if start is None else start
+        self.limit = min(max(self.limit, self.floor), self.ceiling)
+        self.paused = False
+        self.cpus = os.cpu_count() or 1
+        self.idle_rss = metrics.tree_rss()
+        self._last = None
+        self._settling = False   # limit changed in the previous decision
+
+    def _sample(self, running):
+        """Return the samples since the previous call (None the first time).
+        """
+        now = time.time()
+        cpu = metrics.tree_cpu_seconds()
+        machine = machine_cpu_times()
+        rss = metrics.tree_rss()
+        if running == 0:
+            self.idle_rss = rss if self._last is None else min(
+                self.idle_rss, rss)
+        previous, self._last = self._last, (now, cpu, machine)
+        if previous is None:
+            return None
+        elapsed = max(now - previous[0], 1e-3)
+        sample = dict(running=running, tree_rss=rss,
+                      tree_cpu=max(0, cpu - previous[1]) / elapsed)
+        sample['mem_total'], sample['mem_available'] = memory_info()
+        sample['machine_cpu'] = None
+        if machine is not None and previous[2] is not None:
+            busy = machine[0] - previous[2][0]
+            total = machine[1] - previous[2][1]
+            sample['machine_cpu'] = busy / total if total > 0 else 0
+        sample['job_cpu'] = sample['job_rss'] = None
+        if running > 0:
+            sample['job_cpu'] = sample['tree_cpu'] / running
+            sample['job_rss'] = max(0, rss - self.idle_rss) / running
+        return sample
+
+    def _decide(self, s):
+        """Return the action ('grow', 'shrink', 'pause', 'resume' or
+        'hold') and the reason, given the samples `s`."""
+        mem = s['mem_available']
+        if mem is not None:
+            if mem < self.min_free:
+                if not self.paused:
+                    return 'pause', ('available memory %.1f GB < %.1f GB' %
+                                     (mem / 1024**3, self.min_free / 1024**3))
+                return 'hold', 'paused: available memory %.1f GB' % (
+                    mem / 1024**3)
+            if self.paused:
+                if mem >= self.resume_free:
+                    return 'resume', ('available memory %.1f GB >= %.1f GB'
+                                      % (mem / 1024**3,
+                                         self.resume_free / 1024**3))
+                return 'hold', 'paused: available memory %.1f GB' % (
+                    mem / 1024**3)
+        if s['running'] == 0:
+            return 'hold', 'no job running'
+        if self._settling:
+            # Jobs started in the last interval ran only part of it
+            return 'hold', 'waiting one interval after changing the limit'
+        cpu, job_cpu, job_rss = s['machine_cpu'], s['job_cpu'], s['job_rss']
+        if mem is not None and mem - job_rss < self.min_free:
+            if self.limit > self.floor:
+                return 'shrink', ('one more job (%.1f GB) would leave less '
+                                  'than %.1f GB available' %
+                                  (job_rss / 1024**3, self.min_free / 1024**3))
+            return 'hold', 'no memory for one more job (at floor)'
+        if (cpu is not None and cpu >= cpu_high and job_cpu < cpu_starved and
+                self.limit > self.floor):
+            return 'shrink', ('CPUs saturated (%.0f%%), jobs use %.2f cores'
+                              % (100 * cpu, job_cpu))
+        if s['running'] < self.limit:
+            return 'hold', '%d of %d jobs running' % (s['running'],
+                                                      self.limit)
+        if self.limit >= self.ceiling:
+            return 'hold', 'at ceiling (%d)' % self.ceiling
+        idle_cpus = self.cpus * (1 - cpu) if cpu is not None else self.cpus
+        if idle_cpus < job_cpu:
+            return 'hold', ('idle CPUs %.2f < %.2f cores per job' %
+                            (idle_cpus, job_cpu))
+        return 'grow', ('idle CPUs %.2f >= %.2f cores per job, %.1f GB '
+                        'available for %.1f GB per job' %
+                        (idle_cpus, job_cpu, (mem or 0) / 1024**3,
+                         job_rss / 1024**3))
+
+    def update(self, running, force=False):
+        """Sample and decide, if `interval` seconds passed since the last
+        decision (or if `force`). Returns the decision record or None.
+
+        Arguments:
+            running (int): number of jobs currently running.
+        """
+        if (not force and self._last is not None and
+                time.time() - self._last[0] < self.interval):
+            return None
+        sample = self._sample(running)
+        if sample is None:
+            return None
+        action, reason = self._decide(sample)
+        previous = self.limit
+        self._settling = action in ('grow', 'shrink', 'resume')
+        if action == 'grow':
+            self.limit += 1
+        elif action == 'shrink':
+            self.limit -= 1
+        elif action == 'pause':
+            self.paused = True
+        elif action == 'resume':
+            self.paused = False
+        record = dict(time=time.time(), action=action, reason=reason,
+                      limit=self.limit, previous_limit=previous,
+                      paused=self.paused, floor=self.floor,
+                      ceiling=self.ceiling, **sample)
+        if self.log_path is not None:
+            metrics.write_record(record, self.log_path)
+        if action != 'hold':
+            print('- Autoscale: %s to %d jobs%s (%s)' %
+                  (action, self.limit, ' [PAUSED]' if self.paused else '',
+                   reason), flush=True)
+        return record
+
+    def allowed(self, running):
+        """Return the number of jobs that can be started now."""
+        self.update(running)
+        if self.paused:
+            return 0
+        return max(0, self.limit - running)
+
+
+def format_record(record):
+    """Return a one-line description of a decision record."""
+    def gb(value):
+        return '-' if value is None else '%.1f' % (value / 1024**3)
+    return ('%s %-6s limit %d, running %d, CPU %s, job RSS %s GB, '
+            'free %s GB: %s' % (
+        time.strftime('%H:%M:%S', time.localtime(record['time'])),
+        record['action'], record['limit'], record['running'],
+        '-' if record['machine_cpu'] is None
+        else '%.0f%%' % (100 * record['machine_cpu']),
+        gb(record['job_rss']), gb(record['mem_available']),
+        record['reason']))
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        Print the decisions of the autoscaler logged by the batch scripts
+        (see the --autoscale option).
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('--log', metavar='PATH', default=str(default_log_path),
+                        help='Decisions log. Default "%s".' % default_log_path)
+    parser.add_argument('--all', action='store_true',
+                        help="Print also the 'hold' decisions.")
+    args = parser.parse_args()
+
+    records, _ = metrics.read_records(args.log)
+    for record in records:
+        if args.all or record['action'] != 'hold':
+            print(format_record(record))
@@ -1,10 +1,22 @@
 #!/usr/bin/env python
 
 import sys
+import time
 from pathlib import Path
-from multiprocessing import Pool
+from functools import partial
 
-from analyze import run_analysis, default_notebook_name
+from analyze import (run_analysis, default_notebook_name, get_inputs,
+                     analysis_notebooks)
+import kernelpool
+import htmlexport
+import nbslim
+import cachestore
+import cluster
+import startup
+import catalog
+import autoscale
+import cellprofile
+from manifest import Manifest, filter_done, default_manifest_path
 
 
 def get_file_list(folder, glob='*.hdf5'):
@@ -13,35 +25,156 @@ def get_file_list(folder, glob='*.hdf5'):
             if not f.stem.endswith('_cache')]
 
 
+def get_file_list_from_catalog(folder, catalog_path, notebook=None,
+                               since=None, until=None, sample=None,
+                               not_analyzed=False):
+    """Return the files in `folder` (and subfolders) matching the query.
+
+    Files are selected from the `catalog.Catalog` in `catalog_path` by
+    acquisition date (`since`, `until`), sample name and, if
+    `not_analyzed`, if not yet analyzed with `notebook`.
+    """
+    store = catalog.Catalog(catalog_path)
+    try:
+        return store.select(folder=folder, start=since, end=until,
+                            sample=sample,
+                            not_analyzed_with=(notebook or
+                                               default_notebook_name)
+                            if not_analyzed else None)
+    finally:
+        store.close()
+
+
+def init_worker(export_queue=None, kernel_init=None):
+    """Initializer of the analysis workers (see `batch_process`)."""
+    htmlexport.init_worker(export_queue)
+    if kernel_init is not None:
+        kernel_init()
+
+
 def batch_process(folder, nproc=4, notebook=None, save_html=False,
-                  working_dir='./', interactive=False, glob='*.hdf5'):
+                  working_dir='./', interactive=False, glob='*.hdf5',
+                  warm_kernels=False, kernel_max_runs=50,
+                  manifest_path=default_manifest_path, force=False,
+                  rerun_report=False, html_workers=1, slim=False,
+                  cache_dir=None, cache_size=None, cluster_address=None,
+                  catalog_path=None, select=None, autoscale_kws=None,
+                  profile_cells=False):
     assert folder.is_dir(), 'Path not found: %s' % folder
 
     title_msg = 'Processing files in folder: %s' % folder.name
     print('\n\n%s' % title_msg)
 
+    filelist = None
+    if select is not None:
+        filelist = get_file_list_from_catalog(folder, catalog_path,
+                                              notebook=notebook, **select)
+        print('- Selected %d files from catalog "%s"' %
+              (len(filelist), catalog_path))
     if interactive:
-        filelist = get_file_selection_from_user(folder, glob=glob)
-    else:
+        filelist = get_file_selection_from_user(folder, glob=glob,
+                                                filelist=filelist)
+    elif filelist is None:
         filelist = get_file_list(folder, glob=glob)
+    store = None
+    if catalog_path is not None:
+        store = catalog.Catalog(catalog_path)
+
+    inputs = {}
+    manifest = None
+    if manifest_path is not None:
+        manifest = Manifest(manifest_path)
+        print('\n- Checking manifest "%s":' % manifest.path)
+        items = [(str(f.with_suffix('.ipynb')), get_inputs(f, notebook))
+                 for f in filelist]
+        inputs = dict(filter_done(manifest, items, force=force, report=True))
+        filelist = [f for f in filelist
+                    if str(f.with_suffix('.ipynb')) in inputs]
+    if rerun_report:
+        return
 
     print('\n- The following files will be processed:')
     for f in filelist:
         print('  %s' % f)
     print()
 
-    with Pool(processes=nproc) as pool:
+    exporter = None
+    # HTML of remote workers is rendered by the workers
+    if save_html and html_workers > 0 and cluster_address is None:
+        exporter = htmlexport.ExportService(html_workers).start()
+    kernel_init = kernelpool.worker_initializer(warm_kernels, kernel_max_runs)
+    initializer = partial(
+        init_worker, export_queue=None if exporter is None else exporter.queue,
+        kernel_init=kernel_init)
+    remote_initializer = partial(init_worker, kernel_init=kernel_init)
+    autoscaler = None
+    if autoscale_kws is not None:
+        autoscaler = autoscale.Autoscaler(ceiling=nproc, **autoscale_kws)
+    with cluster.get_pool(nproc, initializer, cluster=cluster_address,
+                          remote_initializer=remote_initializer) as pool:
         try:
-            pool.starmap(run_analysis,
-                         [(f, notebook, save_html, working_dir) for f in filelist])
+            results = []
+            todo = list(filelist)
+            while todo:
+                num = len(todo)
+                if autoscaler is not None:
+                    running = sum(not r.ready() for _, r in results)
+                    num = autoscaler.allowed(running)
+                for f in todo[:num]:
+                    results.append((f, pool.apply_async(
+                        run_analysis, (f, notebook, save_html, working_dir),
+                        dict(slim=slim, cache_dir=cache_dir,
+                             cache_size=cache_size,
+                             profile_cells=profile_cells))))
+                todo = todo[num:]
+                if todo:
+                    time.sleep(1)
+            for f, result in results:
+                try:
+                    result.get()
+                except Exception as e:
+                    print('Analysis of "%s" got exception:\n%s' % (f, e),
+                          flush=True)
+                    continue
+                if manifest is not None:
+                    key = str(f.with_suffix('.ipynb'))
+                    manifest.record(key, inputs[key], outputs=[key])
+                if store is not None:
+                    for nb in analysis_notebooks(notebook):
+                        store.record_analysis(f, nb)
         except KeyboardInterrupt:
             print('\n>>> Got keyboard interrupt.\n', flush=True)
+            if exporter is not None:
+                exporter.terminate()
+                exporter = None
+    if exporter is not None:
+        print('Waiting for the HTML reports.', flush=True)
+        exporter.close()
     print('Closing subprocess pool.', flush=True)
+    if profile_cells:
+        print_hot_cells(filelist)
+
+
+def print_hot_cells(filelist, top=10):
+    """Print the ranking of the cells taking the most time in the analysis
+    of the files in `filelist` (see `cellprofile`)."""
+    files = [cellprofile.profile_path(f.with_suffix('.ipynb'))
+             for f in filelist]
+    cells = cellprofile.aggregate([f for f in files if f.is_file()])
+    if cells:
+        print('\n- Hot cells (run ./cellprofile.py for more):\n', flush=True)
+        print(cellprofile.format_ranking(cells, top=top), flush=True)
+
 
+def get_file_selection_from_user(path, glob='*.hdf5', filelist=None):
+    """Get file selection interactively from the user.
 
-def get_file_selection_from_user(path, glob='*.hdf5'):
-    """Get file selection interactively from the user."""
-    filelist = sorted(get_file_list(path, glob=glob))
+    Files are chosen among `filelist` or, if None, among the files in `path`
+    matching `glob`.
+    """
+    if filelist is None:
+        filelist = get_file_list(path, glob=glob)
+    filelist = sorted(filelist)
     print('Data files in %s:\n' % path)
     for i, f in enumerate(filelist):
         print('  [%d] %s' % (i, f.name), flush=True)
@@ -112,6 +245,15 @@ if __name__ == '__main__':
                         default=default_notebook_name, help=msg)
     parser.add_argument('--save-html', action='store_true',
                         help='Save a copy of the output notebooks in HTML.')
+    parser.add_argument('--html-workers', metavar='N', type=int, default=1,
+                        help='Processes rendering the HTML in background '
+                             '(with --save-html). With 0, HTML is rendered '
+                             'by the analysis workers. Default 1.')
+    parser.add_argument('--slim', action='store_true',
+                        help='Move the images of the output notebooks to the '
+                             'sidecar folder "%s" and truncate very large '
+                             'outputs (see nbslim.py).'
+                             % nbslim.default_images_folder)
     parser.add_argument('--choose-files', action='store_true',
                         help='Select files interactively.')
     msg = ('Working dir for the kernel executing the notebook.\n'
@@ -125,18 +267,110 @@ if __name__ == '__main__':
            "accepted by pathlib.Path.glob().")
     parser.add_argument('--glob', metavar='PATTERN', default="'*.hdf5'",
                         help=msg)
+    parser.add_argument('--warm-kernels', action='store_true',
+                        help='Execute notebooks in a long-lived, pre-warmed '
+                             'kernel owned by each worker.')
+    parser.add_argument('--kernel-max-runs', metavar='N', type=int, default=50,
+                        help='Restart a warm kernel after N notebooks. '
+                             'Default 50.')
+    parser.add_argument('--autoscale', action='store_true',
+                        help='Adapt the number of files analyzed at once '
+                             '(between --min-workers and -n) to the CPU and '
+                             'memory use, see autoscale.py.')
+    parser.add_argument('--min-workers', metavar='N', type=int, default=1,
+                        help='Min number of files analyzed at once (with '
+                             '--autoscale). Default 1.')
+    parser.add_argument('--min-free-memory', metavar='GB', type=float,
+                        default=autoscale.default_min_free / 1024**3,
+                        help='With --autoscale, do not start new analyses '
+                             'when the available memory is below GB. '
+                             'Default %(default)g.')
+    parser.add_argument('--start-method', default='fork',
+                        choices=startup.start_methods,
+                        help="How worker processes are started: 'fork' "
+                             "(default), 'preload' (the main process "
+                             "imports the heavy packages before forking the "
+                             "workers) or 'forkserver' (workers are forked "
+                             "from a server process with the packages "
+                             "already imported). See startup.py.")
+    parser.add_argument('--cluster', metavar='HOST:PORT', default=None,
+                        help='Listen on HOST:PORT and analyze the files on '
+                             'the workers connected to it (started with '
+                             './cluster.py on any machine) instead of local '
+                             'processes.')
+    parser.add_argument('--manifest', metavar='PATH',
+                        default=str(default_manifest_path),
+                        help='Manifest file recording the inputs of the '
+                             'analyzed files. Default "%s".'
+                             % default_manifest_path)
+    parser.add_argument('--force', action='store_true',
+                        help='Analyze all the files, even if already '
+                             'analyzed with the same inputs.')
+    parser.add_argument('--rerun-report', action='store_true',
+                        help='Only print which files would be analyzed '
+                             '(and why) according to the manifest.')
+    parser.add_argument('--catalog', metavar='PATH',
+                        default=str(catalog.default_catalog_path),
+                        help='Catalog of the archived files (see catalog.py) '
+                             'where the analyses are recorded. Default "%s".'
+                             % catalog.default_catalog_path)
+    parser.add_argument('--select', action='store_true',
+                        help='Select the files in the folder (and '
+                             'subfolders) from the catalog instead of '
+                             'globbing. Implied by the options below.')
+    catalog.add_select_arguments(parser)
+    parser.add_argument('--not-analyzed', action='store_true',
+                        help='Only files not yet analyzed with the notebook '
+                             '(--notebook).')
+    parser.add_argument('--cache-dir', metavar='PATH', default=None,
+                        help='Keep the analysis caches (_cache.hdf5) in this '
+                             'folder instead of next to the data files '
+                             '(see cachestore.py). Suggested: "%s".'
+                             % cachestore.default_cache_dir)
+    parser.add_argument('--cache-size', metavar='GB', type=float,
+                        default=cachestore.default_max_bytes / 1024**3,
+                        help='Size budget of the cache folder (least '
+                             'recently used caches are removed). '
+                             'Default %(default)g.')
+    parser.add_argument('--profile-cells', action='store_true',
+                        help='Save wall time, CPU time and peak memory of '
+                             'each cell of the notebooks and print the '
+                             'cells taking the most time (see '
+                             'cellprofile.py).')
     args = parser.parse_args()
+    startup.configure(args.start_method)
 
     folder = Path(args.folder)
     if not folder.exists():
         sys.exit('\nFolder not found: %s\n' % folder)
     elif not folder.is_dir():
         sys.exit('\nYou must provide a folder (not a file) as an argument.\n')
+    if args.autoscale and args.cluster:
+        sys.exit('\nOption --autoscale cannot be used with --cluster.\n')
+    select = dict(since=args.since, until=args.until, sample=args.sample,
+                  not_analyzed=args.not_analyzed)
+    if not args.select and not any(select.values()):
+        select = None
+    autoscale_kws = None
+    if args.autoscale:
+        autoscale_kws = dict(floor=args.min_workers,
+                             min_free=int(args.min_free_memory * 1024**3))
 
     try:
         batch_process(folder, nproc=args.num_processes, notebook=args.notebook,
                       save_html=args.save_html, working_dir=args.working_dir,
-                      interactive=args.choose_files, glob=args.glob[1:-1])
+                      interactive=args.choose_files, glob=args.glob[1:-1],
+                      warm_kernels=args.warm_kernels,
+                      kernel_max_runs=args.kernel_max_runs,
+                      manifest_path=Path(args.manifest), force=args.force,
+                      rerun_report=args.rerun_report,
+                      html_workers=args.html_workers, slim=args.slim,
+                      cache_dir=args.cache_dir,
+                      cache_size=int(args.cache_size * 1024**3),
+                      cluster_address=args.cluster,
+                      catalog_path=Path(args.catalog), select=select,
+                      autoscale_kws=autoscale_kws,
+                      profile_cells=args.profile_cells)
         print('Batch analysis completed.', flush=True)
     except KeyboardInterrupt:
         sys.exit('\n\nExecution terminated.\n')
@@ -1,11 +1,34 @@
 #!/usr/bin/env python
 
+import os
 import sys
-from pathlib import Path
 import time
-from multiprocessing import Pool
+import queue
+import threading
+from collections import deque
+from pathlib import Path
+from functools import partial
+import multiprocessing as mp
 
 import transfer
+import kernelpool
+import admission
+import metrics
+import profiles
+import htmlexport
+import nbslim
+import cachestore
+import cluster
+import startup
+import reclaim
+import autoscale
+import microbatch
+import sharding
+from manifest import Manifest, filter_done, default_manifest_path
+from jobstore import JobStore, default_job_store_path
+from catalog import Catalog, default_catalog_path
+from watcher import FolderWatcher
+from pipeline import Pipeline, Stage
 
 
 def get_new_files(folder, init_filelist=None, glob='**/*.dat'):
@@ -20,40 +43,623 @@ def complete_task(fname, dry_run=False):
     print('Completed processing for "%s" (callback)' % fname, flush=True)
 
 
+def pipeline_callback(status, stage_name, job, error):
+    if status == 'completed':
+        print('Completed processing for "%s" (pipeline)' % job['fname'],
+              flush=True)
+    else:
+        print('Stage "%s" for "%s" got exception:\n%s' %
+              (stage_name, job['fname'], error), flush=True)
+
+
+def make_pipeline(nproc=4, copy_workers=2, archive_workers=1,
+                  remove_workers=1, analyze_workers=None, analyze=True,
+                  remove=True, initializer=None, callback=pipeline_callback):
+    """Return a `Pipeline` with the processing stages of `transfer`.
+
+    Arguments:
+        nproc (int): number of conversion workers.
+        copy_workers (int): number of workers copying files to ramdisk.
+        archive_workers (int): number of workers copying files to archive.
+        remove_workers (int): number of workers removing temp files.
+        analyze_workers (int or None): number of analysis workers.
+            If None, use `nproc`.
+        initializer (callable or None): initializer of the workers.
+            Passed to `transfer.init_worker` as `kernel_init` for the
+            conversion and analysis workers.
+        callback (callable): called for each job leaving the pipeline.
+    """
+    if analyze_workers is None:
+        analyze_workers = nproc
+    nworkers = dict(copy=copy_workers, convert=nproc,
+                    archive=archive_workers, remove=remove_workers,
+                    analyze=analyze_workers)
+    stages = []
+    for name, func in transfer.get_stages(remove=remove, analyze=analyze):
+        init = initializer
+        if name not in ('convert', 'analyze') and initializer is not None:
+            init = partial(initializer, kernel_init=None)
+        stages.append(Stage(name, func, nworkers[name], initializer=init))
+    return Pipeline(stages, callback=callback)
+
+
+class Dispatcher:
+    """Submit files to a Pool (or a Pipeline) of workers.
+
+    With a `scheduler` (`admission.RamdiskScheduler`), a file is submitted
+    only after reserving its estimated footprint in the temp folder.
+    The reservation is released when the temp files are removed (by the
+    `reclaim.Reclaimer` of the dispatcher, after a grace period), or at the
+    latest when the processing of the file ends.
+
+    With an `autoscaler` (`autoscale.Autoscaler`), files are submitted only
+    while the number of running jobs is below the limit of the autoscaler.
+
+    With `batch_kws`, small SM files are grouped by a `MicroBatcher` and
+    each group is processed by a single worker call (see `microbatch`).
+    Other files are processed one per job.
+
+    Arguments:
+        nproc (int): number of workers (number of conversion workers when
+            using the pipeline).
+        args (list): arguments for `transfer.process_int` following the
+            file name.
+        kernel_init (callable or None): initializer of the workers.
+        pipeline_kws (dict or None): if not None, use a `Pipeline` created
+            by `make_pipeline()` with these arguments.
+        scheduler (RamdiskScheduler or None): admission scheduler.
+        job_store_path (Path or None): job store updated by the workers.
+        metrics_path (Path or None): JSON lines file where the workers
+            write the metrics of each stage.
+        export_queue (multiprocessing.Queue or None): queue of the
+            `htmlexport.ExportService` rendering the analysis notebooks.
+        cluster_address (string or None): if not None, listen on this
+            address ('HOST:PORT') and run the files on the workers of a
+            `cluster.ClusterPool` instead of a local Pool.
+        removal_grace (float): seconds before the temp files are removed,
+            when the removal can be canceled (see `reclaim`).
+        catalog_path (Path or None): catalog database where the archived
+            files are added (see `catalog`). Local workers add them, files
+            processed by the cluster workers are added on success.
+        autoscaler (Autoscaler or None): controller of the number of files
+            processed concurrently (not used with the pipeline).
+        preview (preview.DatLayout or None): layout of the DAT files for
+            the quick-look preview computed while copying them (see
+            `transfer.init_worker`). No preview if None.
+        history_path (Path or None): JSON lines file of the conversion
+            timings (see `profiles`). If None, the default file.
+        batch_kws (dict or None): if not None, group the small files using
+            a `microbatch.MicroBatcher` created with these arguments
+            (not supported with the pipeline).
+    """
+
+    def __init__(self, nproc, args, kernel_init=None, pipeline_kws=None,
+                 scheduler=None, job_store_path=None, metrics_path=None,
+                 export_queue=None, cluster_address=None,
+                 removal_grace=reclaim.default_grace, catalog_path=None,
+                 autoscaler=None, preview=None, history_path=None,
+                 batch_kws=None):
+        if batch_kws is not None and pipeline_kws is not None:
+            raise ValueError('Micro-batching is not supported with the '
+                             'pipeline.')
+        self.nproc = nproc
+        self.args = args
+        self.pipeline_kws = pipeline_kws
+        self.scheduler = scheduler
+        self.autoscaler = autoscaler
+        self.batcher = None
+        self.files_per_job = 1  # max files processed by a worker call
+        if batch_kws is not None:
+            self.batcher = microbatch.MicroBatcher(**batch_kws)
+            self.files_per_job = self.batcher.max_files
+            if scheduler is not None and scheduler.max_jobs is not None:
+                scheduler.max_jobs *= self.files_per_job
+        self.release_queue = mp.Queue()
+        self.reclaimer = reclaim.Reclaimer(
+            callback=self._reclaimed, grace=removal_grace,
+            protected=(transfer.remote_archive_basedir,
+                       transfer.local_archive_basedir))
+        self.initializer = partial(transfer.init_worker,
+                                   release_queue=self.release_queue,
+                                   kernel_init=kernel_init,
+                                   job_store_path=job_store_path,
+                                   metrics_path=metrics_path,
+                                   export_queue=export_queue,
+                                   reclaim_queue=self.reclaimer.queue,
+                                   catalog_path=catalog_path,
+                                   preview=preview,
+                                   history_path=history_path)
+        # Remote workers have no access to the local queues and job store
+        self.remote_initializer = partial(transfer.init_worker,
+                                          kernel_init=kernel_init,
+                                          metrics_path=metrics_path,
+                                          preview=preview,
+                                          history_path=history_path)
+        self.cluster_address = cluster_address
+        self.catalog_path = catalog_path
+        self._files = {}        # temp path -> file name
+        self._running = {}      # temp path -> job (temp path or group)
+        self._waiting = deque()    # files waiting for the autoscaler
+        self._lock = threading.Lock()
+        self.executor = None
+        self.on_success = None    # called with the file name on success
+        self.on_failure = None    # called with file name and error message
+
+    def start(self):
+        self.reclaimer.start()
+        if self.pipeline_kws is not None:
+            analyze, remove = self.args[2:4]
+            self.executor = make_pipeline(self.nproc, analyze=analyze,
+                                          remove=remove,
+                                          initializer=self.initializer,
+                                          callback=self._pipeline_done,
+                                          **self.pipeline_kws)
+            self.executor.start()
+        else:
+            self.executor = cluster.get_pool(
+                self.nproc, self.initializer, cluster=self.cluster_address,
+                remote_initializer=self.remote_initializer)
+
+    @property
+    def num_active(self):
+        """Number of files added and not yet processed."""
+        with self._lock:
+            return len(self._files)
+
+    def add(self, fname):
+        """Add file `fname` to be processed."""
+        key = transfer.temp_path(fname)
+        with self._lock:
+            if key in self._files:
+                return
+            self._files[key] = fname
+        if self.scheduler is None and self.autoscaler is None:
+            self._submit(key)
+        elif self.scheduler is None:
+            self._waiting.append(key)
+        else:
+            inplace, singlespot, profile = (self.args[1], self.args[5],
+                                            self.args[7])
+            if profile is not None:
+                # With 'auto', reserve the footprint of a tempfile conversion
+                inplace = (profile != 'auto' and
+                           profiles.get_profile(profile)['mode'] == 'inplace')
+            footprint = admission.estimate_footprint(
+                fname, inplace=inplace, singlespot=singlespot)
+            self.scheduler.add(key, footprint)
+
+    @property
+    def num_jobs(self):
+        """Number of worker calls running (or being grouped)."""
+        with self._lock:
+            num = len(set(self._running.values()))
+        if self.batcher is not None and self.batcher.num_pending > 0:
+            num += 1
+        return num
+
+    def _submit(self, key):
+        if self.batcher is not None:
+            fname = self._files[key]
+            try:
+                size = fname.stat().st_size
+            except OSError:
+                size = None
+            if microbatch.batchable(fname, size, self.batcher.max_bytes):
+                for group in self.batcher.add(key, size):
+                    self._submit_group(group)
+                return
+        self._start(key)
+
+    def _submit_group(self, keys):
+        if len(keys) == 1:
+            self._start(keys[0])
+            return
+        group = tuple(keys)
+        with self._lock:
+            for key in keys:
+                self._running[key] = group
+        self.executor.apply_async(
+            transfer.process_group, [[self._files[k] for k in keys]] +
+            self.args, callback=partial(self._group_done, keys),
+            error_callback=partial(self._group_error, keys))
+
+    def _start(self, key):
+        fname = self._files[key]
+        with self._lock:
+            self._running[key] = key
+        if self.pipeline_kws is not None:
+            self.executor.submit(transfer.make_job(fname, *self.args))
+        else:
+            self.executor.apply_async(
+                transfer.process_int, [fname] + self.args,
+                callback=partial(self._pool_done, key),
+                error_callback=partial(self._pool_error, key))
+
+    def _job_done(self, key, removed=False, kept=False):
+        """Called when processing ends. `removed` is True if the temp files
+        were queued for removal (released later by the reclaimer), `kept`
+        if they are left in the temp folder (--keep-temp-files).
+        """
+        with self._lock:
+            self._running.pop(key, None)
+            self._files.pop(key, None)
+        if kept and self.scheduler is not None:
+            self.scheduler.release(key, kept=self._kept_bytes(key))
+        if not removed:
+            self.release_queue.put((key, None))
+
+    def _removed(self, completed):
+        """Return True if the temp files of a completed job are reclaimed
+        by `self.reclaimer`."""
+        return completed and self.args[3] and self.cluster_address is None
+
+    def _kept(self, completed):
+        """Return True if the temp files of a completed job are left in
+        the local temp folder."""
+        dry_run, remove = self.args[0], self.args[3]
+        return (completed and not remove and not dry_run and
+                self.cluster_address is None)
+
+    @staticmethod
+    def _kept_bytes(key):
+        """Return the size of the temp files of `key` left in the temp
+        folder."""
+        return sum(f.stat().st_size for f in transfer.temp_files(key))
+
+    def _reclaimed(self, key, nbytes, kept=False):
+        if kept and self.scheduler is not None:
+            # Removal canceled: the files stay in the temp folder
+            self.scheduler.release(key, kept=self._kept_bytes(key))
+        self.release_queue.put((key, nbytes))
+
+    def _add_to_catalog(self, fname):
+        """Add the outputs of `fname` archived by a cluster worker to the
+        catalog."""
+        dry_run, inplace, analyze, _, analyze_kws, singlespot, _, profile = \
+            self.args
+        outputs = transfer.archive_outputs(fname, inplace=inplace,
+                                           analyze=analyze,
+                                           singlespot=singlespot,
+                                           profile=profile)
+        h5_fname = outputs[0]
+        archived = transfer.replace_basedir(
+            fname, transfer.remote_origin_basedir,
+            transfer.local_archive_basedir)
+        cat = Catalog(self.catalog_path)
+        try:
+            cat.add(h5_fname, data_fname=archived)
+            if analyze:
+                analyze_kws = analyze_kws or {}
+                for notebook in transfer.analysis_notebooks(
+                        analyze_kws.get('input_notebook'),
+                        analyze_kws.get('shards')):
+                    cat.record_analysis(h5_fname, notebook)
+        finally:
+            cat.close()
+
+    def _success(self, fname):
+        if (self.cluster_address is not None and
+                self.catalog_path is not None and not self.args[0]):
+            # Remote workers have no access to the catalog
+            try:
+                self._add_to_catalog(fname)
+            except Exception as e:
+                print('- Error adding "%s" to the catalog: %s' % (fname, e),
+                      flush=True)
+        if self.on_success is not None:
+            try:
+                self.on_success(fname)
+            except Exception as e:
+                print('Error in success callback for "%s": %s' % (fname, e),
+                      flush=True)
+
+    def _failure(self, fname, error):
+        if self.on_failure is not None:
+            try:
+                self.on_failure(fname, error)
+            except Exception as e:
+                print('Error in failure callback for "%s": %s' % (fname, e),
+                      flush=True)
+
+    def _pool_done(self, key, result):
+        fname = self._files[key]
+        complete_task(fname)
+        if result is not None:
+            self._success(result)
+        else:
+            self._failure(fname, None)
+        self._job_done(key, self._removed(result is not None),
+                       self._kept(result is not None))
+
+    def _pool_error(self, key, error):
+        fname = self._files[key]
+        print('Processing of "%s" got exception:\n%s' % (fname, error),
+              flush=True)
+        self._failure(fname, str(error))
+        self._job_done(key)
+
+    def _group_done(self, keys, results):
+        for key, result in zip(keys, results):
+            self._pool_done(key, result)
+
+    def _group_error(self, keys, error):
+        for key in keys:
+            self._pool_error(key, error)
+
+    def _pipeline_done(self, status, stage_name, job, error):
+        pipeline_callback(status, stage_name, job, error)
+        if status == 'completed':
+            self._success(job['fname'])
+        else:
+            self._failure(job['fname'], error)
+        self._job_done(transfer.temp_path(job['fname']),
+                       self._removed(status == 'completed'),
+                       self._kept(status == 'completed'))
+
+    def dispatch(self, timeout=1, flush=False):
+        """Submit the admitted files and wait up to `timeout` for releases.
+
+        If `flush`, the incomplete group of small files is submitted as
+        soon as no other file is waiting (else after `max_wait` seconds).
+        """
+        allowed = None
+        if self.autoscaler is not None:
+            allowed = self.autoscaler.allowed(self.num_jobs)
+        if self.scheduler is not None:
+            if allowed is not None:
+                self.scheduler.max_jobs = (self.scheduler.num_running +
+                                           allowed * self.files_per_job)
+            for key in self.scheduler.admit():
+                self._submit(key)
+        elif allowed is not None:
+            for _ in range(min(allowed * self.files_per_job, len(self._waiting))):
+                self._submit(self._waiting.popleft())
+        if self.batcher is not None:
+            force = flush and not self._waiting and (
+                self.scheduler is None or self.scheduler.num_pending == 0)
+            for group in self.batcher.flush(force):
+                self._submit_group(group)
+        try:
+            key, nbytes = self.release_queue.get(timeout=timeout)
+            while True:
+                if self.scheduler is not None:
+                    self.scheduler.release(key, reclaimed=nbytes)
+                key, nbytes = self.release_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def join(self):
+        """Wait until all the added files are processed."""
+        while self.num_active > 0:
+            self.dispatch(flush=True)
+
+    def close(self):
+        if self.pipeline_kws is not None:
+            self.executor.close()
+        else:
+            self.executor.close()
+            self.executor.join()
+        self.reclaimer.close()
+
+    def terminate(self):
+        self.executor.terminate()
+        self.reclaimer.stop()
+
+
+def get_inputs(fname, args):
+    """Return the manifest inputs of `fname` from the `process_int` args."""
+    (dry_run, inplace, analyze, remove, analyze_kws, singlespot, engine,
+     profile) = args
+    return transfer.get_inputs(fname, inplace=inplace, analyze=analyze,
+                               analyze_kws=analyze_kws, singlespot=singlespot,
+                               engine=engine, profile=profile)
+
+
+def record_success(manifest, args, fname):
+    """Record the processed file `fname` in the `manifest`."""
+    (dry_run, inplace, analyze, remove, analyze_kws, singlespot, engine,
+     profile) = args
+    outputs = transfer.archive_outputs(fname, inplace=inplace,
+                                       analyze=analyze, singlespot=singlespot,
+                                       profile=profile)
+    manifest.record(str(fname), get_inputs(fname, args), outputs=outputs)
+
+
+def monitor_success(manifest, store, args, fname):
+    if manifest is not None:
+        record_success(manifest, args, fname)
+    if store is not None:
+        store.set_state(fname, 'done')
+
+
+def monitor_failure(store, fname, error):
+    if store is not None:
+        store.set_state(fname, 'failed', error=error)
+
+
+def start_reporter(dry_run=False, metrics_path=None, prometheus_path=None,
+                   report_interval=60):
+    """Start and return a `metrics.MetricsReporter` (None if no metrics).
+    """
+    if dry_run or metrics_path is None:
+        return None
+    metrics.configure(metrics_path)
+    reporter = metrics.MetricsReporter(metrics_path,
+                                       prometheus_path=prometheus_path,
+                                       interval=report_interval)
+    reporter.start()
+    return reporter
+
+
+def start_export_service(dry_run=False, analyze=True, analyze_kws=None,
+                         html_workers=1):
+    """Start and return a `htmlexport.ExportService` (None if not needed).
+    """
+    analyze_kws = analyze_kws or {}
+    if dry_run or not analyze or not analyze_kws.get('save_html'):
+        return None
+    if html_workers <= 0:
+        return None
+    print('- Rendering HTML reports in %d background processes.'
+          % html_workers, flush=True)
+    return htmlexport.ExportService(html_workers).start()
+
+
+def make_autoscaler(autoscale_kws=None, nproc=4):
+    """Return an `autoscale.Autoscaler` (None if `autoscale_kws` is None).
+    """
+    if autoscale_kws is None:
+        return None
+    autoscaler = autoscale.Autoscaler(ceiling=nproc, **autoscale_kws)
+    print('- Autoscale: %d to %d concurrent files, pause below %.1f GB of '
+          'free memory.' % (autoscaler.floor, autoscaler.ceiling,
+                            autoscaler.min_free / 1024**3), flush=True)
+    return autoscaler
+
+
+def make_scheduler(admission_control=False, ramdisk_capacity=None,
+                   nproc=4, pipeline_kws=None):
+    """Return a `RamdiskScheduler` or None if `admission_control` is False.
+    """
+    if not admission_control:
+        return None
+    if ramdisk_capacity is None:
+        ramdisk_capacity = admission.ramdisk_capacity(transfer.temp_basedir)
+    max_jobs = nproc if pipeline_kws is None else None
+    print('- Ramdisk admission control: %.1f GB available.' %
+          (ramdisk_capacity / 1024**3), flush=True)
+    return admission.RamdiskScheduler(ramdisk_capacity, max_jobs=max_jobs)
+
+
 def start_monitoring(folder, dry_run=False, nproc=4, inplace=False,
                      analyze=True, remove=True, analyze_kws=None,
-                     singlespot=False):
+                     singlespot=False, warm_kernels=False, kernel_max_runs=50,
+                     watch_backend='auto', pipeline_kws=None,
+                     admission_control=False, ramdisk_capacity=None,
+                     engine='notebook', profile=None,
+                     manifest_path=default_manifest_path,
+                     job_store_path=default_job_store_path,
+                     retry_failed=False,
+                     metrics_path=metrics.default_metrics_path,
+                     prometheus_path=None, report_interval=60,
+                     html_workers=1, cluster_address=None,
+                     removal_grace=reclaim.default_grace,
+                     catalog_path=default_catalog_path, autoscale_kws=None,
+                     preview=None, batch_kws=None,
+                     history_path=profiles.default_history_path):
     title_msg = 'Monitoring files in folder: %s' % folder.name
     print('\n\n%s' % title_msg)
 
-    glob = '*.sm' if singlespot else '*.dat'
-    init_filelist = get_new_files(folder, glob=glob)
+    ext = '.sm' if singlespot else '.dat'
+    watcher = FolderWatcher(folder, ext=ext, backend=watch_backend)
 
-    print('- The following files are present at startup and will be skipped:')
-    for f in init_filelist:
-        print('  %s' % f)
-    print()
+    print('- Watching folder using backend: %s' % watcher.backend)
 
-    args = [dry_run, inplace, analyze, remove, analyze_kws, singlespot]
-    with Pool(processes=nproc) as pool:
-        try:
-            while True:
-                transfer.timestamp()
-                for i in range(20):
-                    time.sleep(3)
-                    newfiles = get_new_files(folder, init_filelist, glob=glob)
-                    for newfile in newfiles:
-                        pool.apply_async(transfer.process_int,
-                                         [newfile] + args,
-                                         callback=complete_task)
-                    init_filelist += newfiles
-        except KeyboardInterrupt:
-            print('\n>>> Got keyboard interrupt.\n', flush=True)
+    args = [dry_run, inplace, analyze, remove, analyze_kws, singlespot,
+            engine, profile]
+    kernel_init = kernelpool.worker_initializer(warm_kernels, kernel_max_runs)
+    scheduler = make_scheduler(admission_control, ramdisk_capacity, nproc,
+                               pipeline_kws)
+    autoscaler = make_autoscaler(autoscale_kws, nproc)
+    manifest = None
+    if not dry_run and manifest_path is not None:
+        manifest = Manifest(manifest_path)
+    store = None
+    added = []
+    if not dry_run and job_store_path is not None:
+        store = JobStore(job_store_path)
+        if retry_failed:
+            print('- Failed jobs put back in queue: %d' % store.retry_failed())
+        print('- Job store "%s": recovered %d interrupted jobs, %s' %
+              (store.path, store.recover(), store.counts()), flush=True)
+        # Files which arrived while the monitor of this folder was stopped
+        # (a folder never monitored has no history: all files are skipped)
+        if store.has_jobs(folder):
+            added = [f for f in watcher.existing
+                     if store.get_state(f) is None]
+            if manifest is not None:
+                items = [(str(f), get_inputs(f, args)) for f in added]
+                added = [Path(key) for key, _ in filter_done(manifest, items)]
+            for f in added:
+                store.add(f)
+    if added:
+        print('- The following files arrived while the monitor was stopped, '
+              'they will be processed:')
+        for f in added:
+            print('  %s' % f)
+    print('- The following files are present at startup and will be '
+          'skipped:')
+    for f in watcher.existing:
+        if f not in added:
+            print('  %s' % f)
+    print()
+    reporter = start_reporter(dry_run, metrics_path, prometheus_path,
+                              report_interval)
+    # HTML of remote workers is rendered by the workers
+    exporter = start_export_service(dry_run, analyze, analyze_kws,
+                                    0 if cluster_address else html_workers)
+    export_queue = None if exporter is None else exporter.queue
+    dispatcher = Dispatcher(nproc, args, kernel_init=kernel_init,
+                            pipeline_kws=pipeline_kws, scheduler=scheduler,
+                            job_store_path=job_store_path if store else None,
+                            metrics_path=None if dry_run else metrics_path,
+                            export_queue=export_queue,
+                            cluster_address=cluster_address,
+                            removal_grace=removal_grace,
+                            catalog_path=None if dry_run else catalog_path,
+                            autoscaler=autoscaler, preview=preview,
+                            history_path=history_path, batch_kws=batch_kws)
+    dispatcher.on_success = partial(monitor_success, manifest, store, args)
+    dispatcher.on_failure = partial(monitor_failure, store)
+    watcher.start()
+    dispatcher.start()
+    try:
+        last_heartbeat = time.time()
+        while True:
+            try:
+                newfile = watcher.queue.get(timeout=1)
+            except queue.Empty:
+                pass
+            else:
+                if store is None:
+                    dispatcher.add(newfile)
+                else:
+                    store.add(newfile)
+            if store is not None:
+                # Keep at most 2 jobs per worker claimed by this monitor
+                limit = (2 * nproc * dispatcher.files_per_job -
+                         dispatcher.num_active)
+                for fname in store.claim(limit, folder=folder):
+                    dispatcher.add(fname)
+            dispatcher.dispatch(timeout=0)
+            if store is not None and time.time() - last_heartbeat >= 60:
+                store.heartbeat()
+                last_heartbeat = time.time()
+    except KeyboardInterrupt:
+        print('\n>>> Got keyboard interrupt.\n', flush=True)
+    finally:
+        watcher.stop()
+        dispatcher.terminate()
+        if exporter is not None:
+            exporter.terminate()
+        if reporter is not None:
+            reporter.stop()
     print('Closing subprocess pool.', flush=True)
 
 
 def batch_process(folder, dry_run=False, nproc=4, inplace=False, analyze=True,
-                  remove=True, analyze_kws=None, singlespot=False):
+                  remove=True, analyze_kws=None, singlespot=False,
+                  warm_kernels=False, kernel_max_runs=50, pipeline_kws=None,
+                  admission_control=False, ramdisk_capacity=None,
+                  engine='notebook', profile=None,
+                  manifest_path=default_manifest_path, force=False,
+                  rerun_report=False,
+                  metrics_path=metrics.default_metrics_path,
+                  prometheus_path=None, report_interval=60, html_workers=1,
+                  cluster_address=None, removal_grace=reclaim.default_grace,
+                  catalog_path=default_catalog_path, autoscale_kws=None,
+                  preview=None, batch_kws=None,
+                  history_path=profiles.default_history_path):
     assert folder.is_dir(), 'Path not found: %s' % folder
 
     title_msg = 'Processing files in folder: %s' % folder.name
@@ -61,18 +667,62 @@ def batch_process(folder, dry_run=False, nproc=4, inplace=False, analyze=True,
 
     glob = '*.sm' if singlespot else '*.dat'
     filelist = get_new_files(folder, glob=glob)
+    args = [dry_run, inplace, analyze, remove, analyze_kws, singlespot,
+            engine, profile]
+
+    manifest = None
+    if manifest_path is not None:
+        manifest = Manifest(manifest_path)
+        print('- Checking manifest "%s":' % manifest.path)
+        items = [(str(f), get_inputs(f, args)) for f in filelist]
+        todo = filter_done(manifest, items, force=force, report=True)
+        filelist = [Path(key) for key, _ in todo]
+        print()
+    if rerun_report:
+        return
 
     print('- The following files will be processed in batch:')
     for f in filelist:
         print('  %s' % f)
     print()
-
-    args = [dry_run, inplace, analyze, remove, analyze_kws, singlespot]
-    with Pool(processes=nproc) as pool:
-        try:
-            pool.starmap(transfer.process_int, [[f] + args for f in filelist])
-        except KeyboardInterrupt:
-            print('\n>>> Got keyboard interrupt.\n', flush=True)
+    kernel_init = kernelpool.worker_initializer(warm_kernels, kernel_max_runs)
+    scheduler = make_scheduler(admission_control, ramdisk_capacity, nproc,
+                               pipeline_kws)
+    autoscaler = make_autoscaler(autoscale_kws, nproc)
+    reporter = start_reporter(dry_run, metrics_path, prometheus_path,
+                              report_interval)
+    # HTML of remote workers is rendered by the workers
+    exporter = start_export_service(dry_run, analyze, analyze_kws,
+                                    0 if cluster_address else html_workers)
+    export_queue = None if exporter is None else exporter.queue
+    dispatcher = Dispatcher(nproc, args, kernel_init=kernel_init,
+                            pipeline_kws=pipeline_kws, scheduler=scheduler,
+                            metrics_path=None if dry_run else metrics_path,
+                            export_queue=export_queue,
+                            cluster_address=cluster_address,
+                            removal_grace=removal_grace,
+                            catalog_path=None if dry_run else catalog_path,
+                            autoscaler=autoscaler, preview=preview,
+                            history_path=history_path, batch_kws=batch_kws)
+    if not dry_run and manifest is not None:
+        dispatcher.on_success = partial(record_success, manifest, args)
+    dispatcher.start()
+    try:
+        for f in filelist:
+            dispatcher.add(f)
+        dispatcher.join()
+        dispatcher.close()
+        if exporter is not None:
+            print('Waiting for the HTML reports.', flush=True)
+            exporter.close()
+    except KeyboardInterrupt:
+        print('\n>>> Got keyboard interrupt.\n', flush=True)
+        dispatcher.terminate()
+        if exporter is not None:
+            exporter.terminate()
+    finally:
+        if reporter is not None:
+            reporter.stop()
     print('Closing subprocess pool.', flush=True)
 
 
@@ -95,7 +745,9 @@ if __name__ == '__main__':
 
     msg = """\
         Monitor a folder and only convert/process new data files appearing
-        after the script is launched. Without this option,
+        after the script is launched (and, if the folder was already
+        monitored with the same job store, the files which arrived while
+        the monitor was stopped). Without this option,
         all the data files in the specified folder will be processed."""
     parser.add_argument('--monitor', action='store_true', help=msg)
 
@@ -107,6 +759,17 @@ if __name__ == '__main__':
     parser.add_argument('--num-processes', '-n', metavar='N', type=int,
                         default=4, help='Number of multiprocess workers to '
                                         'use. Default 4.')
+    parser.add_argument('--engine', default='notebook',
+                        choices=('notebook', 'python'),
+                        help="Run the conversion notebook ('notebook', "
+                             "default) or convert in-process ('python').")
+    parser.add_argument('--profile', default=None,
+                        choices=sorted(profiles.profiles) + ['auto'],
+                        help="Conversion profile (see profiles.py) setting "
+                             "mode, chunk size and compression. 'auto' "
+                             "chooses it for each file from its size, the "
+                             "free ramdisk space and past timings. "
+                             "Overrides --tempfile.")
     parser.add_argument('--analyze', action='store_true',
                         help='Run smFRET analysis after files are converted.')
     parser.add_argument('--singlespot', action='store_true',
@@ -122,23 +785,224 @@ if __name__ == '__main__':
                              'notebook.')
     parser.add_argument('--save-html', action='store_true',
                         help='Save a copy of the smFRET notebooks in HTML.')
+    parser.add_argument('--html-workers', metavar='N', type=int, default=1,
+                        help='Processes rendering the HTML reports in '
+                             'background (with --save-html). With 0, HTML '
+                             'is rendered by the analysis workers. '
+                             'Default 1.')
+    parser.add_argument('--slim', action='store_true',
+                        help='Move the images of the output notebooks to the '
+                             'sidecar folder "%s" and truncate very large '
+                             'outputs (see nbslim.py).'
+                             % nbslim.default_images_folder)
+    parser.add_argument('--profile-cells', action='store_true',
+                        help='Save wall time, CPU time and peak memory of '
+                             'each cell of the analysis notebooks (see '
+                             'cellprofile.py).')
+    parser.add_argument('--cache-dir', metavar='PATH', default=None,
+                        help='Keep the analysis caches (_cache.hdf5) in this '
+                             'folder instead of next to the data files '
+                             '(see cachestore.py). Suggested: "%s".'
+                             % cachestore.default_cache_dir)
+    parser.add_argument('--cache-size', metavar='GB', type=float,
+                        default=cachestore.default_max_bytes / 1024**3,
+                        help='Size budget of the cache folder (least '
+                             'recently used caches are removed). '
+                             'Default %(default)g.')
+    parser.add_argument('--shards', metavar='N', type=int, default=None,
+                        help='Analyze the spots of each 48-spot file in N '
+                             'kernels in parallel (see sharding.py). Each '
+                             'kernel loads the whole file. Limited to '
+                             'CPUs / parallel analyses.')
+    parser.add_argument('--micro-batch', action='store_true',
+                        help='Process the small SM files in groups, each '
+                             'group in a single worker call sharing the '
+                             'kernel of the notebooks (see microbatch.py). '
+                             'DAT files are processed one by one. Not '
+                             'compatible with --pipeline.')
+    parser.add_argument('--batch-max-mb', metavar='MB', type=float,
+                        default=microbatch.default_max_bytes / 1024**2,
+                        help='Max total size of the files of a group (with '
+                             '--micro-batch). Default %(default)g.')
+    parser.add_argument('--batch-max-files', metavar='N', type=int,
+                        default=microbatch.default_max_files,
+                        help='Max number of files in a group (with '
+                             '--micro-batch). Default %(default)d.')
     parser.add_argument('--keep-temp-files', action='store_true',
                         help='Do not delete files from temporary work folder.')
+    parser.add_argument('--removal-grace', metavar='SECONDS', type=float,
+                        default=reclaim.default_grace,
+                        help='Delay before removing the temp files of a '
+                             'file, in background. Create "<name>%s" '
+                             'next to the temp files to cancel. '
+                             'Default %%(default)g.' % reclaim.keep_suffix)
+    parser.add_argument('--warm-kernels', action='store_true',
+                        help='Execute notebooks in a long-lived, pre-warmed '
+                             'kernel owned by each worker.')
+    parser.add_argument('--kernel-max-runs', metavar='N', type=int, default=50,
+                        help='Restart a warm kernel after N notebooks. '
+                             'Default 50.')
+    parser.add_argument('--watch-backend', default='auto',
+                        choices=('auto', 'inotify', 'scan'),
+                        help="Method used to detect new files in monitor mode. "
+                             "'auto' (default) uses inotify unless the folder "
+                             "is on a network file system.")
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Run copy, conversion, archival and analysis as '
+                             'separate stages, each one with its own workers. '
+                             'The number of conversion workers is set by -n.')
+    parser.add_argument('--copy-workers', metavar='N', type=int, default=2,
+                        help='Workers copying files to ramdisk (with '
+                             '--pipeline). Default 2.')
+    parser.add_argument('--archive-workers', metavar='N', type=int, default=1,
+                        help='Workers copying files to archive (with '
+                             '--pipeline). Default 1.')
+    parser.add_argument('--analyze-workers', metavar='N', type=int,
+                        default=None,
+                        help='Analysis workers (with --pipeline). '
+                             'Default same as -n.')
+    parser.add_argument('--admission', action='store_true',
+                        help='Start processing a file only when its estimated '
+                             'footprint fits in the ramdisk.')
+    parser.add_argument('--ramdisk-capacity', metavar='GB', type=float,
+                        default=None,
+                        help='Ramdisk space available for processing (with '
+                             '--admission). Default: current free space.')
+    parser.add_argument('--autoscale', action='store_true',
+                        help='Adapt the number of files processed at once '
+                             '(between --min-workers and -n) to the CPU and '
+                             'memory use, see autoscale.py. Not compatible '
+                             'with --pipeline and --cluster.')
+    parser.add_argument('--min-workers', metavar='N', type=int, default=1,
+                        help='Min number of files processed at once (with '
+                             '--autoscale). Default 1.')
+    parser.add_argument('--min-free-memory', metavar='GB', type=float,
+                        default=autoscale.default_min_free / 1024**3,
+                        help='With --autoscale, do not start new files when '
+                             'the available memory is below GB. '
+                             'Default %(default)g.')
+    parser.add_argument('--start-method', default='fork',
+                        choices=startup.start_methods,
+                        help="How worker processes are started: 'fork' "
+                             "(default), 'preload' (the main process "
+                             "imports the heavy packages before forking the "
+                             "workers) or 'forkserver' (workers are forked "
+                             "from a server process with the packages "
+                             "already imported). See startup.py.")
+    parser.add_argument('--cluster', metavar='HOST:PORT', default=None,
+                        help='Listen on HOST:PORT and process the files on '
+                             'the workers connected to it (started with '
+                             './cluster.py on any machine) instead of local '
+                             'processes. Not compatible with --pipeline and '
+                             '--admission.')
+    parser.add_argument('--manifest', metavar='PATH',
+                        default=str(default_manifest_path),
+                        help='Manifest file recording the inputs of the '
+                             'processed files. Default "%s".'
+                             % default_manifest_path)
+    parser.add_argument('--force', action='store_true',
+                        help='Process all the files, even if already '
+                             'processed with the same inputs.')
+    parser.add_argument('--rerun-report', action='store_true',
+                        help='Only print which files would be processed '
+                             '(and why) according to the manifest.')
+    parser.add_argument('--job-store', metavar='PATH',
+                        default=str(default_job_store_path),
+                        help='Database with the state of the jobs in monitor '
+                             'mode. Pending jobs are resumed on restart. '
+                             'Default "%s".' % default_job_store_path)
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='In monitor mode, process again the jobs which '
+                             'failed in previous runs.')
+    parser.add_argument('--catalog', metavar='PATH',
+                        default=str(default_catalog_path),
+                        help='Catalog database where the archived files are '
+                             'indexed (see catalog.py). Default "%s".'
+                             % default_catalog_path)
+    parser.add_argument('--metrics', metavar='PATH',
+                        default=str(metrics.default_metrics_path),
+                        help='JSON lines file where the metrics of each '
+                             'processing stage are appended. Default "%s".'
+                             % metrics.default_metrics_path)
+    parser.add_argument('--history', metavar='PATH',
+                        default=str(profiles.default_history_path),
+                        help='JSON lines file of the conversion timings used '
+                             "by '--profile auto'. Default \"%s\"."
+                             % profiles.default_history_path)
+    parser.add_argument('--prometheus', metavar='PATH', default=None,
+                        help='Periodically write the metrics to this file in '
+                             'Prometheus text format.')
+    parser.add_argument('--report-interval', metavar='SECONDS', type=float,
+                        default=60,
+                        help='Interval between throughput summaries. '
+                             'Default 60.')
     args = parser.parse_args()
+    startup.configure(args.start_method)
 
     folder = Path(args.folder)
     if not folder.exists():
         sys.exit('\nFolder not found: %s\n' % folder)
     elif not folder.is_dir():
         sys.exit('\nYou must provide a folder (not a file) as an argument.\n')
+    if args.cluster and (args.pipeline or args.admission):
+        sys.exit('\nOption --cluster cannot be used with --pipeline or '
+                 '--admission.\n')
+    if args.autoscale and (args.pipeline or args.cluster):
+        sys.exit('\nOption --autoscale cannot be used with --pipeline or '
+                 '--cluster.\n')
+    if args.micro_batch and args.pipeline:
+        sys.exit('\nOption --micro-batch cannot be used with --pipeline.\n')
+    shards = None
+    if args.shards and not args.singlespot:
+        # Each shard is a kernel: at most one kernel per CPU in total
+        num_jobs = args.num_processes
+        if args.pipeline and args.analyze_workers is not None:
+            num_jobs = args.analyze_workers
+        shards = sharding.limit_shards(args.shards, num_jobs)
+        if shards != args.shards:
+            print('- Shards per file limited to %s (%d CPUs).' %
+                  (shards, os.cpu_count() or 1))
     analyze_kws = dict(input_notebook=args.notebook, save_html=args.save_html,
-                       working_dir=args.working_dir)
+                       working_dir=args.working_dir, slim=args.slim,
+                       shards=shards,
+                       cache_dir=args.cache_dir,
+                       cache_size=int(args.cache_size * 1024**3),
+                       profile_cells=args.profile_cells)
     kwargs = dict(dry_run=args.dry_run, nproc=args.num_processes,
                   inplace=not args.tempfile, singlespot=args.singlespot,
                   analyze=args.analyze, analyze_kws=analyze_kws,
-                  remove=not args.keep_temp_files)
+                  remove=not args.keep_temp_files,
+                  warm_kernels=args.warm_kernels,
+                  kernel_max_runs=args.kernel_max_runs,
+                  admission_control=args.admission, engine=args.engine,
+                  profile=args.profile, html_workers=args.html_workers)
+    if args.ramdisk_capacity is not None:
+        kwargs['ramdisk_capacity'] = int(args.ramdisk_capacity * 1024**3)
+    if args.pipeline:
+        kwargs['pipeline_kws'] = dict(copy_workers=args.copy_workers,
+                                      archive_workers=args.archive_workers,
+                                      analyze_workers=args.analyze_workers)
+    kwargs['manifest_path'] = Path(args.manifest)
+    kwargs['metrics_path'] = Path(args.metrics)
+    kwargs['history_path'] = Path(args.history)
+    kwargs['prometheus_path'] = args.prometheus
+    kwargs['report_interval'] = args.report_interval
+    kwargs['cluster_address'] = args.cluster
+    kwargs['removal_grace'] = args.removal_grace
+    kwargs['catalog_path'] = Path(args.catalog)
+    if args.autoscale:
+        kwargs['autoscale_kws'] = dict(
+            floor=args.min_workers,
+            min_free=int(args.min_free_memory * 1024**3))
+    if args.micro_batch:
+        kwargs['batch_kws'] = dict(
+            max_bytes=int(args.batch_max_mb * 1024**2),
+            max_files=args.batch_max_files)
     if args.monitor:
-        start_monitoring(folder, **kwargs)
+        start_monitoring(folder, watch_backend=args.watch_backend,
+                         job_store_path=Path(args.job_store),
+                         retry_failed=args.retry_failed, **kwargs)
     else:
-        batch_process(folder, **kwargs)
+        batch_process(folder, force=args.force,
+                      rerun_report=args.rerun_report, **kwargs)
     print('Monitor execution end.', flush=True)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""
+benchmark - End-to-end throughput benchmark on synthetic data.
+
+Synthetic data files (see `synthdata`) are processed by
+`batch_convert.batch_process` (i.e. `transfer.process` in each worker)
+for each combination of number of processes, conversion mode, conversion
+engine, chunk size and conversion profile. Local folders in the benchmark
+working dir replace the remote, ramdisk and archive mounts:
+
+    <workdir>/origin/     synthetic data files (generated once)
+    <workdir>/run/temp/   temp folder (ramdisk)
+    <workdir>/run/archive/
+
+Optionally, the archived Photon-HDF5 files are analyzed with
+`batch_analyze.batch_process`.
+
+Each run records the per-stage metrics (see `metrics`). The report is
+saved as JSON and can be compared with a previous report (`--baseline`)
+to catch throughput regressions.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import itertools
+import subprocess
+from pathlib import Path
+
+import transfer
+import batch_convert
+import metrics
+import synthdata
+import profiles
+
+
+default_workdir = Path('~', '.transfer_convert', 'benchmark').expanduser()
+
+
+def setup_transfer(workdir):
+    """Point the folders of `transfer` to local folders in `workdir`.
+
+    Worker processes inherit the module variables (fork start method).
+    """
+    workdir = Path(workdir)
+    run_dir = Path(workdir, 'run')
+    transfer.remote_origin_basedir = str(Path(workdir, 'origin')) + '/'
+    transfer.temp_basedir = str(Path(run_dir, 'temp')) + '/'
+    transfer.local_archive_basedir = str(Path(run_dir, 'archive')) + '/'
+    transfer.remote_archive_basedir = str(Path(run_dir, 'remote_archive')) + '/'
+    return run_dir
+
+
+def get_configs(nproc=(1, 2, 4), modes=('inplace', 'tempfile'),
+                engines=('python',), chunksizes=(None,), profile_names=(None,),
+                singlespot=False):
+    """Return the list of configurations (dicts) to be benchmarked.
+
+    The chunk size is used only by the python engine in tempfile mode.
+    A conversion profile (see `profiles`) sets mode and chunk size.
+    """
+    if singlespot:
+        modes, profile_names = ('singlespot',), (None,)
+    configs = []
+    for n, mode, engine, chunksize, profile in itertools.product(
+            nproc, modes, engines, chunksizes, profile_names):
+        if profile is not None:
+            mode, chunksize = 'profile', None
+        if engine != 'python' or mode != 'tempfile':
+            chunksize = None
+        config = dict(nproc=n, mode=mode, engine=engine, chunksize=chunksize,
+                      profile=profile)
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def config_id(config):
+    """Return a string identifying `config` (used to compare reports)."""
+    return ' '.join('%s=%s' % (k, config[k]) for k in sorted(config))
+
+
+def run_conversion(config, workdir, analyze_notebook=None):
+    """Process all the files in `<workdir>/origin` with `config`.
+
+    Returns a dict with the results of the run.
+    """
+    import conversion
+    run_dir = setup_transfer(workdir)
+    if run_dir.exists():
+        shutil.rmtree(str(run_dir))
+    run_dir.mkdir(parents=True)
+    metrics_path = Path(run_dir, 'metrics.jsonl')
+    default_chunksize = conversion.tempfile_chunksize
+    if config['chunksize'] is not None:
+        conversion.tempfile_chunksize = config['chunksize']
+    origin = Path(transfer.remote_origin_basedir)
+    singlespot = config['mode'] == 'singlespot'
+    datafiles = sorted(origin.glob('*.sm' if singlespot else '*.dat'))
+    t_start = time.time()
+    try:
+        batch_convert.batch_process(
+            origin, nproc=config['nproc'], inplace=config['mode'] == 'inplace',
+            analyze=False, remove=True, singlespot=singlespot,
+            engine=config['engine'], profile=config['profile'],
+            manifest_path=None, catalog_path=None,
+            history_path=Path(run_dir, 'conversion_history.jsonl'),
+            metrics_path=metrics_path, report_interval=3600,
+            removal_grace=0)
+    finally:
+        conversion.tempfile_chunksize = default_chunksize
+    wall = time.time() - t_start
+
+    totals = metrics.StageTotals()
+    records = []
+    if metrics_path.is_file():
+        records, _ = metrics.read_records(metrics_path)
+    for record in records:
+        totals.add(record)
+    nbytes = sum(f.stat().st_size for f in datafiles)
+    archive = Path(transfer.local_archive_basedir)
+    h5files = sorted(archive.glob('*.hdf5'))
+    result = dict(config=config, num_files=len(datafiles), bytes=nbytes,
+                  wall=wall, mbps=nbytes / 1024**2 / wall,
+                  num_converted=len(h5files),
+                  errors=sum(r['status'] != 'ok' for r in records),
+                  stages={stage: dict(
+                      busy_mbps=metrics._mbps(t['bytes'], t['seconds']),
+                      seconds=t['seconds'], peak_rss=t['peak_rss'],
+                      errors=t['error'])
+                      for stage, t in totals.totals.items()})
+    if analyze_notebook is not None and h5files:
+        result['analysis'] = run_analysis(archive, config['nproc'],
+                                          analyze_notebook)
+    return result
+
+
+def run_analysis(folder, nproc, notebook):
+    """Analyze the Photon-HDF5 files in `folder` and return the results."""
+    import batch_analyze
+    h5files = sorted(batch_analyze.get_file_list(folder))
+    nbytes = sum(f.stat().st_size for f in h5files)
+    t_start = time.time()
+    batch_analyze.batch_process(folder, nproc=nproc, notebook=notebook,
+                                working_dir=str(folder), manifest_path=None)
+    wall = time.time() - t_start
+    analyzed = [f for f in h5files if f.with_suffix('.ipynb').is_file()]
+    return dict(num_files=len(h5files), num_analyzed=len(analyzed),
+                bytes=nbytes, wall=wall, mbps=nbytes / 1024**2 / wall,
+                files_per_min=len(analyzed) / wall * 60)
+
+
+def git_revision():
+    """Return the git commit of the repository (None if not available)."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=str(Path(__file__).parent), stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(configs, workdir=default_workdir, data_kws=None,
+                  repeat=1, analyze_notebook=None):
+    """Run all the `configs` and return the report dict.
+
+    Arguments:
+        configs (list): configurations from `get_configs()`.
+        workdir (Path): benchmark working dir.
+        data_kws (dict or None): arguments of `synthdata.generate_files`.
+        repeat (int): number of runs of each configuration. The fastest
+            run is reported.
+        analyze_notebook (string or None): if not None, also run the
+            analysis of the converted files with this notebook.
+    """
+    data_kws = data_kws or {}
+    workdir = Path(workdir)
+    origin = Path(workdir, 'origin')
+    # Generate the data again if the parameters changed
+    params_path = Path(origin, 'params.json')
+    if params_path.is_file():
+        with open(str(params_path)) as f:
+            if json.load(f) != data_kws:
+                shutil.rmtree(str(origin))
+    synthdata.generate_files(origin, **data_kws)
+    with open(str(params_path), 'w') as f:
+        json.dump(data_kws, f)
+    report = dict(host=socket.gethostname(), cpu_count=os.cpu_count(),
+                  python=platform.python_version(), revision=git_revision(),
+                  time=time.ctime(), data=data_kws, repeat=repeat, results=[])
+    for config in configs:
+        print('\n\n=== BENCHMARK %s' % config_id(config), flush=True)
+        runs = [run_conversion(config, workdir, analyze_notebook)
+                for _ in range(repeat)]
+        report['results'].append(min(runs, key=lambda r: r['wall']))
+    return report
+
+
+def print_report(report, baseline=None, tolerance=0.1):
+    """Print the report, comparing throughputs with `baseline` (if any).
+
+    Returns the list of configurations slower than the baseline by more
+    than `tolerance` (fraction).
+    """
+    base = {}
+    if baseline is not None:
+        base = {config_id(r['config']): r for r in baseline['results']}
+        print('\nBaseline: %s (revision %s, %s)' %
+              (baseline['time'], baseline['revision'], baseline['host']))
+    print('\nReport: %s (revision %s, %s, %d CPUs)' %
+          (report['time'], report['revision'], report['host'],
+           report['cpu_count']))
+    print('Data: %s\n' % report['data'])
+    regressions = []
+    stages = metrics.stages
+    print('%-52s %7s %8s %5s  %s' % ('configuration', 'wall s', 'MB/s', 'err',
+                                     '  '.join('%8s' % s for s in stages)))
+    for r in report['results']:
+        key = config_id(r['config'])
+        busy = ['%8.1f' % r['stages'][s]['busy_mbps'] if s in r['stages']
+                else '%8s' % '-' for s in stages]
+        line = '%-52s %7.1f %8.1f %5d  %s' % (key, r['wall'], r['mbps'],
+                                             r['errors'], '  '.join(busy))
+        if key in base:
+            ratio = r['mbps'] / base[key]['mbps']
+            line += '  %+.0f%%' % ((ratio - 1) * 100)
+            if ratio < 1 - tolerance:
+                line += ' REGRESSION'
+                regressions.append(key)
+        print(line)
+        if 'analysis' in r:
+            a = r['analysis']
+            print('%-52s %7.1f %8.1f %5d  %.1f files/min' %
+                  ('  analysis', a['wall'], a['mbps'],
+                   a['num_files'] - a['num_analyzed'], a['files_per_min']))
+    print('\nStage columns: busy throughput (MB/s) of a single worker.',
+          flush=True)
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        Benchmark conversion (and optionally analysis) on synthetic data
+        using local folders in place of the remote, ramdisk and archive
+        mounts. Each combination of the parameters is run and the results
+        are saved in a JSON report.
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('--workdir', metavar='PATH', default=str(default_workdir),
+                        help='Benchmark working dir. Default "%s".'
+                             % default_workdir)
+    parser.add_argument('--num-files', metavar='N', type=int, default=4,
+                        help='Number of synthetic files. Default 4.')
+    parser.add_argument('--size', metavar='MB', type=float, default=100,
+                        help='Size of each file in MB. Default 100.')
+    parser.add_argument('--rate', metavar='CPS', type=float, default=None,
+                        help='Count rate per spot (see synthdata.py).')
+    parser.add_argument('--spots', metavar='N', type=int, default=48,
+                        help='Number of active spots. Default 48.')
+    parser.add_argument('--singlespot', action='store_true',
+                        help='Benchmark us-ALEX SM files.')
+    parser.add_argument('--nproc', metavar='N', type=int, nargs='+',
+                        default=[1, 2, 4],
+                        help='Numbers of processes. Default 1 2 4.')
+    parser.add_argument('--mode', nargs='+', default=['inplace', 'tempfile'],
+                        choices=('inplace', 'tempfile'),
+                        help='Conversion modes of DAT files. Default both.')
+    parser.add_argument('--engine', nargs='+', default=['python'],
+                        choices=('notebook', 'python'),
+                        help="Conversion engines. Default 'python'.")
+    parser.add_argument('--chunksize', metavar='N', type=int, nargs='+',
+                        default=[None],
+                        help='Chunk sizes of the tempfile conversion.')
+    parser.add_argument('--profile', nargs='+', default=[None],
+                        choices=sorted(profiles.profiles) + ['auto'],
+                        help='Conversion profiles (they replace --mode and '
+                             '--chunksize).')
+    parser.add_argument('--repeat', metavar='N', type=int, default=1,
+                        help='Runs of each configuration (the fastest is '
+                             'reported). Default 1.')
+    parser.add_argument('--analyze', metavar='NB_NAME', default=None,
+                        help='Also analyze the files with this notebook.')
+    parser.add_argument('--report', metavar='PATH', default=None,
+                        help='Save the JSON report. Default: '
+                             '<workdir>/report_<time>.json.')
+    parser.add_argument('--baseline', metavar='PATH', default=None,
+                        help='JSON report to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Throughput loss (fraction) reported as a '
+                             'regression. Default 0.1.')
+    args = parser.parse_args()
+
+    data_kws = dict(num_files=args.num_files, singlespot=args.singlespot,
+                    size_mb=args.size, rate=args.rate, num_spots=args.spots)
+    configs = get_configs(nproc=args.nproc, modes=args.mode,
+                          engines=args.engine, chunksizes=args.chunksize,
+                          profile_names=args.profile,
+                          singlespot=args.singlespot)
+    report = run_benchmark(configs, workdir=args.workdir, data_kws=data_kws,
+                           repeat=args.repeat, analyze_notebook=args.analyze)
+    report_path = args.report
+    if report_path is None:
+        report_path = Path(args.workdir,
+                           time.strftime('report_%Y-%m-%d_%H%M%S.json'))
+    with open(str(report_path), 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print('\nReport saved in "%s".' % report_path)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = print_report(report, baseline, tolerance=args.tolerance)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+cachestore - Local store for the analysis caches, with a size budget.
+
+FRETBursts `calc_bg_cache` saves the background fits (and other results)
+in a file `<data file name>_cache.hdf5` next to the data file. Each set of
+fit parameters is stored in a separate group of this file, so the cache
+can be reused by any notebook analyzing the same data.
+
+A `CacheStore` keeps these cache files in a local folder, one entry per
+data file, keyed by a hash of the data file content (so the entry is found
+even if the data file is moved or copied). During an analysis (see
+`CacheStore.checkout`) the cache file next to the data file is a symbolic
+link to the entry; at the end of the last analysis using it the link is
+removed, and a cache file created by the analysis is moved into the
+store. Size and last access time
+of each entry are tracked in a SQLite database and the least recently used
+entries are removed to keep the total size under a byte budget.
+
+Cache files found next to the data files are moved into the store the
+first time the data file is analyzed with the store enabled.
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+from pathlib import Path
+from contextlib import contextmanager
+
+
+default_cache_dir = Path('~', '.transfer_convert',
+                         'analysis_cache').expanduser()
+default_max_bytes = 50 * 1024**3
+cache_suffix = '_cache.hdf5'
+sample_size = 4 * 1024**2     # bytes hashed at the start, middle and end
+stale_pin_timeout = 24 * 3600  # entries in use for longer can be evicted
+
+schema = """\
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    data_name TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL,
+    pins INTEGER NOT NULL DEFAULT 0,
+    pinned REAL
+);
+CREATE INDEX IF NOT EXISTS entries_access ON entries (last_access);
+"""
+
+
+def data_key(path):
+    """Return the key of data file `path` (hash of size and content).
+
+    Only three blocks of `sample_size` bytes (start, middle and end of the
+    file) are hashed, so that the key of large files is fast to compute.
+    """
+    path = Path(path)
+    size = path.stat().st_size
+    hasher = hashlib.sha1(str(size).encode())
+    with open(str(path), 'rb') as f:
+        for offset in (0, max(0, size // 2 - sample_size // 2),
+                       max(0, size - sample_size)):
+            f.seek(offset)
+            hasher.update(f.read(sample_size))
+    return hasher.hexdigest()
+
+
+def cache_path(data_filename):
+    """Return the cache file name used by FRETBursts for `data_filename`."""
+    data_filename = Path(data_filename)
+    return data_filename.with_name(data_filename.stem + cache_suffix)
+
+
+class CacheStore:
+    """Analysis cache files stored in a folder, with LRU eviction.
+
+    Arguments:
+        path (Path): folder of the store. It is created if not existing.
+        max_bytes (int): budget for the total size of the entries.
+    """
+
+    def __init__(self, path=default_cache_dir, max_bytes=default_max_bytes):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(str(Path(self.path, 'index.sqlite')),
+                                    timeout=60, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(schema)
+
+    def close(self):
+        self.conn.close()
+
+    def entry_path(self, key):
+        return Path(self.path, key + cache_suffix)
+
+    def _touch(self, key, data_name, pins=0):
+        """Update size and access time of entry `key`, adding `pins` pins.
+
+        Returns the number of pins of the entry before the update and
+        the time of the last pin (or None).
+        """
+        now = time.time()
+        size = 0
+        entry = self.entry_path(key)
+        if entry.is_file():
+            size = entry.stat().st_size
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO entries (key, data_name, created, '
+                'last_access) VALUES (?, ?, ?, ?)', (key, data_name, now, now))
+            old_pins, pinned = self.conn.execute(
+                'SELECT pins, pinned FROM entries WHERE key = ?',
+                (key,)).fetchone()
+            self.conn.execute(
+                'UPDATE entries SET size = ?, last_access = ?, '
+                'pins = MAX(0, pins + ?), pinned = COALESCE(?, pinned) '
+                'WHERE key = ?',
+                (size, now, pins, now if pins > 0 else None, key))
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return old_pins, pinned
+
+    @staticmethod
+    def _in_use(pins, pinned):
+        """Return True if `pins` pins, the last at time `pinned`, are live."""
+        return pins > 0 and time.time() - (pinned or 0) < stale_pin_timeout
+
+    def _pinned(self, key):
+        """Return True if the entry `key` is in use (and not stale)."""
+        row = self.conn.execute('SELECT pins, pinned FROM entries '
+                                'WHERE key = ?', (key,)).fetchone()
+        return row is not None and self._in_use(*row)
+
+    def _import(self, key, cache_file):
+        """Move `cache_file` in the store as the entry `key`."""
+        entry = self.entry_path(key)
+        tmp_path = Path(self.path, '.' + entry.name + '.tmp')
+        shutil.copyfile(str(cache_file), str(tmp_path))
+        os.replace(str(tmp_path), str(entry))
+        os.remove(str(cache_file))
+
+    @contextmanager
+    def checkout(self, data_filename):
+        """Context manager making the cache of `data_filename` available.
+
+        While in the context, the FRETBursts cache file of `data_filename`
+        is a link to the entry in the store (if there is one). On exit,
+        a new cache file is moved into the store and the LRU entries are
+        evicted if the store exceeds `max_bytes`.
+        Yields the path of the entry in the store.
+        """
+        data_filename = Path(data_filename)
+        key = data_key(data_filename)
+        link = cache_path(data_filename)
+        entry = self.entry_path(key)
+        # Pin the entry before looking at the link, so that another
+        # analysis of the same file does not remove the link in between
+        shared = self._in_use(*self._touch(key, data_filename.name, pins=1))
+        if link.is_symlink():
+            # Left by an interrupted analysis, or in use by another process
+            if not shared:
+                link.unlink()
+        elif link.is_file() and not shared:
+            self._import(key, link)
+        found_link = os.path.lexists(str(link))
+        if entry.is_file() and not found_link:
+            try:
+                os.symlink(str(entry), str(link))
+            except FileExistsError:
+                found_link = True   # another process is analyzing the file
+        try:
+            yield entry
+        finally:
+            pins, pinned = self._touch(key, data_filename.name, pins=-1)
+            # The link (or a new cache file) is handled by the last
+            # analysis using it
+            in_use = self._in_use(pins - 1, pinned)
+            if link.is_symlink():
+                if not in_use:
+                    link.unlink()
+            elif link.is_file() and not in_use:
+                if found_link and entry.is_file():
+                    # Created while the link was missing: the entry, shared
+                    # with the other analyses, is not replaced
+                    os.remove(str(link))
+                else:
+                    self._import(key, link)
+                    self._touch(key, data_filename.name)
+            self.evict()
+
+    def evict(self, max_bytes=None):
+        """Remove the least recently used entries exceeding `max_bytes`.
+
+        Entries in use are not removed (unless in use for more than
+        `stale_pin_timeout` seconds). Returns the number of entries and of
+        bytes removed.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        rows = self.conn.execute(
+            'SELECT key, size, pins, pinned FROM entries '
+            'ORDER BY last_access').fetchall()
+        total = sum(row[1] for row in rows)
+        now = time.time()
+        removed, removed_bytes = 0, 0
+        for key, size, pins, pinned in rows:
+            if total <= max_bytes:
+                break
+            if pins > 0 and now - (pinned or 0) < stale_pin_timeout:
+                continue
+            entry = self.entry_path(key)
+            if entry.is_file():
+                entry.unlink()
+            self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+            removed += 1
+            removed_bytes += size
+        return removed, removed_bytes
+
+    def entries(self):
+        """Return a list of dicts describing the entries (LRU first)."""
+        cur = self.conn.execute('SELECT key, data_name, size, created, '
+                                'last_access, pins FROM entries '
+                                'ORDER BY last_access')
+        names = [c[0] for c in cur.description]
+        return [dict(zip(names, row)) for row in cur.fetchall()]
+
+    def total_bytes(self):
+        row = self.conn.execute('SELECT SUM(size) FROM entries').fetchone()
+        return row[0] or 0
+
+
+@contextmanager
+def checkout(data_filename, cache_dir=None, max_bytes=None):
+    """Checkout the cache of `data_filename` from the store in `cache_dir`.
+
+    If `cache_dir` is None the store is not used (yields None).
+    """
+    if cache_dir is None:
+        yield None
+        return
+    store = CacheStore(cache_dir, max_bytes=max_bytes or default_max_bytes)
+    try:
+        with store.checkout(data_filename) as entry:
+            yield entry
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        List the entries of the analysis cache store, optionally evicting
+        the least recently used entries to fit a size budget.
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('--cache-dir', metavar='PATH',
+                        default=str(default_cache_dir),
+                        help='Folder of the store. Default "%s".'
+                             % default_cache_dir)
+    parser.add_argument('--evict', metavar='GB', type=float, default=None,
+                        help='Evict the LRU entries exceeding GB gigabytes.')
+    args = parser.parse_args()
+
+    store = CacheStore(args.cache_dir)
+    if args.evict is not None:
+        removed, removed_bytes = store.evict(int(args.evict * 1024**3))
+        print('Evicted %d entries (%.1f MB).' %
+              (removed, removed_bytes / 1024**2))
+    for e in store.entries():
+        print('%s  %8.1f MB  %s  %s' % (
+            e['key'][:12], e['size'] / 1024**2,
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(e['last_access'])),
+            e['data_name']))
+    print('Total: %.1f MB' % (store.total_bytes() / 1024**2))
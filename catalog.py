@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+"""
+catalog - Index of the archived Photon-HDF5 files.
+
+Finding the files to analyze by globbing the archive (e.g. '**/*.hdf5'
+on the NTFS disk) lists every file of every folder before anything
+starts. The catalog is a SQLite database (WAL mode) with one row per
+archived Photon-HDF5 file: path, size and checksum of the file and of the
+original data file, acquisition date, number of spots, measurement type
+and the main fields of the YAML metadata (description, sample, dyes,
+buffer, author). The analyses run on each file (notebook name and date)
+are stored in a second table.
+
+Files are added by `transfer.copy_files_to_archive` (see the `--catalog`
+option of `batch_convert.py`) and the analyses by `batch_analyze.py` and
+`transfer`. Files archived before the catalog existed can be indexed with
+`./catalog.py --scan FOLDER`. `Catalog.select()` returns the files
+matching a date range, a sample name, a folder and/or not yet analyzed
+with a given notebook, e.g. for the `--select` option of
+`batch_analyze.py`.
+"""
+
+import json
+import time
+import sqlite3
+import datetime
+from pathlib import Path
+
+
+default_catalog_path = Path('~', '.transfer_convert',
+                            'catalog.sqlite').expanduser()
+
+# Suffixes of the Photon-HDF5 file names (see transfer.convert)
+conversion_suffixes = ('_inplace', '_tf')
+
+# Fields of the YAML metadata stored in their own (indexed) columns
+yaml_fields = dict(description=('description',),
+                   sample=('sample', 'sample_name'),
+                   dye_names=('sample', 'dye_names'),
+                   buffer_name=('sample', 'buffer_name'),
+                   author=('identity', 'author'))
+
+schema = """\
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    checksum TEXT,
+    data_path TEXT,
+    data_size INTEGER,
+    data_checksum TEXT,
+    acquired TEXT,
+    num_spots INTEGER,
+    measurement_type TEXT,
+    description TEXT,
+    sample TEXT,
+    dye_names TEXT,
+    buffer_name TEXT,
+    author TEXT,
+    metadata TEXT,
+    archived REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+CREATE INDEX IF NOT EXISTS files_acquired ON files (acquired);
+CREATE INDEX IF NOT EXISTS files_sample ON files (sample);
+CREATE TABLE IF NOT EXISTS analyses (
+    path TEXT NOT NULL,
+    notebook TEXT NOT NULL,
+    analyzed REAL NOT NULL,
+    PRIMARY KEY (path, notebook)
+);
+CREATE INDEX IF NOT EXISTS analyses_notebook ON analyses (notebook);
+"""
+
+
+def _get(d, keys):
+    for key in keys:
+        if not isinstance(d, dict) or key not in d:
+            return None
+        d = d[key]
+    return d
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode(errors='replace')
+    return value
+
+
+def read_metadata(yaml_fname):
+    """Return the dict of the YAML metadata file (empty if missing)."""
+    yaml_fname = Path(yaml_fname)
+    if not yaml_fname.is_file():
+        return {}
+    import yaml
+    with open(str(yaml_fname)) as f:
+        return yaml.safe_load(f) or {}
+
+
+def read_h5_info(h5_fname):
+    """Return acquisition date, number of spots and measurement type.
+
+    Values are None if not found in the Photon-HDF5 file (or if pytables
+    is not installed). The acquisition date is the creation time of the
+    original data file (/provenance/creation_time).
+    """
+    info = dict(acquired=None, num_spots=None, measurement_type=None)
+    try:
+        import tables
+    except ImportError:
+        return info
+    with tables.open_file(str(h5_fname)) as h5file:
+        def read(where):
+            try:
+                return _decode(h5file.get_node(where).read())
+            except tables.NoSuchNodeError:
+                return None
+        info['acquired'] = read('/provenance/creation_time')
+        num_spots = read('/setup/num_spots')
+        info['num_spots'] = None if num_spots is None else int(num_spots)
+        for group in ('/photon_data', '/photon_data0'):
+            mtype = read(group + '/measurement_specs/measurement_type')
+            if mtype is not None:
+                info['measurement_type'] = mtype
+                break
+    return info
+
+
+def parse_date(date):
+    """Return the ISO string ('YYYY-MM-DD HH:MM:SS') of `date`.
+
+    `date` can be a string (ISO format or prefix of it, e.g. '2017-05'),
+    a datetime or a timestamp.
+    """
+    if date is None:
+        return None
+    if isinstance(date, (int, float)):
+        date = datetime.datetime.fromtimestamp(date)
+    if isinstance(date, datetime.datetime):
+        return date.strftime('%Y-%m-%d %H:%M:%S')
+    return str(date).replace('T', ' ')
+
+
+class Catalog:
+    """Archived files and their analyses stored in a SQLite database.
+
+    Arguments:
+        path (Path): database file. It is created if not existing.
+    """
+
+    def __init__(self, path=default_catalog_path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), timeout=60,
+                                    isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(schema)
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, h5_fname, checksum=None, data_fname=None,
+            data_checksum=None, yaml_fname=None):
+        """Add (or update) the archived Photon-HDF5 file `h5_fname`.
+
+        Arguments:
+            h5_fname (Path): the archived Photon-HDF5 file.
+            checksum (string or None): checksum of `h5_fname`, e.g. as
+                computed while copying it.
+            data_fname (Path or None): the archived original data file.
+            data_checksum (string or None): checksum of `data_fname`.
+            yaml_fname (Path or None): YAML metadata file. If None, use the
+                YAML file next to `data_fname` (or to `h5_fname`).
+        """
+        # Absolute paths, as matched by `select()`
+        h5_fname = Path(h5_fname).resolve()
+        if data_fname is not None:
+            data_fname = Path(data_fname).resolve()
+        if yaml_fname is None:
+            yaml_fname = Path(data_fname or h5_fname).with_suffix('.yml')
+        metadata = read_metadata(yaml_fname)
+        info = read_h5_info(h5_fname)
+        if info['acquired'] is None:
+            source = data_fname if data_fname is not None else h5_fname
+            info['acquired'] = parse_date(Path(source).stat().st_mtime)
+        row = dict(path=str(h5_fname), folder=str(h5_fname.parent),
+                   name=h5_fname.name, size=h5_fname.stat().st_size,
+                   checksum=checksum, data_checksum=data_checksum,
+                   data_path=None, data_size=None,
+                   metadata=json.dumps(metadata, sort_keys=True,
+                                       default=str),
+                   archived=time.time(), **info)
+        row['acquired'] = parse_date(row['acquired'])
+        if data_fname is not None:
+            row['data_path'] = str(data_fname)
+            row['data_size'] = Path(data_fname).stat().st_size
+        for column, keys in yaml_fields.items():
+            value = _get(metadata, keys)
+            row[column] = None if value is None else str(value)
+        columns = sorted(row)
+        self.conn.execute(
+            'INSERT OR REPLACE INTO files (%s) VALUES (%s)' %
+            (', '.join(columns), ', '.join('?' * len(columns))),
+            [row[c] for c in columns])
+
+    def record_analysis(self, h5_fname, notebook):
+        """Record that `h5_fname` was analyzed with `notebook`."""
+        self.conn.execute(
+            'INSERT OR REPLACE INTO analyses (path, notebook, analyzed) '
+            'VALUES (?, ?, ?)', (str(Path(h5_fname).resolve()),
+                                 Path(notebook).name, time.time()))
+
+    def select(self, folder=None, start=None, end=None, sample=None,
+               measurement_type=None, num_spots=None, not_analyzed_with=None,
+               recursive=True):
+        """Return the paths of the files matching all the conditions.
+
+        Arguments:
+            folder (Path or None): only files in this folder (and in its
+                subfolders if `recursive`).
+            start, end (string, datetime or None): range of acquisition
+                dates (inclusive). Strings are ISO dates or their prefix,
+                e.g. '2017-05' as `end` includes the whole month.
+            sample (string or None): case-insensitive substring of the
+                sample name.
+            measurement_type (string or None): e.g. 'smFRET-usALEX'.
+            num_spots (int or None): number of spots.
+            not_analyzed_with (string or None): only files not yet analyzed
+                with the notebook of this name.
+        """
+        where, params = [], []
+        if folder is not None:
+            folder = str(Path(folder).resolve())
+            if recursive:
+                where.append('(folder = ? OR folder LIKE ?)')
+                params += [folder, folder.rstrip('/') + '/%']
+            else:
+                where.append('folder = ?')
+                params.append(folder)
+        if start is not None:
+            where.append('acquired >= ?')
+            params.append(parse_date(start))
+        if end is not None:
+            # Dates with the `end` prefix are included
+            where.append('acquired < ?')
+            params.append(parse_date(end) + '\uffff')
+        if sample is not None:
+            where.append('sample LIKE ?')
+            params.append('%' + sample + '%')
+        if measurement_type is not None:
+            where.append('measurement_type = ?')
+            params.append(measurement_type)
+        if num_spots is not None:
+            where.append('num_spots = ?')
+            params.append(num_spots)
+        if not_analyzed_with is not None:
+            where.append('path NOT IN (SELECT path FROM analyses '
+                         'WHERE notebook = ?)')
+            params.append(Path(not_analyzed_with).name)
+        query = 'SELECT path FROM files'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY acquired, path'
+        return [Path(row[0]) for row in self.conn.execute(query, params)]
+
+    def get(self, h5_fname):
+        """Return the dict describing file `h5_fname` (None if missing)."""
+        cur = self.conn.execute('SELECT * FROM files WHERE path = ?',
+                                (str(Path(h5_fname).resolve()),))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip([c[0] for c in cur.description], row))
+
+    def analyses(self, h5_fname):
+        """Return the list of (notebook, timestamp) of `h5_fname`."""
+        return self.conn.execute(
+            'SELECT notebook, analyzed FROM analyses WHERE path = ? '
+            'ORDER BY analyzed', (str(Path(h5_fname).resolve()),)).fetchall()
+
+    def scan(self, folder, glob='**/*.hdf5', update=False):
+        """Add the Photon-HDF5 files in `folder` not yet in the catalog.
+
+        With `update`, files already in the catalog are indexed again.
+        Returns the number of files added.
+        """
+        known = set()
+        if not update:
+            known = {row[0] for row in
+                     self.conn.execute('SELECT path FROM files')}
+        added = 0
+        for h5_fname in sorted(Path(folder).resolve().glob(glob)):
+            if h5_fname.stem.endswith('_cache') or str(h5_fname) in known:
+                continue
+            # Archived name: <data file stem>[_inplace|_tf].hdf5
+            stem = h5_fname.stem
+            for suffix in conversion_suffixes:
+                if stem.endswith(suffix):
+                    stem = stem[:-len(suffix)]
+                    break
+            data_fname = None
+            for ext in ('.dat', '.sm'):
+                if Path(h5_fname.parent, stem + ext).is_file():
+                    data_fname = Path(h5_fname.parent, stem + ext)
+                    break
+            try:
+                self.add(h5_fname, data_fname=data_fname,
+                         yaml_fname=Path(h5_fname.parent, stem + '.yml'))
+            except Exception as e:
+                print('- Error indexing "%s": %s' % (h5_fname, e), flush=True)
+                continue
+            added += 1
+        return added
+
+
+def add_select_arguments(parser):
+    """Add the catalog selection options to the argparse `parser`."""
+    parser.add_argument('--since', metavar='DATE', default=None,
+                        help='Files acquired on or after DATE (e.g. '
+                             '2017-05-01).')
+    parser.add_argument('--until', metavar='DATE', default=None,
+                        help='Files acquired on or before DATE (e.g. 2017-05 '
+                             'for the whole month).')
+    parser.add_argument('--sample', metavar='TEXT', default=None,
+                        help='Files whose sample name contains TEXT.')
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        Index the archived Photon-HDF5 files and list the files matching
+        the selection options.
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('folder', nargs='?', default=None,
+                        help='Only list files in this folder.')
+    parser.add_argument('--catalog', metavar='PATH',
+                        default=str(default_catalog_path),
+                        help='Catalog database. Default "%s".'
+                             % default_catalog_path)
+    parser.add_argument('--scan', metavar='FOLDER', default=None,
+                        help='Index the Photon-HDF5 files in FOLDER and its '
+                             'subfolders which are not in the catalog.')
+    parser.add_argument('--update', action='store_true',
+                        help='With --scan, index again the files already in '
+                             'the catalog.')
+    add_select_arguments(parser)
+    parser.add_argument('--not-analyzed-with', metavar='NB_NAME',
+                        default=None,
+                        help='Files not yet analyzed with this notebook.')
+    args = parser.parse_args()
+
+    catalog = Catalog(args.catalog)
+    if args.scan is not None:
+        print('Indexed %d files.' % catalog.scan(args.scan, update=args.update),
+              flush=True)
+    for path in catalog.select(folder=args.folder, start=args.since,
+                               end=args.until, sample=args.sample,
+                               not_analyzed_with=args.not_analyzed_with):
+        f = catalog.get(path)
+        print('%s  %-12s %3s  %-20s %s' % (
+            f['acquired'] or '', f['measurement_type'] or '',
+            f['num_spots'] or '', (f['sample'] or '')[:20], path))
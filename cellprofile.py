@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+cellprofile - Per-cell execution profile of the analysis notebooks.
+
+With `profile=True`, `nbrun.run_notebook` executes the notebook with
+`ProfilingPreprocessor`, which measures each code cell:
+
+- wall time (s),
+- CPU time (s) of the kernel and of its child processes,
+- peak RSS (bytes) of the kernel and of its child processes, sampled
+  every `sample_interval` seconds (and from the kernel's VmHWM).
+
+The measures are saved in the metadata of each cell of the output notebook
+(key 'profile') and in a sidecar JSON file `<output notebook>_profile.json`
+(see `write_profile`), where each cell is identified by its index in the
+template notebook, its first line and the hash of its source.
+
+Run this module as a script to aggregate the sidecar files of a whole
+batch (e.g. a `batch_analyze.py --profile-cells` run) and print the
+ranking of the hot cells. Linux only (the measures are read from /proc).
+"""
+
+import json
+import time
+import hashlib
+from pathlib import Path
+
+import metrics
+
+
+sample_interval = 0.1   # seconds between RSS samples during a cell
+profile_suffix = '_profile.json'
+sort_keys = ('wall', 'cpu', 'peak_rss', 'runs')
+
+_preprocessor_class = None
+
+
+def kernel_pid(km):
+    """Return the PID of the kernel of the KernelManager `km` (or None)."""
+    kernel = getattr(km, 'kernel', None)    # jupyter_client < 7
+    if kernel is None:
+        kernel = getattr(getattr(km, 'provisioner', None), 'process', None)
+    return getattr(kernel, 'pid', None)
+
+
+class CellTimer:
+    """Context manager measuring the execution of a cell in process `pid`.
+
+    After the body exits, `result` is a dict with keys 'wall', 'cpu' and
+    'peak_rss' (the last two are None if `pid` is None).
+    """
+
+    def __init__(self, pid, interval=sample_interval):
+        self.pid = pid
+        self.interval = interval
+        self.result = None
+
+    def __enter__(self):
+        self._sampler = None
+        if self.pid is not None:
+            metrics.reset_peak_rss(self.pid)
+            self._cpu = metrics.tree_cpu_seconds(self.pid)
+            self._sampler = metrics.RSSSampler(self.interval, pid=self.pid)
+            self._sampler.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._start
+        self.result = dict(wall=wall, cpu=None, peak_rss=None)
+        if self._sampler is not None:
+            self.result['peak_rss'] = self._sampler.stop()
+            self.result['cpu'] = (metrics.tree_cpu_seconds(self.pid) -
+                                  self._cpu)
+        return False
+
+
+def ProfilingPreprocessor(**kwargs):
+    """Return an `ExecutePreprocessor` saving the profile of each cell.
+
+    The profile dict (see `CellTimer`) is saved in `cell.metadata.profile`
+    of each code cell, also when the cell raises an error.
+    """
+    global _preprocessor_class
+    if _preprocessor_class is None:
+        from nbconvert.preprocessors import ExecutePreprocessor
+
+        class _ProfilingPreprocessor(ExecutePreprocessor):
+            def preprocess_cell(self, cell, resources, *args, **kwargs):
+                if cell.cell_type != 'code' or not cell.source.strip():
+                    return super().preprocess_cell(cell, resources, *args,
+                                                   **kwargs)
+                timer = CellTimer(kernel_pid(getattr(self, 'km', None)))
+                try:
+                    with timer:
+                        return super().preprocess_cell(cell, resources,
+                                                       *args, **kwargs)
+                finally:
+                    cell.metadata['profile'] = timer.result
+
+        _preprocessor_class = _ProfilingPreprocessor
+    return _preprocessor_class(**kwargs)
+
+
+def first_line(source):
+    """Return the first non-empty line of the cell `source`."""
+    for line in source.splitlines():
+        if line.strip():
+            return line.strip()
+    return ''
+
+
+def cell_profiles(nb, inserted_pos=None):
+    """Return the list of profiles of the code cells of the notebook `nb`.
+
+    Arguments:
+        nb (NotebookNode): executed notebook (before inserting other cells).
+        inserted_pos (int or None): index of the cell inserted in the
+            template notebook (the arguments), if any. Used to compute
+            the index of each cell in the template.
+    """
+    profiles = []
+    for index, cell in enumerate(nb['cells']):
+        profile = cell.get('metadata', {}).get('profile')
+        if cell['cell_type'] != 'code' or profile is None:
+            continue
+        inserted = index == inserted_pos
+        template_index = index
+        if inserted:
+            template_index = None
+        elif inserted_pos is not None and index > inserted_pos:
+            template_index -= 1
+        source = cell['source']
+        profiles.append(dict(
+            index=template_index, inserted=inserted,
+            first_line=first_line(source),
+            source_hash=hashlib.sha1(source.encode()).hexdigest()[:12],
+            **profile))
+    return profiles
+
+
+def profile_path(out_path_ipynb):
+    """Return the sidecar file of the profile of notebook `out_path_ipynb`.
+    """
+    out_path_ipynb = Path(out_path_ipynb)
+    return Path(out_path_ipynb.parent, out_path_ipynb.stem + profile_suffix)
+
+
+def write_profile(nb, notebook_path, out_path_ipynb, start_time, duration,
+                  inserted_pos=None, error=False):
+    """Save the profile of the cells of `nb` in the sidecar JSON file.
+
+    Returns the path of the sidecar file.
+    """
+    path = profile_path(out_path_ipynb)
+    profile = dict(notebook=Path(notebook_path).name,
+                   notebook_path=str(notebook_path),
+                   output=str(out_path_ipynb), start=start_time,
+                   duration=duration, error=error,
+                   cells=cell_profiles(nb, inserted_pos))
+    with open(str(path), 'w') as f:
+        json.dump(profile, f, indent=1)
+    return path
+
+
+def find_profiles(paths):
+    """Return the sidecar profile files in `paths` (files or folders)."""
+    found = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            found.extend(sorted(path.glob('**/*' + profile_suffix)))
+        elif path.is_file():
+            found.append(path)
+    return found
+
+
+def aggregate(profile_files, notebook=None):
+    """Aggregate the cell profiles of `profile_files`.
+
+    Cells are grouped by notebook name, index in the template and first
+    line (so that a cell edited in the template is a new group).
+    Returns a list of dicts, one per cell, with the total, mean and max
+    of the measures over the runs, sorted by total wall time.
+
+    Arguments:
+        notebook (string or None): if not None, aggregate only the
+            profiles of the notebook with this name.
+    """
+    groups = {}
+    for path in profile_files:
+        try:
+            with open(str(path)) as f:
+                profile = json.load(f)
+        except (OSError, ValueError) as e:
+            print('Skipping "%s": %s' % (path, e), flush=True)
+            continue
+        if notebook is not None and profile['notebook'] != notebook:
+            continue
+        for cell in profile['cells']:
+            # The arguments cell differs for each file
+            first = ('(notebook arguments)' if cell['inserted']
+                     else cell['first_line'])
+            key = (profile['notebook'], cell['index'], first)
+            group = groups.setdefault(key, dict(
+                notebook=key[0], index=key[1], first_line=key[2],
+                inserted=cell['inserted'], runs=0, wall=0., cpu=0.,
+                max_wall=0., peak_rss=0, files=set()))
+            group['runs'] += 1
+            group['wall'] += cell['wall']
+            group['cpu'] += cell['cpu'] or 0
+            group['max_wall'] = max(group['max_wall'], cell['wall'])
+            group['peak_rss'] = max(group['peak_rss'],
+                                    cell['peak_rss'] or 0)
+            group['files'].add(profile['output'])
+    cells = list(groups.values())
+    for cell in cells:
+        cell['files'] = len(cell['files'])
+        cell['mean_wall'] = cell['wall'] / cell['runs']
+    return sorted(cells, key=lambda c: c['wall'], reverse=True)
+
+
+def format_ranking(cells, top=20, sort='wall'):
+    """Return the table (string) of the `top` cells sorted by `sort`."""
+    total = sum(c['wall'] for c in cells) or 1
+    cells = sorted(cells, key=lambda c: c[sort], reverse=True)[:top]
+    lines = ['%4s %-28s %4s %5s %9s %6s %8s %8s %8s %8s  %s' % (
+        'rank', 'notebook', 'cell', 'runs', 'wall (s)', '%', 'mean (s)',
+        'max (s)', 'CPU (s)', 'RSS (MB)', 'first line')]
+    for rank, c in enumerate(cells, 1):
+        index = 'arg' if c['inserted'] else c['index']
+        lines.append('%4d %-28s %4s %5d %9.1f %6.1f %8.2f %8.2f %8.1f %8.0f'
+                     '  %s' % (rank, c['notebook'][:28], index, c['runs'],
+                               c['wall'], 100 * c['wall'] / total,
+                               c['mean_wall'], c['max_wall'], c['cpu'],
+                               c['peak_rss'] / 1024**2, c['first_line'][:60]))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        Aggregate the per-cell profiles of the notebooks executed with
+        --profile-cells (files "*%s") and print the ranking of the cells
+        taking the most time.
+        """ % profile_suffix
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('paths', nargs='+',
+                        help='Profile files or folders (searched '
+                             'recursively).')
+    parser.add_argument('--top', metavar='N', type=int, default=20,
+                        help='Number of cells printed. Default 20.')
+    parser.add_argument('--sort', default='wall', choices=sort_keys,
+                        help='Ranking criterion. Default: total wall time.')
+    parser.add_argument('--notebook', metavar='NB_NAME', default=None,
+                        help='Aggregate only the profiles of this notebook.')
+    args = parser.parse_args()
+
+    files = find_profiles(args.paths)
+    cells = aggregate(files, notebook=args.notebook)
+    print('%d profiles, %d cells, %.1f s total.\n' %
+          (len(files), len(cells), sum(c['wall'] for c in cells)))
+    if cells:
+        print(format_ranking(cells, top=args.top, sort=args.sort))
@@ -0,0 +1,584 @@
+#!/usr/bin/env python
+"""
+cluster - Run the batch jobs on worker processes of other machines.
+
+A `ClusterPool` has the same interface of `multiprocessing.Pool` used by
+the batch scripts (`apply_async`, `close`, `join`, `terminate`), but it is
+a coordinator listening on a TCP port: jobs are queued and sent to the
+worker processes which connect to it, on any machine (or on localhost for
+testing). Start a worker with:
+
+    ./cluster.py HOST:PORT --slots 4
+
+Each worker registers reporting its CPU and memory capacity, then pulls a
+job when it has a free slot and enough free memory, runs it in a local
+`concurrent.futures.ProcessPoolExecutor` and sends back the result and the
+captured output (log) of the job. If a process of the worker dies (e.g.
+killed by the OOM killer), its job (and the other jobs running on the
+worker) are reported as failed and the processes are restarted. The
+coordinator prints the log when the job completes. The worker runs a
+`reclaim.Reclaimer` removing the temp files of its jobs in background
+(see `worker_reclaim_queue()`), as the reclaimer of the coordinator is
+not reachable from other machines.
+A job whose worker dies (or stops sending heartbeats), or which raises an
+exception, is put back in the queue and sent to another worker, up to
+`max_attempts` times.
+
+Connections are authenticated with a shared key (HMAC, see
+`multiprocessing.connection`) read from `default_authkey_path`, which
+is created by the coordinator on first use and must be copied to the
+worker machines. Jobs and results are pickled, so workers need the same
+version of this repository and the data folders mounted at the same paths.
+"""
+
+import io
+import os
+import sys
+import time
+import socket
+import threading
+import traceback
+import collections
+from pathlib import Path
+from multiprocessing import Pool
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.connection import Listener, Client
+
+import reclaim
+
+
+default_port = 6047
+default_authkey_path = Path('~', '.transfer_convert',
+                            'cluster.key').expanduser()
+heartbeat_interval = 10       # seconds between worker heartbeats
+heartbeat_timeout = 120       # a silent worker is considered dead
+max_attempts = 3              # executions of a job before giving up
+min_free_memory = 2 * 1024**3  # workers do not pull jobs with less memory
+
+
+def parse_address(address):
+    """Return a (host, port) tuple from a 'HOST:PORT' string."""
+    host, _, port = address.rpartition(':')
+    return host or '', int(port) if port else default_port
+
+
+def load_authkey(path=default_authkey_path, create=False):
+    """Return the shared key. If `create`, create a random key if missing.
+    """
+    path = Path(path)
+    if not path.is_file():
+        if not create:
+            raise FileNotFoundError('Cluster key "%s" not found. Copy it from '
+                                    'the coordinator machine.' % path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32).hex().encode())
+    return path.read_bytes().strip()
+
+
+def memory_info():
+    """Return total and available memory in bytes (Linux only)."""
+    info = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                info[name] = int(value.split()[0]) * 1024
+    except OSError:
+        return None, None
+    return info.get('MemTotal'), info.get('MemAvailable')
+
+
+def capacity(slots):
+    """Return a dict describing the resources of this machine."""
+    mem_total, mem_available = memory_info()
+    return dict(host=socket.gethostname(), pid=os.getpid(),
+                cpus=os.cpu_count(), slots=slots, mem_total=mem_total,
+                mem_available=mem_available, load=os.getloadavg()[0])
+
+
+class RemoteError(Exception):
+    """Exception raised by a job on a worker (message is the traceback)."""
+
+
+class ClusterResult:
+    """Result of `ClusterPool.apply_async` (like `Pool.apply_async`)."""
+
+    def __init__(self, callback=None, error_callback=None):
+        self._event = threading.Event()
+        self._callback = callback
+        self._error_callback = error_callback
+        self._value = None
+        self._error = None
+
+    def _set(self, value=None, error=None):
+        self._value, self._error = value, error
+        self._event.set()
+        try:
+            if error is None and self._callback is not None:
+                self._callback(value)
+            elif error is not None and self._error_callback is not None:
+                self._error_callback(error)
+        except Exception:
+            traceback.print_exc()
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        return self.ready() and self._error is None
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class _Job:
+    def __init__(self, job_id, func, args, kwds, result):
+        self.id = job_id
+        self.func = func
+        self.args = args
+        self.kwds = kwds
+        self.result = result
+        self.attempts = 0
+        self.failed_on = set()   # workers where the job failed
+        self.worker = None
+
+
+class _Worker:
+    def __init__(self, worker_id, info):
+        self.id = worker_id
+        self.info = info
+        self.jobs = {}
+        self.last_seen = time.time()
+        self.stopped = False
+
+    @property
+    def name(self):
+        return '%s:%d' % (self.info['host'], self.info['pid'])
+
+
+class ClusterPool:
+    """Pool-like coordinator sending jobs to workers connected over TCP.
+
+    Arguments:
+        address (tuple): (host, port) where the coordinator listens.
+        initializer (callable or None): called by each worker process
+            before running jobs (must be picklable, e.g. a function or a
+            `functools.partial` of a function, with no local queues).
+        authkey (bytes or None): shared key. If None, use `load_authkey()`.
+        max_attempts (int): executions of a job before reporting failure.
+        verbose (bool): if True, print workers events and job logs.
+    """
+
+    def __init__(self, address=('', default_port), initializer=None,
+                 authkey=None, max_attempts=max_attempts, verbose=True):
+        if authkey is None:
+            authkey = load_authkey(create=True)
+        self.address = address
+        self.initializer = initializer
+        self.max_attempts = max_attempts
+        self.verbose = verbose
+        self._listener = Listener(address, authkey=authkey)
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._workers = {}
+        self._num_jobs = 0
+        self._num_workers = 0
+        self._num_done = 0
+        self._closed = False
+        self._stopped = False
+        self._done = threading.Condition(self._lock)
+        threading.Thread(target=self._accept, name='cluster-accept',
+                         daemon=True).start()
+        self._log('Coordinator listening on %s:%d' % self._listener.address)
+
+    def _log(self, msg):
+        if self.verbose:
+            print('[cluster] %s' % msg, flush=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.terminate()
+
+    def apply_async(self, func, args=(), kwds=None, callback=None,
+                    error_callback=None):
+        """Queue `func(*args, **kwds)`. Returns a `ClusterResult`."""
+        result = ClusterResult(callback, error_callback)
+        with self._lock:
+            assert not self._closed, 'Pool is closed.'
+            self._num_jobs += 1
+            self._pending.append(_Job(self._num_jobs, func, tuple(args),
+                                      kwds or {}, result))
+        return result
+
+    def close(self):
+        """No more jobs will be submitted."""
+        with self._lock:
+            self._closed = True
+
+    def join(self):
+        """Wait until all the submitted jobs are completed."""
+        with self._done:
+            self._done.wait_for(lambda: self._num_done == self._num_jobs)
+            # Let the idle workers receive the 'stop' message
+            self._done.wait_for(lambda: not self._workers,
+                                timeout=heartbeat_interval)
+        self._shutdown()
+
+    def terminate(self):
+        self._shutdown()
+        with self._done:
+            self._done.wait_for(lambda: not self._workers, timeout=2)
+
+    def _shutdown(self):
+        with self._lock:
+            self._closed = True
+            self._stopped = True
+        try:
+            self._listener.close()
+        except OSError:
+            pass
+
+    def status(self):
+        """Return a list of dicts describing the connected workers."""
+        with self._lock:
+            return [dict(w.info, name=w.name, jobs=len(w.jobs))
+                    for w in self._workers.values()]
+
+    def _accept(self):
+        while not self._stopped:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                if self._stopped:
+                    break
+                time.sleep(1)   # failed authentication or transient error
+                continue
+            threading.Thread(target=self._serve, args=(conn,),
+                             name='cluster-worker', daemon=True).start()
+
+    def _next_job(self, worker):
+        """Pop the first pending job not failed on `worker` (or None)."""
+        others = set(self._workers) - {worker.id}
+        for job in self._pending:
+            # Retry elsewhere, unless no other worker is available
+            if worker.id not in job.failed_on or others <= job.failed_on:
+                self._pending.remove(job)
+                job.attempts += 1
+                job.worker = worker.id
+                worker.jobs[job.id] = job
+                return job
+        return None
+
+    def _finish(self, job, value=None, error=None):
+        job.result._set(value, error)
+        with self._done:
+            self._num_done += 1
+            self._done.notify_all()
+
+    def _failed(self, worker, job, error):
+        """Put `job` back in the queue or report the failure."""
+        with self._lock:
+            worker.jobs.pop(job.id, None)
+            job.failed_on.add(worker.id)
+            retry = job.attempts < self.max_attempts and not self._stopped
+            if retry:
+                self._pending.appendleft(job)
+        if retry:
+            self._log('Job %d failed on %s (attempt %d), retrying: %s' %
+                      (job.id, worker.name, job.attempts,
+                       error.splitlines()[-1] if error else ''))
+        else:
+            self._finish(job, error=RemoteError(error))
+
+    def _serve(self, conn):
+        worker = None
+        try:
+            kind, info = conn.recv()
+            if kind != 'register':
+                return
+            with self._lock:
+                self._num_workers += 1
+                worker = _Worker(self._num_workers, info)
+                self._workers[worker.id] = worker
+            conn.send(('init', self.initializer))
+            self._log('Worker %s registered: %d slots, %d CPUs, %.1f GB RAM' %
+                      (worker.name, info['slots'], info['cpus'],
+                       (info['mem_total'] or 0) / 1024**3))
+            while True:
+                if not conn.poll(heartbeat_timeout):
+                    self._log('Worker %s timed out.' % worker.name)
+                    break
+                kind, payload = conn.recv()
+                worker.last_seen = time.time()
+                if kind == 'result':
+                    self._result(worker, *payload)
+                    conn.send(('ok', None))
+                    continue
+                worker.info.update(payload)
+                if kind == 'heartbeat':
+                    conn.send(('stop' if self._stopped else 'ok', None))
+                    if self._stopped:
+                        worker.stopped = True
+                        break
+                    continue
+                # kind == 'get'
+                with self._lock:
+                    job = None if self._stopped else self._next_job(worker)
+                    stop = self._stopped or (self._closed and
+                                             not self._pending and
+                                             not worker.jobs)
+                if job is not None:
+                    conn.send(('job', (job.id, job.func, job.args, job.kwds)))
+                elif stop:
+                    conn.send(('stop', None))
+                    worker.stopped = True
+                    break
+                else:
+                    conn.send(('wait', None))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            if worker is not None:
+                self._lost(worker)
+
+    def _result(self, worker, job_id, value, error, log):
+        with self._lock:
+            job = worker.jobs.get(job_id)
+        if job is None:
+            return
+        if log and self.verbose:
+            sys.stdout.write(''.join('[%s] %s\n' % (worker.info['host'], line)
+                                     for line in log.splitlines()))
+            sys.stdout.flush()
+        if error is None:
+            with self._lock:
+                worker.jobs.pop(job_id, None)
+            self._finish(job, value=value)
+        else:
+            self._failed(worker, job, error)
+
+    def _lost(self, worker):
+        with self._done:
+            self._workers.pop(worker.id, None)
+            jobs = list(worker.jobs.values())
+            self._done.notify_all()
+        for job in jobs:
+            self._failed(worker, job, 'Worker %s lost.' % worker.name)
+        if not worker.stopped:
+            self._log('Worker %s disconnected.' % worker.name)
+
+
+class _Tee(io.TextIOBase):
+    """Write to a stream and keep a copy of the text in `log`."""
+
+    def __init__(self, stream, log):
+        self.stream = stream
+        self.log = log
+
+    def write(self, text):
+        self.log.write(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+_process_initialized = False
+_reclaim_queue = None   # queue of the reclaimer of `run_worker`
+
+
+def worker_reclaim_queue():
+    """Return the queue of the `reclaim.Reclaimer` of this worker.
+
+    The queue is inherited by the processes running the jobs of
+    `run_worker`. Returns None in other processes.
+    """
+    return _reclaim_queue
+
+
+def _run_job(func, args, kwds, initializer=None):
+    """Run a job in a worker process. Returns value, error and log.
+
+    `initializer` is called before the first job of the process.
+    """
+    global _process_initialized
+    if not _process_initialized:
+        if initializer is not None:
+            initializer()
+        _process_initialized = True
+    stdout, stderr = sys.stdout, sys.stderr
+    log = io.StringIO()
+    sys.stdout, sys.stderr = _Tee(stdout, log), _Tee(stderr, log)
+    value, error = None, None
+    try:
+        value = func(*args, **kwds)
+    except Exception:
+        error = traceback.format_exc()
+        sys.stderr.write(error)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return value, error, log.getvalue()
+
+
+def run_worker(address, slots=None, authkey=None, min_free=min_free_memory,
+               removal_grace=reclaim.default_grace):
+    """Connect to the coordinator at `address` and run jobs until stopped.
+
+    Arguments:
+        address (tuple): (host, port) of the coordinator.
+        slots (int or None): number of jobs executed in parallel. If None,
+            use the number of CPUs.
+        authkey (bytes or None): shared key. If None, use `load_authkey()`.
+        min_free (int): do not start a new job if the available memory
+            (bytes) is below this value.
+        removal_grace (float): seconds before the temp files of the jobs
+            are removed, when the removal can be canceled (see `reclaim`).
+    """
+    global _reclaim_queue
+    if slots is None:
+        slots = os.cpu_count()
+    if authkey is None:
+        authkey = load_authkey()
+    conn = Client(address, authkey=authkey)
+    conn.send(('register', capacity(slots)))
+    _, initializer = conn.recv()
+    print('Connected to %s:%d (%d slots).' % (address + (slots,)), flush=True)
+    running = {}
+    last_message = time.time()
+    reclaimer = reclaim.Reclaimer(grace=removal_grace)
+    reclaimer.start()
+    # Created before the processes of the executor, which inherit it
+    _reclaim_queue = reclaimer.queue
+    executor = ProcessPoolExecutor(max_workers=slots)
+    completed = False
+    try:
+        while True:
+            broken = False
+            for job_id, res in list(running.items()):
+                if res.done():
+                    try:
+                        value, error, log = res.result()
+                    except BrokenProcessPool:
+                        # A process died: all the running jobs are lost
+                        broken = True
+                        value, error, log = None, (
+                            'A process of worker %s died while running the '
+                            'job.' % socket.gethostname()), ''
+                    except Exception:
+                        value, error, log = None, traceback.format_exc(), ''
+                    conn.send(('result', (job_id, value, error, log)))
+                    conn.recv()
+                    del running[job_id]
+            if broken:
+                print('A worker process died, restarting the processes.',
+                      flush=True)
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=slots)
+            _, mem_available = memory_info()
+            stats = dict(load=os.getloadavg()[0], mem_available=mem_available,
+                         running=len(running))
+            if len(running) < slots and (mem_available is None or
+                                         mem_available > min_free):
+                conn.send(('get', stats))
+                kind, payload = conn.recv()
+                last_message = time.time()
+                if kind == 'job':
+                    job_id, func, args, kwds = payload
+                    try:
+                        res = executor.submit(_run_job, func, args, kwds,
+                                              initializer)
+                    except BrokenProcessPool:
+                        # Broken after the last check of the running jobs
+                        res = concurrent.futures.Future()
+                        res.set_exception(BrokenProcessPool())
+                    running[job_id] = res
+                    continue
+                elif kind == 'stop':
+                    break
+            elif time.time() - last_message > heartbeat_interval:
+                conn.send(('heartbeat', stats))
+                kind, _ = conn.recv()
+                last_message = time.time()
+                if kind == 'stop':
+                    break
+            time.sleep(1)
+        completed = True
+    finally:
+        executor.shutdown(wait=False)
+        # Pending removals are canceled on errors (e.g. Ctrl-C)
+        if completed:
+            reclaimer.close()
+        else:
+            reclaimer.stop()
+    conn.close()
+
+
+def get_pool(nproc, initializer=None, cluster=None, remote_initializer=None):
+    """Return a `multiprocessing.Pool` or, if `cluster` is not None, a
+    `ClusterPool` listening on `cluster` ('HOST:PORT' string).
+
+    `remote_initializer` is used by the remote workers (default
+    `initializer`): it must not reference local objects such as queues.
+    """
+    if cluster is None:
+        return Pool(processes=nproc, initializer=initializer)
+    if remote_initializer is None:
+        remote_initializer = initializer
+    return ClusterPool(parse_address(cluster), initializer=remote_initializer)
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        Start a worker executing the jobs of a batch script started with
+        the --cluster option (coordinator). The shared key "%s" must be
+        copied from the coordinator machine.
+        """ % default_authkey_path
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('address', help='Address of the coordinator '
+                                        '(HOST:PORT).')
+    parser.add_argument('--slots', '-n', metavar='N', type=int, default=None,
+                        help='Jobs executed in parallel. Default: number of '
+                             'CPUs.')
+    parser.add_argument('--min-free-memory', metavar='GB', type=float,
+                        default=min_free_memory / 1024**3,
+                        help='Do not start jobs when the available memory is '
+                             'below GB. Default %(default)g.')
+    parser.add_argument('--removal-grace', metavar='SECONDS', type=float,
+                        default=reclaim.default_grace,
+                        help='Seconds before the temp files of the jobs are '
+                             'removed (create "<name>.keep" to cancel). '
+                             'Default %(default)g.')
+    parser.add_argument('--forever', action='store_true',
+                        help='Reconnect (or wait for the coordinator) after '
+                             'the coordinator stops.')
+    args = parser.parse_args()
+
+    address = parse_address(args.address)
+    min_free = int(args.min_free_memory * 1024**3)
+    while True:
+        try:
+            run_worker(address, slots=args.slots, min_free=min_free,
+                       removal_grace=args.removal_grace)
+        except (ConnectionError, EOFError) as e:
+            if not args.forever:
+                sys.exit('Connection to the coordinator failed: %s' % e)
+        except KeyboardInterrupt:
+            sys.exit('\nWorker terminated.\n')
+        if not args.forever:
+            break
+        time.sleep(10)
@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+"""
+conversion - Convert DAT and SM files to Photon-HDF5 without notebooks.
+
+The functions in this module perform the same steps of the conversion
+notebooks (inplace, tempfile and singlespot), without plots and without
+serializing the outputs. Each function returns the output file name and
+a dict of conversion stats.
+
+`write_record()` saves the stats in a JSON file (the conversion record),
+which can be used later to create a provenance notebook with
+`make_provenance_notebook()`.
+"""
+
+import os
+import json
+import pprint
+import time
+import platform
+from pathlib import Path
+
+import numpy as np
+import tables
+import yaml
+import phconvert as phc
+# niconverter is imported only by the 48-spot conversion functions
+
+import validate
+
+
+# Identity data used when the metadata does not contain identity info
+default_identity_48spot = dict(
+    author='Antonino Ingargiola',
+    author_affiliation='UCLA',
+    creator='Antonino Ingargiola',
+    creator_affiliation='UCLA')
+
+default_identity_singlespot = dict(
+    author='Maya Segal',
+    author_affiliation='UCLA',
+    creator='Antonino Ingargiola',
+    creator_affiliation='UCLA')
+
+# Used when the us-ALEX metadata does not contain the field setup
+default_setup_singlespot = dict(
+    num_pixels=2,
+    num_spots=1,
+    num_spectral_ch=2,
+    num_polarization_ch=1,
+    num_split_ch=1,
+    modulated_excitation=True,
+    lifetime=False,
+    excitation_cw=[True, True],
+    excitation_alternated=[True, True],
+    excitation_wavelengths=[532e-9, 635e-9],
+    detection_wavelengths=[580e-9, 660e-9])
+
+# Used when the us-ALEX metadata does not contain the field measurement_specs
+default_measurement_specs_singlespot = dict(
+    measurement_type='smFRET-usALEX',
+    alex_period=4000,
+    alex_offset=700,
+    alex_excitation_period1=(2180, 3900),
+    alex_excitation_period2=(200, 1800),
+    detectors_specs=dict(spectral_ch1=[0],
+                         spectral_ch2=[1]))
+
+sm_timestamps_unit = 12.5e-9
+
+# Parameters of the streaming SM conversion
+sm_chunk_records = 2**20        # records decoded at once (12 MB)
+sm_header_max_size = 2**16      # bytes read to decode the header
+sm_trailer_size = 26            # 'End Of Run' and fields after the records
+sm_record_dtype = np.dtype([('timestamp', '>i8'), ('detector', '>u4')])
+sm_filter = dict(complevel=6, complib='zlib')   # as save_photon_hdf5
+
+# Parameters of the tempfile conversion
+tempfile_chunksize = 262144
+tempfile_raw_filter = dict(complevel=1, complib='blosc')
+tempfile_filter = dict(complevel=6, complib='zlib')
+
+
+def load_metadata(filename):
+    """Load the YAML metadata file associated to the data file `filename`."""
+    meta_filename = Path(filename).with_suffix('.yml')
+    assert meta_filename.is_file(), 'Metadata YAML file not found.'
+    with open(str(meta_filename)) as f:
+        return yaml.safe_load(f)
+
+
+def get_versions():
+    """Return a dict with the versions of the conversion software."""
+    versions = dict(python=platform.python_version(),
+                    numpy=np.__version__, tables=tables.__version__,
+                    phconvert=phc.__version__)
+    try:
+        import niconverter as nic
+        versions['niconverter'] = nic.__version__
+    except ImportError:
+        pass
+    return versions
+
+
+def _save_48spot(source_filename, out_path, metadata, stats, t_start):
+    """Common final steps of the 48-spot conversions."""
+    import niconverter as nic
+    results = validate.validate_file(out_path)
+    stats['neg_jumps'] = [r['neg_jumps'] for r in results]
+    stats['timings']['check'] = time.time() - t_start
+    if not validate.is_valid(results):
+        raise ValueError('Timestamps not monotonic (negative jumps per '
+                         'array: %s)' % stats['neg_jumps'])
+
+    h5file = tables.open_file(str(out_path), mode='a')
+    dt, endianess, meta = nic.detectformat(source_filename)
+    ts_unit = 1 / meta['clock_frequency']
+    t2, aem2 = nic.get_photon_data_arr(h5file, spots=np.arange(48))
+    meta['acquisition_duration'] = nic.duration(t2, ts_unit)
+
+    if 'identity' not in metadata:
+        metadata['identity'] = default_identity_48spot
+    metadata, measurement_specs = nic.populate_metadata_smFRET_48spots(
+        metadata, source_filename, h5file=h5file,
+        acq_duration=meta['acquisition_duration'])
+    data = nic.fill_photon_data_tables(metadata.copy(), h5file, ts_unit,
+                                       measurement_specs=measurement_specs)
+    phc.hdf5.save_photon_hdf5(data, h5file=h5file, overwrite=True,
+                              close=True)
+    stats['timings']['save'] = time.time() - t_start
+    stats.update(acquisition_duration=meta['acquisition_duration'],
+                 num_timestamps=int(meta['num_timestamps']),
+                 clock_frequency=meta['clock_frequency'])
+    return stats
+
+
+def _init_stats(mode, source_filename, out_path):
+    return dict(mode=mode, source=str(source_filename), output=str(out_path),
+                source_size=Path(source_filename).stat().st_size,
+                timings={}, versions=get_versions(),
+                start_time=time.ctime())
+
+
+def _finish_stats(stats, t_start):
+    stats['duration'] = time.time() - t_start
+    stats['output_size'] = Path(stats['output']).stat().st_size
+    stats['mbps'] = stats['source_size'] / 1024**2 / stats['duration']
+    return stats
+
+
+def convert_inplace(source_filename, out_path=None):
+    """Convert a 48-spot DAT file to Photon-HDF5 with no temporary file.
+
+    Arguments:
+        source_filename (Path): DAT file. The YAML metadata file must be in
+            the same folder.
+        out_path (Path or None): output file. If None, use the DAT file name
+            with suffix '_inplace.hdf5'.
+
+    Returns:
+        Output file name and a dict of conversion stats.
+    """
+    import niconverter as nic
+    source_filename = Path(source_filename)
+    assert source_filename.is_file(), 'File not found: %s' % source_filename
+    if out_path is None:
+        out_path = Path(source_filename.parent,
+                        source_filename.stem + '_inplace.hdf5')
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    metadata = load_metadata(source_filename)
+    stats = _init_stats('inplace', source_filename, out_path)
+
+    t_start = time.time()
+    nic.ni96ch_process_spots(source_filename, out_path=out_path, close=True)
+    stats['timings']['preprocess'] = time.time() - t_start
+    _save_48spot(source_filename, out_path, metadata, stats, t_start)
+    return out_path, _finish_stats(stats, t_start)
+
+
+def convert_tempfile(source_filename, out_path=None, out_path_raw=None,
+                     chunksize=None, raw_filter=None, comp_filter=None):
+    """Convert a 48-spot DAT file to Photon-HDF5 using a raw temporary file.
+
+    Arguments:
+        source_filename (Path): DAT file. The YAML metadata file must be in
+            the same folder.
+        out_path (Path or None): output file. If None, use the DAT file name
+            with suffix '_tf.hdf5'.
+        out_path_raw (Path or None): temporary file. If None, use the DAT
+            file name with suffix '_raw_temp.hdf5'.
+        chunksize (int or None): chunk size for reading the DAT file.
+            If None, use `tempfile_chunksize`.
+        raw_filter, comp_filter (dict or None): arguments of
+            `tables.Filters` for the temporary and the output file.
+            If None, use `tempfile_raw_filter` and `tempfile_filter`.
+
+    Returns:
+        Output file name and a dict of conversion stats.
+    """
+    import niconverter as nic
+    source_filename = Path(source_filename)
+    assert source_filename.is_file(), 'File not found: %s' % source_filename
+    if out_path is None:
+        out_path = Path(source_filename.parent,
+                        source_filename.stem + '_tf.hdf5')
+    if out_path_raw is None:
+        out_path_raw = Path(source_filename.parent,
+                            source_filename.stem + '_raw_temp.hdf5')
+    if chunksize is None:
+        chunksize = tempfile_chunksize
+    if raw_filter is None:
+        raw_filter = tempfile_raw_filter
+    if comp_filter is None:
+        comp_filter = tempfile_filter
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    metadata = load_metadata(source_filename)
+    stats = _init_stats('tempfile', source_filename, out_path)
+    stats.update(chunksize=chunksize, raw_filter=raw_filter,
+                 comp_filter=comp_filter)
+
+    t_start = time.time()
+    nic.ni96ch_process(source_filename, close=True, out_path=out_path_raw,
+                       chunksize=chunksize,
+                       comp_filter=tables.Filters(**raw_filter))
+    stats['timings']['preprocess'] = time.time() - t_start
+
+    nch = 96
+    with tables.open_file(str(out_path_raw), mode='r') as h5file_raw:
+        timestamps_m = [h5file_raw.get_node('/timestamps%d' % ch)
+                        for ch in range(nch)]
+        with tables.open_file(str(out_path), mode='w') as h5file:
+            nic.save_timestamps_detectors_48ch(
+                timestamps_m, h5file, comp_filter=tables.Filters(**comp_filter))
+    stats['timings']['merge'] = time.time() - t_start
+    _save_48spot(source_filename, out_path, metadata, stats, t_start)
+    return out_path, _finish_stats(stats, t_start)
+
+
+def update_with_defaults(input_dict, default_dict):
+    for k in default_dict:
+        if k not in input_dict:
+            input_dict[k] = default_dict[k]
+    return input_dict
+
+
+def sm_load_photon_data(filename, metadata, def_measurement_specs):
+    """Load photon_data from a .sm us-ALEX file into a metadata dict.
+    """
+    metadata = metadata.copy()
+    timestamps, detectors, labels = phc.smreader.load_sm(str(filename),
+                                                         return_labels=True)
+    measurement_specs = metadata.pop('measurement_specs',
+                                     def_measurement_specs)
+    update_with_defaults(measurement_specs, def_measurement_specs)
+
+    photon_data = dict(
+        timestamps=timestamps,
+        timestamps_specs=dict(timestamps_unit=sm_timestamps_unit),
+        detectors=detectors,
+        measurement_specs=measurement_specs)
+
+    acquisition_duration = (timestamps[-1] - timestamps[0]) * sm_timestamps_unit
+
+    provenance = dict(
+        filename=str(filename),
+        software='LabVIEW Data Acquisition usALEX')
+
+    metadata.update(
+        _filename=str(filename),
+        acquisition_duration=round(acquisition_duration),
+        photon_data=photon_data,
+        provenance=provenance)
+    return metadata
+
+
+def sm_open(filename):
+    """Decode the header of the SM file `filename`.
+
+    Returns the header size (bytes), the number of records and the list
+    of the channel labels.
+    """
+    filename = str(filename)
+    with open(filename, 'rb') as f:
+        header = f.read(sm_header_max_size)
+    header_size, labels = phc.smreader.decode_header(header)
+    num_records = ((os.path.getsize(filename) - header_size -
+                    sm_trailer_size) // sm_record_dtype.itemsize)
+    if num_records <= 0:
+        raise ValueError('No photon records in SM file "%s".' % filename)
+    return header_size, num_records, labels
+
+
+def sm_map_records(filename, header_size, start, count):
+    """Memory-map `count` records of the SM file from record `start`.
+
+    Returns a read-only array of records (fields 'timestamp' and
+    'detector', big endian). The file is unmapped when the array is
+    deleted.
+    """
+    return np.memmap(str(filename), dtype=sm_record_dtype, mode='r',
+                     offset=header_size + start * sm_record_dtype.itemsize,
+                     shape=(count,))
+
+
+def sm_stream_photon_data(filename, h5file, metadata, def_measurement_specs,
+                          chunk_records=sm_chunk_records):
+    """Stream photon_data from a .sm us-ALEX file into `h5file`.
+
+    Like `sm_load_photon_data`, but the records are memory-mapped and
+    decoded `chunk_records` at a time (one map per chunk, so that mapped
+    pages do not accumulate) and appended to the extendable arrays
+    `/photon_data/timestamps` and `/photon_data/detectors` of `h5file`.
+    The memory used does not depend on the file size. The acquisition
+    duration is computed from the first and last records, and the
+    detectors counts (`/setup/detectors`) while decoding.
+
+    Returns the metadata dict, with the PyTables arrays as photon_data
+    (to be completed with `phc.hdf5.save_photon_hdf5(data, h5file=h5file)`),
+    and a dict with the number of records and of negative timestamp jumps.
+    """
+    metadata = metadata.copy()
+    header_size, num_records, labels = sm_open(filename)
+    filters = tables.Filters(**sm_filter)
+    group = h5file.create_group('/', 'photon_data')
+    timestamps = h5file.create_earray(group, 'timestamps', tables.Int64Atom(),
+                                      shape=(0,), filters=filters,
+                                      expectedrows=num_records)
+    detectors = h5file.create_earray(group, 'detectors', tables.UInt32Atom(),
+                                     shape=(0,), filters=filters,
+                                     expectedrows=num_records)
+    counts = {}
+    neg_jumps = 0
+    last = None
+    for start in range(0, num_records, chunk_records):
+        chunk = sm_map_records(filename, header_size, start,
+                               min(chunk_records, num_records - start))
+        chunk_timestamps = chunk['timestamp'].astype('int64')
+        chunk_detectors = chunk['detector'].astype('uint32')
+        del chunk
+        timestamps.append(chunk_timestamps)
+        detectors.append(chunk_detectors)
+        for det, count in zip(*np.unique(chunk_detectors,
+                                         return_counts=True)):
+            counts[int(det)] = counts.get(int(det), 0) + int(count)
+        neg_jumps += int((np.diff(chunk_timestamps) < 0).sum())
+        if last is not None and chunk_timestamps[0] < last:
+            neg_jumps += 1
+        last = chunk_timestamps[-1]
+    first = sm_map_records(filename, header_size, 0, 1)['timestamp'][0]
+    last = sm_map_records(filename, header_size, num_records - 1,
+                          1)['timestamp'][0]
+    acquisition_duration = (int(last) - int(first)) * sm_timestamps_unit
+
+    measurement_specs = metadata.pop('measurement_specs',
+                                     def_measurement_specs)
+    update_with_defaults(measurement_specs, def_measurement_specs)
+    photon_data = dict(
+        timestamps=timestamps,
+        timestamps_specs=dict(timestamps_unit=sm_timestamps_unit),
+        detectors=detectors,
+        measurement_specs=measurement_specs)
+    ids = np.array(sorted(counts), dtype='uint32')
+    setup = dict(metadata.get('setup', {}))
+    setup['detectors'] = dict(id=ids, id_hardware=ids,
+                              counts=np.array([counts[i] for i in ids]))
+    provenance = dict(
+        filename=str(filename),
+        software='LabVIEW Data Acquisition usALEX')
+
+    metadata.update(
+        _filename=str(filename),
+        acquisition_duration=round(acquisition_duration),
+        photon_data=photon_data,
+        setup=setup,
+        provenance=provenance)
+    return metadata, dict(num_records=num_records, neg_jumps=neg_jumps)
+
+
+def fill_with_defaults(metadata, default_setup, default_identity):
+    """Fill all missing values in metadata with defaults."""
+    setup = metadata.get('setup', default_setup)
+    metadata['setup'] = update_with_defaults(setup, default_setup)
+
+    identity = metadata.get('identity', default_identity)
+    metadata['identity'] = update_with_defaults(identity, default_identity)
+
+    sample = metadata['sample']
+    sample['num_dyes'] = len(sample['dye_names'].split(','))
+
+
+def convert_singlespot(input_filename, output_path=None, streaming=True,
+                       chunk_records=None):
+    """Convert a us-ALEX SM file to Photon-HDF5.
+
+    Arguments:
+        input_filename (Path): SM file. The YAML metadata file must be in
+            the same folder.
+        output_path (Path or None): output folder. If None, save the
+            Photon-HDF5 file in the same folder as the SM file.
+        streaming (bool): if True, decode the SM file in chunks writing
+            them directly to the output file (see `sm_stream_photon_data`),
+            with constant memory use. The detectors counts are computed
+            while decoding and the phconvert validation, which would read
+            the whole arrays, is skipped. If False, load the whole file in
+            memory as the conversion notebook.
+        chunk_records (int or None): records decoded at once when
+            `streaming`. If None, use `sm_chunk_records`.
+
+    Returns:
+        Output file name and a dict of conversion stats.
+    """
+    input_filename = Path(input_filename)
+    assert input_filename.is_file(), 'Input SM file not found: %s' % input_filename
+    if output_path is None:
+        output_path = input_filename.parent
+    out_filename = Path(output_path, input_filename.stem + '.hdf5')
+    metadata = load_metadata(input_filename)
+    stats = _init_stats('singlespot', input_filename, out_filename)
+
+    stats['streaming'] = streaming
+
+    t_start = time.time()
+    if streaming:
+        if chunk_records is None:
+            chunk_records = sm_chunk_records
+        h5file = tables.open_file(str(out_filename), mode='w',
+                                  filters=tables.Filters(**sm_filter))
+        try:
+            data, sm_stats = sm_stream_photon_data(
+                input_filename, h5file, metadata,
+                default_measurement_specs_singlespot,
+                chunk_records=chunk_records)
+            fill_with_defaults(data, default_setup_singlespot,
+                               default_identity_singlespot)
+            stats['timings']['load'] = time.time() - t_start
+            phc.hdf5.save_photon_hdf5(data, h5file=h5file, overwrite=True,
+                                      close=True, validate=False)
+        finally:
+            if h5file.isopen:
+                h5file.close()
+        stats.update(chunk_records=chunk_records,
+                     neg_jumps=sm_stats['neg_jumps'])
+        num_timestamps = sm_stats['num_records']
+    else:
+        data = sm_load_photon_data(input_filename, metadata,
+                                   default_measurement_specs_singlespot)
+        fill_with_defaults(data, default_setup_singlespot,
+                           default_identity_singlespot)
+        stats['timings']['load'] = time.time() - t_start
+        phc.hdf5.save_photon_hdf5(data, h5_fname=str(out_filename),
+                                  overwrite=True, close=True)
+        num_timestamps = int(data['photon_data']['timestamps'].size)
+    stats['timings']['save'] = time.time() - t_start
+    stats.update(acquisition_duration=data['acquisition_duration'],
+                 num_timestamps=num_timestamps)
+    return out_filename, _finish_stats(stats, t_start)
+
+
+def convert_file(filename, mode='inplace', **kwargs):
+    """Convert `filename` with `mode` ('inplace', 'tempfile' or 'singlespot').
+    """
+    func = dict(inplace=convert_inplace, tempfile=convert_tempfile,
+                singlespot=convert_singlespot)[mode]
+    return func(filename, **kwargs)
+
+
+def write_record(stats, record_path):
+    """Save the conversion `stats` as a JSON conversion record."""
+    with open(str(record_path), 'w') as f:
+        json.dump(stats, f, indent=2, sort_keys=True, default=str)
+    return record_path
+
+
+provenance_code = """\
+import phconvert as phc
+import matplotlib.pyplot as plt
+%matplotlib inline
+
+data = phc.hdf5.load_photon_hdf5({output!r})
+phc.plotter.alternation_hist(data{ich})
+plt.grid()
+"""
+
+
+def record_output(record, record_path):
+    """Return the Photon-HDF5 file of the conversion `record`.
+
+    The `output` of the conversion (in the ramdisk) is removed after
+    archival: use `archived_output` if in the record, else a file with the
+    same name next to `record_path` or in its parent folder (the archive
+    layout of `transfer`), else `output`.
+    """
+    output = Path(record['output'])
+    candidates = [record.get('archived_output'),
+                  Path(record_path.parent, output.name),
+                  Path(record_path.parent.parent, output.name)]
+    for path in candidates:
+        if path is not None and Path(path).is_file():
+            return str(path)
+    return record.get('archived_output') or str(output)
+
+
+def make_provenance_notebook(record_path, out_path=None, execute=False):
+    """Create a notebook describing a conversion from its JSON record.
+
+    The notebook contains the conversion stats and a cell plotting the
+    alternation histogram of the output file. It is executed (with nbrun)
+    only if `execute` is True.
+    """
+    import nbformat
+    record_path = Path(record_path)
+    with open(str(record_path)) as f:
+        record = json.load(f)
+    if out_path is None:
+        out_path = record_path.with_suffix('.ipynb')
+    output = record_output(record, record_path)
+    text = ('# Conversion to Photon-HDF5\n\n'
+            '**Source:** %s\n\n**Output:** %s\n\n**Mode:** %s\n\n'
+            '**Executed:** %s\n\n**Duration:** %.1f seconds.' %
+            (record['source'], output, record['mode'],
+             record['start_time'], record['duration']))
+    ich = '' if record['mode'] == 'singlespot' else ', ich=18'
+    nb = nbformat.v4.new_notebook()
+    nb['cells'] = [
+        nbformat.v4.new_markdown_cell(text),
+        nbformat.v4.new_code_cell('record = %s' % pprint.pformat(record)),
+        nbformat.v4.new_code_cell(provenance_code.format(
+            output=output, ich=ich))]
+    nbformat.write(nb, str(out_path))
+    if execute:
+        from nbrun import run_notebook
+        run_notebook(out_path, out_path_ipynb=out_path, display_links=False)
+    return out_path
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        Convert a DAT or SM file to Photon-HDF5 without executing a notebook,
+        or create the provenance notebook from a conversion record.
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('datafile',
+                        help='Data file to convert, or conversion record '
+                             '(.json) with --provenance.')
+    parser.add_argument('--mode', default='inplace',
+                        choices=('inplace', 'tempfile', 'singlespot'),
+                        help="Conversion mode. Default 'inplace'.")
+    parser.add_argument('--no-streaming', action='store_true',
+                        help='With --mode singlespot, load the whole SM file '
+                             'in memory (as the conversion notebook) instead '
+                             'of converting it in chunks.')
+    parser.add_argument('--provenance', action='store_true',
+                        help='Create the provenance notebook from a '
+                             'conversion record.')
+    parser.add_argument('--execute', action='store_true',
+                        help='Execute the provenance notebook.')
+    args = parser.parse_args()
+
+    datafile = Path(args.datafile)
+    assert datafile.is_file(), 'File not found: %s' % datafile
+    if args.provenance:
+        nb_path = make_provenance_notebook(datafile, execute=args.execute)
+        print('Provenance notebook: %s' % nb_path)
+    else:
+        kwargs = {}
+        if args.mode == 'singlespot':
+            kwargs['streaming'] = not args.no_streaming
+        out_path, stats = convert_file(datafile, mode=args.mode, **kwargs)
+        record = write_record(stats, Path(out_path.parent,
+                                          out_path.stem + '_conversion.json'))
+        print('Converted %s in %.1f s. Record: %s' %
+              (out_path, stats['duration'], record))
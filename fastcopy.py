@@ -0,0 +1,194 @@
+"""
+fastcopy - In-process file copy with throughput and integrity information.
+
+`copy_file()` copies a file choosing the fastest available method:
+
+- 'copy_file_range' or 'sendfile': zero-copy in kernel space (used when no
+  checksum is requested and the OS/file systems support it).
+- 'chunked': large-buffer reads and writes, computing the checksum in the
+  same pass (used with a checksum or as a fallback, e.g. over CIFS).
+- 'parallel': consecutive chunks are copied concurrently by several
+  threads (used for very large files when `nthreads > 1`). The chunks are
+  hashed in order as they complete, so the checksum is computed in the
+  same pass and is the same as with the other methods.
+
+All the methods return a `CopyStats` tuple with bytes, seconds and MB/s.
+
+With an `observer`, the data is also passed, chunk by chunk and in order,
+to a callable (e.g. a `preview.DatPreview` computing statistics while the
+file is copied). This forces the 'chunked' method.
+"""
+
+import os
+import time
+import errno
+import shutil
+import hashlib
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+default_chunk_size = 8 * 1024**2          # 8 MB buffer
+default_parallel_min_size = 2 * 1024**3   # split files larger than 2 GB
+
+CopyStats = namedtuple('CopyStats', ['source', 'dest', 'bytes', 'seconds',
+                                     'mbps', 'checksum', 'method'])
+
+# errno values for which zero-copy syscalls fall back to the next method
+_fallback_errnos = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+                    errno.ENOTSUP, errno.EOPNOTSUPP}
+
+
+def _write_all(fd, data):
+    while len(data) > 0:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+def _copy_chunked(fd_in, fd_out, hasher, chunk_size, observer=None):
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(fd_in, 'rb', buffering=0, closefd=False) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            if hasher is not None:
+                hasher.update(view[:n])
+            _write_all(fd_out, view[:n])
+            if observer is not None:
+                observer(view[:n])
+
+
+def _copy_kernel(fd_in, fd_out, size, chunk_size):
+    """Zero-copy using copy_file_range or sendfile. Returns the method."""
+    methods = []
+    if hasattr(os, 'copy_file_range'):
+        methods.append(('copy_file_range', os.copy_file_range))
+    if hasattr(os, 'sendfile'):
+        methods.append(('sendfile',
+                        lambda fdi, fdo, count: os.sendfile(fdo, fdi, None,
+                                                            count)))
+    for name, func in methods:
+        copied = 0
+        try:
+            while copied < size:
+                n = func(fd_in, fd_out, min(chunk_size, size - copied))
+                if n == 0:
+                    break
+                copied += n
+            return name
+        except OSError as e:
+            if copied > 0 or e.errno not in _fallback_errnos:
+                raise
+    _copy_chunked(fd_in, fd_out, None, chunk_size)
+    return 'chunked'
+
+
+def _copy_chunk(fd_in, fd_out, offset, length, name):
+    """Copy `length` bytes at `offset` and return them."""
+    data = b''
+    while len(data) < length:
+        block = os.pread(fd_in, length - len(data), offset + len(data))
+        if not block:
+            raise OSError('Unexpected end of file: %s' % name)
+        data += block
+    written = 0
+    while written < len(data):
+        written += os.pwrite(fd_out, data[written:], offset + written)
+    return data
+
+
+def _copy_parallel(source, dest, size, checksum, chunk_size, nthreads):
+    hasher = hashlib.new(checksum) if checksum is not None else None
+    # Threads copy consecutive chunks, which are hashed in order as they
+    # complete: at most `window` chunks are in memory.
+    window = 2 * nthreads
+    pending = deque()
+
+    def next_chunk():
+        data = pending.popleft().result()
+        if hasher is not None:
+            hasher.update(data)
+
+    fd_in = os.open(source, os.O_RDONLY)
+    try:
+        fd_out = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd_out, size)
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                for offset in range(0, size, chunk_size):
+                    if len(pending) >= window:
+                        next_chunk()
+                    pending.append(executor.submit(
+                        _copy_chunk, fd_in, fd_out, offset,
+                        min(chunk_size, size - offset), source))
+                while pending:
+                    next_chunk()
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+    return hasher.hexdigest() if hasher is not None else None
+
+
+def copy_file(source, dest, checksum='md5', chunk_size=default_chunk_size,
+              nthreads=1, parallel_min_size=default_parallel_min_size,
+              preserve=True, observer=None):
+    """Copy file `source` to `dest` and return a `CopyStats` tuple.
+
+    Arguments:
+        source (Path or string): file to be copied.
+        dest (Path or string): destination file or folder.
+        checksum (string or None): name of the hashlib algorithm used to
+            compute the checksum of the copied data. If None, no checksum
+            is computed and zero-copy syscalls are used when possible.
+        chunk_size (int): size (bytes) of the read/write buffer.
+        nthreads (int): number of threads used to copy files larger than
+            `parallel_min_size`.
+        parallel_min_size (int): minimum file size (bytes) for a parallel
+            copy.
+        preserve (bool): if True, copy permissions and modification time
+            (like `cp -a`).
+        observer (callable or None): called with each chunk of data
+            (a memoryview valid only during the call), in order.
+
+    Raises OSError if the copy fails or the size of the copy differs
+    from the size of the source.
+    """
+    source, dest = str(source), str(dest)
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(source))
+    size = os.stat(source).st_size
+    t_start = time.perf_counter()
+    if nthreads > 1 and size >= parallel_min_size and observer is None:
+        method = 'parallel'
+        digest = _copy_parallel(source, dest, size, checksum, chunk_size,
+                                nthreads)
+    else:
+        hasher = hashlib.new(checksum) if checksum is not None else None
+        fd_in = os.open(source, os.O_RDONLY)
+        try:
+            fd_out = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0o644)
+            try:
+                if hasher is None and observer is None:
+                    method = _copy_kernel(fd_in, fd_out, size, chunk_size)
+                else:
+                    method = 'chunked'
+                    _copy_chunked(fd_in, fd_out, hasher, chunk_size,
+                                  observer)
+            finally:
+                os.close(fd_out)
+        finally:
+            os.close(fd_in)
+        digest = hasher.hexdigest() if hasher is not None else None
+    seconds = time.perf_counter() - t_start
+    if preserve:
+        shutil.copystat(source, dest)
+    dest_size = os.stat(dest).st_size
+    if dest_size != size:
+        raise OSError('Incomplete copy of %s: %d of %d bytes.' %
+                      (source, dest_size, size))
+    mbps = size / 1024**2 / seconds if seconds > 0 else float('inf')
+    return CopyStats(source, dest, size, seconds, mbps, digest, method)
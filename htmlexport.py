@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+htmlexport - Render executed notebooks to HTML in background processes.
+
+Rendering HTML with nbconvert takes several seconds for notebooks with
+many plots. With an `ExportService`, the workers executing notebooks only
+put the (notebook, HTML) file names in a queue and move to the next
+file, while a small pool of low-priority processes renders the HTML.
+
+Notebooks whose HTML file is newer than the notebook are skipped, so that
+the HTML of a whole folder can be (re)rendered on demand by running this
+module as a script.
+"""
+
+import os
+import time
+import multiprocessing as mp
+from pathlib import Path
+
+import nbslim
+
+
+default_html_folder = 'reports_html'
+default_niceness = 10
+
+EXPORT_QUEUE = None     # queue of the ExportService used by this process
+
+
+def init_worker(export_queue=None):
+    """Set the queue where this process sends the notebooks to render."""
+    global EXPORT_QUEUE
+    EXPORT_QUEUE = export_queue
+
+
+def export_queue():
+    """Return the queue set by `init_worker()` (None if not set)."""
+    return EXPORT_QUEUE
+
+
+def html_path(ipynb_path, html_folder=None):
+    """Return the default HTML file name for notebook `ipynb_path`.
+
+    If `html_folder` is None, use the folder `default_html_folder` in the
+    same folder as the notebook.
+    """
+    ipynb_path = Path(ipynb_path)
+    if html_folder is None:
+        html_folder = Path(ipynb_path.parent, default_html_folder)
+    return Path(html_folder, ipynb_path.stem + '.html')
+
+
+def is_up_to_date(ipynb_path, html_path):
+    """Return True if `html_path` exists and is newer than `ipynb_path`."""
+    html_path = Path(html_path)
+    if not html_path.is_file():
+        return False
+    ipynb_mtime = Path(ipynb_path).stat().st_mtime_ns
+    return html_path.stat().st_mtime_ns >= ipynb_mtime
+
+
+def export_html(ipynb_path, html_path, force=False):
+    """Render notebook `ipynb_path` to `html_path`.
+
+    Returns False if the HTML is up to date (and `force` is False),
+    True otherwise. The HTML file is written atomically.
+    """
+    if not force and is_up_to_date(ipynb_path, html_path):
+        return False
+    import nbformat
+    from nbconvert import HTMLExporter
+    html_path = Path(html_path)
+    html_path.parent.mkdir(parents=True, exist_ok=True)
+    nb = nbformat.read(str(ipynb_path), as_version=4)
+    nbslim.inline_images(nb, ipynb_path)
+    body, _ = HTMLExporter().from_notebook_node(nb)
+    tmp_path = html_path.with_name('.' + html_path.name + '.tmp')
+    with open(str(tmp_path), 'w') as f:
+        f.write(body)
+    os.replace(str(tmp_path), str(html_path))
+    return True
+
+
+def _export_worker(queue, niceness, force):
+    try:
+        os.nice(niceness)
+    except OSError:
+        pass
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        ipynb_path, out_path = item
+        t_start = time.time()
+        try:
+            if export_html(ipynb_path, out_path, force=force):
+                print('  [HTML] %s (%.1f s)' % (Path(out_path).name,
+                                                time.time() - t_start),
+                      flush=True)
+        except Exception as e:
+            print('Error exporting "%s" to HTML: %s' % (ipynb_path, e),
+                  flush=True)
+
+
+class ExportService:
+    """Pool of low-priority processes rendering notebooks to HTML.
+
+    Arguments:
+        nworkers (int): number of processes.
+        niceness (int): increment of the nice value of the processes.
+        force (bool): if True, render the HTML even if up to date.
+
+    Pass `queue` to the processes executing the notebooks (e.g. through
+    `init_worker()` in a Pool initializer) and call `submit()` or put
+    (notebook, HTML) file names in the queue.
+    """
+
+    def __init__(self, nworkers=1, niceness=default_niceness, force=False):
+        self.queue = mp.Queue()
+        self.workers = [mp.Process(target=_export_worker,
+                                   args=(self.queue, niceness, force),
+                                   name='html-export-%d' % i, daemon=True)
+                        for i in range(nworkers)]
+
+    def start(self):
+        for w in self.workers:
+            w.start()
+        return self
+
+    def submit(self, ipynb_path, html_path):
+        self.queue.put((str(ipynb_path), str(html_path)))
+
+    def close(self, timeout=None):
+        """Wait until the queued notebooks are rendered and stop."""
+        for _ in self.workers:
+            self.queue.put(None)
+        for w in self.workers:
+            w.join(timeout)
+
+    def terminate(self):
+        for w in self.workers:
+            w.terminate()
+
+
+def find_notebooks(paths, html_folder=None, force=False):
+    """Return (notebook, HTML) pairs to be rendered from files or folders.
+    """
+    pairs = []
+    for path in paths:
+        path = Path(path)
+        notebooks = sorted(path.glob('*.ipynb')) if path.is_dir() else [path]
+        for nb_path in notebooks:
+            out_path = html_path(nb_path, html_folder)
+            if force or not is_up_to_date(nb_path, out_path):
+                pairs.append((nb_path, out_path))
+    return pairs
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        Render executed notebooks to HTML, skipping the notebooks whose HTML
+        is up to date. HTML files are saved in the folder '%s' next to each
+        notebook (or in the folder passed with --html-folder).
+        """ % default_html_folder
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('paths', nargs='+',
+                        help='Notebooks or folders containing notebooks.')
+    parser.add_argument('--html-folder', metavar='PATH', default=None,
+                        help='Folder where HTML files are saved.')
+    parser.add_argument('--num-processes', '-n', metavar='N', type=int,
+                        default=2, help='Number of processes. Default 2.')
+    parser.add_argument('--force', action='store_true',
+                        help='Render also the up-to-date notebooks.')
+    args = parser.parse_args()
+
+    pairs = find_notebooks(args.paths, html_folder=args.html_folder,
+                           force=args.force)
+    print('Rendering %d notebooks to HTML.' % len(pairs), flush=True)
+    service = ExportService(args.num_processes, niceness=0,
+                            force=args.force).start()
+    for nb_path, out_path in pairs:
+        service.submit(nb_path, out_path)
+    try:
+        service.close()
+    except KeyboardInterrupt:
+        service.terminate()
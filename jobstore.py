@@ -0,0 +1,203 @@
+"""
+jobstore - Persistent state of the files processed in monitor mode.
+
+Jobs are stored in a SQLite database (WAL mode), one row per data file,
+so that queued and in-flight jobs survive a restart or a crash of the
+monitor. Several monitor processes (and their workers) can share the same
+database: a job is assigned to a monitor by an atomic "claim", and each
+monitor claims only the files of the folder it monitors.
+
+Job states:
+
+- 'discovered': the file is ready to be processed.
+- 'copying', 'converting', 'archived', 'analyzed': processing steps,
+  updated by the workers.
+- 'done': processing completed.
+- 'failed': processing failed (see the `error` column).
+
+Jobs in a processing state whose owner is dead (a process on this host
+which is not running anymore, or with no heartbeat for `stale_timeout`
+seconds) are put back in the 'discovered' state by `recover()`.
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import threading
+from pathlib import Path
+
+
+default_job_store_path = Path('~', '.transfer_convert',
+                              'jobs.sqlite').expanduser()
+
+pending_state = 'discovered'
+processing_states = ('copying', 'converting', 'archived', 'analyzed')
+final_states = ('done', 'failed')
+all_states = (pending_state,) + processing_states + final_states
+
+schema = """\
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    fname TEXT UNIQUE NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    heartbeat REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created);
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner);
+"""
+
+
+def owner_id():
+    """Return the identifier of the current process ('host:pid')."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def _owner_alive(owner):
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname():
+        return None     # unknown
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass
+    return True
+
+
+class JobStore:
+    """Job states stored in a SQLite database.
+
+    Arguments:
+        path (Path): database file. It is created if not existing.
+        owner (string or None): identifier of the monitor claiming jobs.
+            If None, use `owner_id()`.
+    """
+
+    def __init__(self, path=default_job_store_path, owner=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.owner = owner_id() if owner is None else owner
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.path), timeout=60,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(schema)
+
+    def close(self):
+        self.conn.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params)
+
+    def add(self, fname):
+        """Add `fname` as 'discovered'. Returns False if already present."""
+        now = time.time()
+        cur = self._execute(
+            'INSERT OR IGNORE INTO jobs (fname, state, created, updated) '
+            'VALUES (?, ?, ?, ?)', (str(fname), pending_state, now, now))
+        return cur.rowcount > 0
+
+    def has_jobs(self, folder):
+        """Return True if the store has jobs of files in `folder`."""
+        prefix = os.path.join(str(folder), '')
+        row = self._execute('SELECT 1 FROM jobs WHERE substr(fname, 1, ?) = ? '
+                            'LIMIT 1', (len(prefix), prefix)).fetchone()
+        return row is not None
+
+    def claim(self, limit=1, folder=None):
+        """Assign up to `limit` discovered jobs to this owner.
+
+        If `folder` is not None, claim only jobs of files in `folder`, so
+        that monitors of different folders (and with different processing
+        options) sharing the database do not process each other's files.
+
+        Returns the list of file names (Path) of the claimed jobs.
+        """
+        if limit <= 0:
+            return []
+        prefix = '' if folder is None else os.path.join(str(folder), '')
+        now = time.time()
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.conn.execute(
+                    'SELECT id, fname FROM jobs WHERE state = ? '
+                    'AND substr(fname, 1, ?) = ? ORDER BY created LIMIT ?',
+                    (pending_state, len(prefix), prefix, limit)).fetchall()
+                self.conn.executemany(
+                    'UPDATE jobs SET state = ?, owner = ?, updated = ?, '
+                    'heartbeat = ?, attempts = attempts + 1, error = NULL '
+                    'WHERE id = ?',
+                    [('copying', self.owner, now, now, row[0])
+                     for row in rows])
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return [Path(row[1]) for row in rows]
+
+    def set_state(self, fname, state, error=None):
+        """Set the state of job `fname` (and the error message if any)."""
+        assert state in all_states, 'Invalid state: %s' % state
+        self._execute('UPDATE jobs SET state = ?, error = COALESCE(?, error), '
+                      'updated = ? '
+                      'WHERE fname = ?', (state, error, time.time(),
+                                          str(fname)))
+
+    def get_state(self, fname):
+        """Return the state of job `fname` or None if not present."""
+        row = self._execute('SELECT state FROM jobs WHERE fname = ?',
+                            (str(fname),)).fetchone()
+        return None if row is None else row[0]
+
+    def heartbeat(self):
+        """Mark the jobs being processed by this owner as alive."""
+        self._execute('UPDATE jobs SET heartbeat = ? WHERE owner = ? AND '
+                      'state IN (%s)' % ','.join('?' * len(processing_states)),
+                      (time.time(), self.owner) + processing_states)
+
+    def recover(self, stale_timeout=3600):
+        """Put back in the queue the jobs being processed by dead owners.
+
+        Returns the number of recovered jobs.
+        """
+        now = time.time()
+        rows = self._execute(
+            'SELECT id, owner, heartbeat FROM jobs WHERE state IN (%s)' %
+            ','.join('?' * len(processing_states)),
+            processing_states).fetchall()
+        stale = []
+        for job_id, owner, heartbeat in rows:
+            alive = _owner_alive(owner) if owner else False
+            if alive is None:
+                alive = heartbeat is not None and now - heartbeat < stale_timeout
+            if not alive:
+                stale.append(job_id)
+        with self._lock:
+            self.conn.executemany(
+                'UPDATE jobs SET state = ?, owner = NULL, updated = ? '
+                'WHERE id = ?', [(pending_state, now, i) for i in stale])
+        return len(stale)
+
+    def retry_failed(self):
+        """Put the failed jobs back in the queue. Returns their number."""
+        cur = self._execute('UPDATE jobs SET state = ?, owner = NULL, '
+                            'updated = ? WHERE state = ?',
+                            (pending_state, time.time(), 'failed'))
+        return cur.rowcount
+
+    def counts(self):
+        """Return a dict with the number of jobs in each state."""
+        rows = self._execute('SELECT state, COUNT(*) FROM jobs '
+                             'GROUP BY state').fetchall()
+        return dict(rows)
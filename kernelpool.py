@@ -0,0 +1,311 @@
+"""
+kernelpool - Long-lived, pre-warmed Jupyter kernels for notebook execution.
+
+Starting a kernel and importing the scientific stack (numpy, tables,
+phconvert, fretbursts, ...) takes a large share of the time needed to
+process a short measurement. A `KernelPool` keeps kernels alive between
+notebook executions: each borrowed kernel has its namespace reset before
+running the next notebook, and it is replaced after a number of runs,
+when its memory grows too large or when it dies.
+
+USAGE
+-----
+
+With multiprocessing, pass `init_worker_pool` as Pool `initializer` so that
+each worker process owns one warm kernel. Functions running in the worker
+retrieve it with `worker_pool()` and pass it to `nbrun.run_notebook()`.
+"""
+
+import inspect
+import os
+import queue
+import warnings
+from contextlib import contextmanager
+from functools import partial
+
+
+# Modules imported in each new kernel before it is handed out.
+# Missing modules are silently skipped.
+default_warmup_modules = ('numpy', 'tables', 'yaml', 'phconvert',
+                          'niconverter', 'pandas', 'matplotlib.pyplot',
+                          'seaborn', 'fretbursts')
+
+warmup_template = """\
+import importlib
+for _name in {modules!r}:
+    try:
+        importlib.import_module(_name)
+    except Exception:
+        pass
+del importlib, _name
+"""
+
+reset_template = """\
+import sys as _sys
+if 'matplotlib.pyplot' in _sys.modules:
+    _sys.modules['matplotlib.pyplot'].close('all')
+del _sys
+get_ipython().run_line_magic('reset', '-f')
+import os as _os
+_os.chdir({path!r})
+del _os
+"""
+
+_worker_pool = None
+
+
+def process_rss(pid):
+    """Return the resident memory (bytes) of process `pid` (Linux only).
+
+    Returns None if the information is not available.
+    """
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def execution_mode():
+    """Return how the installed nbconvert can run a notebook in a pooled kernel.
+
+    Returns 'km' if `ExecutePreprocessor.preprocess()` accepts an existing
+    kernel manager (`km=`, nbconvert 5.4+) and leaves it running, 'drive'
+    if the kernel must be driven by `preprocess_in_kernel()` (older
+    nbconvert, e.g. the 5.1.1 of conda_environment_linux.yml) and None if
+    neither is possible (each notebook then runs in a new kernel).
+    """
+    from nbconvert.preprocessors import ExecutePreprocessor
+    params = inspect.signature(ExecutePreprocessor.preprocess).parameters
+    if 'km' in params:
+        return 'km'
+    if hasattr(ExecutePreprocessor, 'run_cell'):
+        return 'drive'
+    return None
+
+
+def preprocess_in_kernel(ep, nb, resources, km):
+    """Execute `nb` with the `ExecutePreprocessor` `ep` in the kernel of `km`.
+
+    The kernel is left running. With an nbconvert not supporting
+    `preprocess(..., km=km)`, the client of `ep` is connected to `km` here
+    and the cells are executed one by one by `ep.preprocess_cell()`.
+    With an nbconvert not supporting either, `km` is not used and the
+    notebook runs in a new kernel (plain `ep.preprocess()`).
+    """
+    mode = execution_mode()
+    if mode == 'km':
+        return ep.preprocess(nb, resources, km=km)
+    if mode is None:
+        warnings.warn('This nbconvert version cannot execute notebooks in '
+                      'a pooled kernel: using a new kernel.')
+        return ep.preprocess(nb, resources)
+    from nbconvert.preprocessors import Preprocessor
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=getattr(ep, 'startup_timeout', 60))
+        kc.allow_stdin = False
+        ep.km, ep.kc, ep.nb = km, kc, nb
+        ep._display_id_map = {}
+        return Preprocessor.preprocess(ep, nb, resources)
+    finally:
+        kc.stop_channels()
+        for attr in ('nb', 'kc', 'km'):
+            if hasattr(ep, attr):
+                delattr(ep, attr)
+
+
+class PooledKernel:
+    """A running kernel with its usage counters."""
+
+    def __init__(self, km):
+        self.km = km
+        self.runs = 0
+
+    @property
+    def pid(self):
+        kernel = getattr(self.km, 'kernel', None)
+        return getattr(kernel, 'pid', None)
+
+    def rss(self):
+        pid = self.pid
+        return None if pid is None else process_rss(pid)
+
+    def is_alive(self):
+        return self.km.is_alive()
+
+    def execute(self, code, timeout=60):
+        """Execute `code` in the kernel discarding the output.
+
+        Raises RuntimeError if the execution fails.
+        """
+        kc = self.km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=timeout)
+            reply = kc.execute_interactive(code, timeout=timeout,
+                                           output_hook=lambda msg: None)
+        finally:
+            kc.stop_channels()
+        content = reply['content']
+        if content['status'] != 'ok':
+            raise RuntimeError('Error executing code in kernel: %s: %s' %
+                               (content.get('ename'), content.get('evalue')))
+
+    def shutdown(self):
+        try:
+            self.km.shutdown_kernel(now=True)
+        except Exception:
+            pass
+
+
+class KernelPool:
+    """A pool of long-lived, pre-warmed Jupyter kernels.
+
+    Arguments:
+        size (int): number of kernels in the pool.
+        kernel_name (string or None): name of the kernel. Use the default
+            kernel if None.
+        max_runs (int or None): a kernel is replaced after executing
+            this number of notebooks. No limit if None.
+        max_rss (int or None): a kernel is replaced when, after a notebook
+            execution, its resident memory exceeds this value (bytes).
+            No limit if None.
+        warmup_modules (sequence of strings): modules imported in each
+            new kernel before use.
+        startup_timeout (int): max time (seconds) to wait for a new kernel
+            to be ready.
+    """
+
+    def __init__(self, size=1, kernel_name=None, max_runs=50,
+                 max_rss=4 * 1024**3, warmup_modules=default_warmup_modules,
+                 startup_timeout=120):
+        self.size = size
+        self.kernel_name = kernel_name
+        self.max_runs = max_runs
+        self.max_rss = max_rss
+        self.warmup_modules = tuple(warmup_modules)
+        self.startup_timeout = startup_timeout
+        self.started = 0
+        self._idle = queue.Queue()
+        self._kernels = []
+        for _ in range(size):
+            self._idle.put(self._start_kernel())
+
+    def _start_kernel(self):
+        from jupyter_client.manager import KernelManager
+        kwargs = {}
+        if self.kernel_name is not None:
+            kwargs['kernel_name'] = self.kernel_name
+        km = KernelManager(**kwargs)
+        km.start_kernel()
+        kernel = PooledKernel(km)
+        if self.warmup_modules:
+            kernel.execute(warmup_template.format(modules=self.warmup_modules),
+                           timeout=self.startup_timeout)
+        self._kernels.append(kernel)
+        self.started += 1
+        return kernel
+
+    def _replace(self, kernel):
+        kernel.shutdown()
+        if kernel in self._kernels:
+            self._kernels.remove(kernel)
+        return self._start_kernel()
+
+    def _needs_recycle(self, kernel):
+        if not kernel.is_alive():
+            return True
+        if self.max_runs is not None and kernel.runs >= self.max_runs:
+            return True
+        if self.max_rss is not None:
+            rss = kernel.rss()
+            if rss is not None and rss > self.max_rss:
+                return True
+        return False
+
+    @contextmanager
+    def kernel(self, working_dir='./'):
+        """Borrow a kernel with a clean namespace, running in `working_dir`.
+
+        Yields the `KernelManager` of the borrowed kernel, to be passed
+        to `preprocess_in_kernel()`.
+        """
+        kernel = self._idle.get()
+        try:
+            if not kernel.is_alive():
+                kernel = self._replace(kernel)
+            path = os.path.abspath(str(working_dir))
+            kernel.execute(reset_template.format(path=path))
+            yield kernel.km
+        finally:
+            kernel.runs += 1
+            try:
+                if self._needs_recycle(kernel):
+                    kernel = self._replace(kernel)
+            finally:
+                self._idle.put(kernel)
+
+    def shutdown(self):
+        """Shutdown all the kernels in the pool."""
+        for kernel in self._kernels:
+            kernel.shutdown()
+        self._kernels = []
+
+
+def init_worker_pool(**kwargs):
+    """Create the kernel pool of the current worker process.
+
+    To be used as `initializer` of a `multiprocessing.Pool`. Keyword
+    arguments are passed to `KernelPool`.
+    """
+    global _worker_pool
+    from multiprocessing.util import Finalize
+    _worker_pool = KernelPool(**kwargs)
+    Finalize(_worker_pool, _worker_pool.shutdown, exitpriority=10)
+
+
+def worker_pool():
+    """Return the kernel pool of the current process or None."""
+    return _worker_pool
+
+
+@contextmanager
+def temporary_pool(**kwargs):
+    """Share a kernel between the notebooks executed in the body.
+
+    If the current process has no kernel pool (see `init_worker_pool`),
+    create one with a single kernel, used by `worker_pool()` in the body
+    and shut down at the end. Keyword arguments are passed to
+    `KernelPool`. Yields the pool.
+    """
+    global _worker_pool
+    if _worker_pool is not None:
+        yield _worker_pool
+        return
+    pool = KernelPool(**kwargs)
+    _worker_pool = pool
+    try:
+        yield pool
+    finally:
+        _worker_pool = None
+        pool.shutdown()
+
+
+def worker_initializer(warm_kernels=False, kernel_max_runs=50):
+    """Return the Pool initializer creating a warm kernel in each worker.
+
+    Returns None (no initializer) if `warm_kernels` is False or if the
+    installed nbconvert cannot run notebooks in a pooled kernel.
+    """
+    if not warm_kernels:
+        return None
+    if execution_mode() is None:
+        warnings.warn('--warm-kernels is not supported by this nbconvert '
+                      'version: ignored.')
+        return None
+    return partial(init_worker_pool, max_runs=kernel_max_runs)
@@ -0,0 +1,181 @@
+"""
+manifest - Record the inputs of each output to skip work already done.
+
+For each output (identified by a key, e.g. the data file name), the manifest
+stores a fingerprint of the inputs used to create it: data and metadata
+files (size and mtime, or content hash), the notebook (content hash) and
+the versions of the relevant packages, and the paths of the output files.
+Batch runs skip the outputs whose fingerprint is unchanged and whose output
+files still exist.
+
+The manifest is a JSON file, written atomically. It is meant to be updated
+by a single process (the main process of a batch run).
+"""
+
+import os
+import json
+import time
+import hashlib
+from pathlib import Path
+
+
+default_manifest_path = Path('~', '.transfer_convert',
+                             'manifest.json').expanduser()
+
+convert_packages = ('phconvert', 'niconverter')
+analysis_packages = ('fretbursts', 'phconvert')
+
+
+def file_hash(path, algorithm='sha1', chunk_size=8 * 1024**2):
+    """Return the hex digest of the content of file `path`."""
+    hasher = hashlib.new(algorithm)
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def package_version(name):
+    """Return the installed version of package `name` (None if missing).
+
+    The package is not imported.
+    """
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        import pkg_resources
+        try:
+            return pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            return None
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
+
+
+def file_signature(path, hash_content=False):
+    """Return a string identifying the content of file `path`.
+
+    If `hash_content` is False, use size and mtime (fast on network
+    file systems), otherwise hash the content.
+    """
+    path = Path(path)
+    if not path.is_file():
+        return None
+    if hash_content:
+        return 'sha1:' + file_hash(path)
+    st = path.stat()
+    return 'stat:%d:%d' % (st.st_size, st.st_mtime_ns)
+
+
+def get_inputs(datafiles=(), notebooks=(), packages=(), hash_content=False,
+               extra=None):
+    """Return a dict describing the inputs of an output.
+
+    Arguments:
+        datafiles (sequence of Path): data files. Files with extension
+            .yml are always hashed (they are small), the others only
+            if `hash_content` is True.
+        notebooks (sequence of Path): notebooks (or python modules) used to
+            create the output. Always hashed.
+        packages (sequence of strings): packages whose version is recorded.
+        extra (dict or None): additional items (e.g. conversion mode).
+    """
+    inputs = {}
+    for path in datafiles:
+        path = Path(path)
+        hashed = hash_content or path.suffix == '.yml'
+        inputs['file:' + path.name] = file_signature(path, hashed)
+    for path in notebooks:
+        inputs['notebook:' + Path(path).name] = file_signature(path, True)
+    for name in packages:
+        inputs['version:' + name] = package_version(name)
+    if extra is not None:
+        inputs.update(('extra:' + k, v) for k, v in extra.items())
+    return inputs
+
+
+def fingerprint(inputs):
+    """Return the fingerprint (hex digest) of the `inputs` dict."""
+    text = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class Manifest:
+    """A JSON file mapping each output key to the fingerprint of its inputs.
+
+    Arguments:
+        path (Path): manifest file. It is created if not existing.
+    """
+
+    def __init__(self, path=default_manifest_path):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.is_file():
+            with open(str(self.path)) as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(str(tmp_path), 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(str(tmp_path), str(self.path))
+
+    def changes(self, key, inputs):
+        """Return the list of inputs changed since `key` was recorded.
+
+        Returns ['new'] if `key` was never recorded, ['missing output']
+        if a recorded output file does not exist and an empty list if the
+        recorded fingerprint matches `inputs`.
+        """
+        entry = self.entries.get(str(key))
+        if entry is None:
+            return ['new']
+        if not all(Path(p).exists() for p in entry.get('outputs', ())):
+            return ['missing output']
+        if entry['fingerprint'] == fingerprint(inputs):
+            return []
+        old = entry['inputs']
+        return sorted(k for k in set(old) | set(inputs)
+                      if old.get(k) != inputs.get(k))
+
+    def is_done(self, key, inputs):
+        """Return True if `key` was recorded with the same `inputs`."""
+        return len(self.changes(key, inputs)) == 0
+
+    def record(self, key, inputs, outputs=(), save=True):
+        """Record that the output `key` was created from `inputs`.
+
+        `outputs` are the paths of the output files, which must exist for
+        the output to be considered done.
+        """
+        self.entries[str(key)] = dict(fingerprint=fingerprint(inputs),
+                                      inputs=inputs, time=time.ctime(),
+                                      outputs=[str(p) for p in outputs])
+        if save:
+            self.save()
+
+
+def filter_done(manifest, items, force=False, report=False):
+    """Return the (key, inputs) items which need to be (re)processed.
+
+    Arguments:
+        manifest (Manifest): the manifest.
+        items (list): list of (key, inputs) tuples.
+        force (bool): if True, return all the items.
+        report (bool): if True, print the items to be rerun with the
+            reason (i.e. which inputs changed).
+    """
+    todo = []
+    for key, inputs in items:
+        changes = manifest.changes(key, inputs)
+        if force or len(changes) > 0:
+            todo.append((key, inputs))
+            if report:
+                reason = 'forced' if not changes else ', '.join(changes)
+                print('  RERUN %s (%s)' % (key, reason), flush=True)
+        elif report:
+            print('  SKIP  %s (unchanged)' % key, flush=True)
+    return todo
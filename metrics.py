@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+"""
+metrics - Per-stage performance metrics of the processed files.
+
+For each file and processing stage (copy, convert, archive, remove,
+analyze) a record is appended to a JSON lines file with start and end
+time, duration, bytes processed, throughput, peak RSS and exit status.
+Records are appended with a single write, so that several worker
+processes can share the same file.
+
+Peak RSS is the peak resident memory of the worker process and of its
+child processes (e.g. the kernels executing the notebooks), sampled
+every `rss_interval` seconds while the stage is running.
+
+`MetricsReporter` follows the JSON lines file from the main process,
+periodically printing a throughput summary and writing the aggregated
+metrics in the Prometheus text format (e.g. for node_exporter's
+textfile collector).
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+default_metrics_path = Path('~', '.transfer_convert',
+                            'metrics.jsonl').expanduser()
+
+stages = ('copy', 'convert', 'archive', 'remove', 'analyze')
+rss_interval = 1    # seconds between RSS samples
+_clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+METRICS_PATH = None     # JSON lines file where records are written
+_current = None         # record of the stage running in this process
+
+
+def configure(path=default_metrics_path):
+    """Set the JSON lines file where this process writes the records.
+
+    If `path` is None, records are not written.
+    """
+    global METRICS_PATH
+    METRICS_PATH = None if path is None else Path(path)
+    if METRICS_PATH is not None:
+        METRICS_PATH.parent.mkdir(parents=True, exist_ok=True)
+
+
+def write_record(record, path=None):
+    """Append `record` (a dict) as a line to the JSON lines file `path`."""
+    path = METRICS_PATH if path is None else path
+    if path is None:
+        return
+    line = (json.dumps(record, sort_keys=True, default=str) + '\n').encode()
+    fd = os.open(str(path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def add_bytes(nbytes):
+    """Add `nbytes` to the bytes processed by the current stage (if any)."""
+    if _current is not None and nbytes is not None:
+        _current['bytes'] += nbytes
+
+
+def _read_status(pid, field):
+    """Return `field` (in bytes) from /proc/<pid>/status or 0 if missing."""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _children(pid):
+    children = []
+    try:
+        tasks = os.listdir('/proc/%d/task' % pid)
+    except OSError:
+        return children
+    for tid in tasks:
+        try:
+            with open('/proc/%d/task/%s/children' % (pid, tid)) as f:
+                children.extend(int(c) for c in f.read().split())
+        except OSError:
+            pass
+    return children
+
+
+def tree_rss(pid=None):
+    """Return the total RSS (bytes) of process `pid` and its descendants."""
+    pid = os.getpid() if pid is None else pid
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        total += _read_status(p, 'VmRSS')
+        todo.extend(_children(p))
+    return total
+
+
+def _cpu_seconds(pid):
+    """Return user + system CPU time (s) of process `pid` (0 if missing),
+    including the time of its children which have been waited for."""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return 0
+    # utime, stime, cutime, cstime
+    return sum(int(x) for x in fields[11:15]) / _clock_ticks
+
+
+def tree_cpu_seconds(pid=None):
+    """Return the CPU time (s) of process `pid` and its descendants."""
+    pid = os.getpid() if pid is None else pid
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        total += _cpu_seconds(p)
+        todo.extend(_children(p))
+    return total
+
+
+def reset_peak_rss(pid=None):
+    """Reset the peak RSS (VmHWM) of process `pid` (default: this process).
+
+    Requires Linux >= 4.0, ignored if not supported.
+    """
+    try:
+        with open('/proc/%s/clear_refs' % (pid or 'self'), 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class RSSSampler(threading.Thread):
+    """Thread sampling the RSS of the process tree of `pid` (default: this
+    process) every `interval` seconds, keeping the maximum. `stop()`
+    returns the peak RSS (bytes).
+    """
+
+    def __init__(self, interval=rss_interval, pid=None):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.pid = os.getpid() if pid is None else pid
+        self.peak = tree_rss(self.pid)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, tree_rss(self.pid))
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, tree_rss(self.pid),
+                        _read_status(self.pid, 'VmHWM'))
+        return self.peak
+
+
+@contextmanager
+def measure(fname, stage, verbose=False, **extra):
+    """Context manager recording the metrics of `stage` for file `fname`.
+
+    Bytes processed are added in the body with `add_bytes()`. The record
+    is written when the body exits, with status 'error' (and the error
+    message) if an exception is raised. If `verbose`, the record is also
+    printed. Yields the record dict.
+    """
+    global _current
+    record = dict(file=str(fname), stage=stage, host=socket.gethostname(),
+                  pid=os.getpid(), start=time.time(), bytes=0,
+                  status='ok', error=None)
+    record.update(extra)
+    reset_peak_rss()
+    sampler = RSSSampler()
+    sampler.start()
+    previous, _current = _current, record
+    try:
+        yield record
+    except BaseException as e:
+        record['status'] = 'error'
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        _current = previous
+        record['peak_rss'] = sampler.stop()
+        record['end'] = time.time()
+        record['seconds'] = record['end'] - record['start']
+        record['mbps'] = _mbps(record['bytes'], record['seconds'])
+        write_record(record)
+        if verbose:
+            print(format_record(record), flush=True)
+
+
+def format_record(record):
+    """Return a one-line description of a stage record."""
+    msg = '-- [%s] %s: %.1f MB in %.1f s (%.1f MB/s), peak RSS %.0f MB, %s' % (
+        record['stage'], Path(record['file']).name, record['bytes'] / 1024**2,
+        record['seconds'], record['mbps'], record['peak_rss'] / 1024**2,
+        record['status'].upper())
+    return msg + ' %s' % time.ctime(record['end'])
+
+
+def read_records(path, offset=0):
+    """Return the records in `path` from byte `offset` and the new offset.
+
+    An incomplete last line (being written) is not returned.
+    """
+    records = []
+    with open(str(path), 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            try:
+                records.append(json.loads(line.decode()))
+            except ValueError:
+                pass
+    return records, offset
+
+
+class StageTotals:
+    """Aggregated metrics of the records of each stage."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.totals = {}
+
+    def add(self, record):
+        t = self.totals.setdefault(record['stage'], dict(
+            ok=0, error=0, bytes=0, seconds=0., peak_rss=0, last_mbps=0.,
+            first_start=record['start'], last_end=record['end']))
+        t['ok' if record['status'] == 'ok' else 'error'] += 1
+        t['bytes'] += record['bytes']
+        t['seconds'] += record['seconds']
+        t['peak_rss'] = max(t['peak_rss'], record.get('peak_rss', 0))
+        t['last_mbps'] = record['mbps']
+        t['first_start'] = min(t['first_start'], record['start'])
+        t['last_end'] = max(t['last_end'], record['end'])
+
+    def summary(self):
+        """Return a multi-line string with the throughput of each stage.
+
+        'busy' is the throughput of a single worker (bytes / time spent in
+        the stage), 'wall' the aggregated throughput of all the workers
+        (bytes / wall-clock time from the first start to the last end).
+        """
+        lines = ['-- THROUGHPUT %s (%.0f min)' %
+                 (time.ctime(), (time.time() - self.start) / 60)]
+        for stage in sorted(self.totals, key=_stage_order):
+            t = self.totals[stage]
+            wall = t['last_end'] - t['first_start']
+            lines.append(
+                '   %-8s %4d ok %3d err %9.1f MB  busy %7.1f MB/s  '
+                'wall %7.1f MB/s  peak RSS %6.0f MB' %
+                (stage, t['ok'], t['error'], t['bytes'] / 1024**2,
+                 _mbps(t['bytes'], t['seconds']), _mbps(t['bytes'], wall),
+                 t['peak_rss'] / 1024**2))
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """Return the metrics as a string in the Prometheus text format."""
+        metrics = [
+            ('runs_total', 'counter', 'Stage runs by exit status.', None),
+            ('bytes_total', 'counter', 'Bytes processed.', 'bytes'),
+            ('seconds_total', 'counter', 'Time spent in the stage.',
+             'seconds'),
+            ('last_mbps', 'gauge', 'Throughput (MB/s) of the last run.',
+             'last_mbps'),
+            ('peak_rss_bytes', 'gauge', 'Max peak RSS of the runs.',
+             'peak_rss'),
+        ]
+        lines = []
+        for name, kind, help_text, key in metrics:
+            name = 'transfer_stage_' + name
+            lines += ['# HELP %s %s' % (name, help_text),
+                      '# TYPE %s %s' % (name, kind)]
+            for stage in sorted(self.totals, key=_stage_order):
+                t = self.totals[stage]
+                if key is None:
+                    for status in ('ok', 'error'):
+                        lines.append('%s{stage="%s",status="%s"} %d' %
+                                     (name, stage, status, t[status]))
+                else:
+                    lines.append('%s{stage="%s"} %s' % (name, stage, t[key]))
+        lines += ['# HELP transfer_start_time_seconds Start of the run.',
+                  '# TYPE transfer_start_time_seconds gauge',
+                  'transfer_start_time_seconds %.3f' % self.start]
+        return '\n'.join(lines) + '\n'
+
+
+def _stage_order(stage):
+    return (stages.index(stage) if stage in stages else len(stages), stage)
+
+
+def _mbps(nbytes, seconds):
+    return nbytes / 1024**2 / seconds if seconds > 0 else 0
+
+
+def write_prometheus(totals, path):
+    """Write `totals` (StageTotals) to `path` in the Prometheus text format.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(str(tmp_path), 'w') as f:
+        f.write(totals.prometheus())
+    os.replace(str(tmp_path), str(path))
+
+
+class MetricsReporter(threading.Thread):
+    """Thread following the records written to a JSON lines file.
+
+    Every `interval` seconds, new records are aggregated, the throughput
+    summary is printed and the Prometheus file (if any) is updated.
+    Only records written after the reporter is created are included.
+
+    Arguments:
+        path (Path): JSON lines file written by the workers.
+        prometheus_path (Path or None): Prometheus text file.
+        interval (float): seconds between updates.
+    """
+
+    def __init__(self, path=default_metrics_path, prometheus_path=None,
+                 interval=60):
+        super().__init__(daemon=True)
+        self.path = Path(path)
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.totals = StageTotals()
+        self._offset = self.path.stat().st_size if self.path.is_file() else 0
+        self._stop_event = threading.Event()
+
+    def update(self):
+        """Read the new records. Returns the number of new records."""
+        if not self.path.is_file():
+            return 0
+        records, self._offset = read_records(self.path, self._offset)
+        for record in records:
+            self.totals.add(record)
+        if self.prometheus_path is not None:
+            write_prometheus(self.totals, self.prometheus_path)
+        return len(records)
+
+    def report(self):
+        self.update()
+        print('\n%s\n' % self.totals.summary(), flush=True)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                print('Error reporting metrics: %s' % e, flush=True)
+
+    def stop(self):
+        """Stop the thread and print the final summary."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.report()
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    descr = """\
+        Print the throughput of each processing stage from a JSON lines
+        metrics file and optionally write the Prometheus text file.
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('metrics', nargs='?', default=str(default_metrics_path),
+                        help='JSON lines metrics file. Default "%s".'
+                             % default_metrics_path)
+    parser.add_argument('--prometheus', metavar='PATH', default=None,
+                        help='Write the metrics in Prometheus text format.')
+    parser.add_argument('--since', metavar='HOURS', type=float, default=None,
+                        help='Only include records of the last HOURS hours.')
+    parser.add_argument('--stage', default=None, choices=stages,
+                        help='Also print the records of this stage.')
+    args = parser.parse_args()
+
+    if not Path(args.metrics).is_file():
+        sys.exit('\nMetrics file not found: %s\n' % args.metrics)
+    records, _ = read_records(args.metrics)
+    if args.since is not None:
+        tmin = time.time() - args.since * 3600
+        records = [r for r in records if r['start'] >= tmin]
+    totals = StageTotals()
+    for record in records:
+        totals.add(record)
+        if record['stage'] == args.stage:
+            print(format_record(record))
+    if records:
+        totals.start = min(r['start'] for r in records)
+    print(totals.summary())
+    if args.prometheus is not None:
+        write_prometheus(totals, args.prometheus)
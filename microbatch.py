@@ -0,0 +1,85 @@
+"""
+microbatch - Group small data files to be processed in a single job.
+
+A us-ALEX SM file is converted and analyzed in a few seconds, and the
+per-file overhead (submitting the job, starting the kernels executing the
+conversion and analysis notebooks) dominates. `MicroBatcher` groups the
+small files until the group reaches a byte (`max_bytes`) or count
+(`max_files`) budget, or until the first file of the group waited
+`max_wait` seconds. Each group is then processed by a single worker call
+(`transfer.process_group`), which executes all the notebooks of the group
+in the same kernel while producing the outputs, archive copies, metrics
+and errors of each file as when files are processed one by one.
+
+Only the files for which `batchable()` is True are grouped: 48-spot DAT
+files, or any file larger than `max_bytes`, are processed one per job.
+"""
+
+import time
+from pathlib import Path
+
+
+default_max_bytes = 256 * 1024**2
+default_max_files = 16
+default_max_wait = 5     # seconds before submitting an incomplete group
+batchable_extensions = ('.sm',)
+
+
+def batchable(fname, size, max_bytes=default_max_bytes):
+    """Return True if the file `fname` of `size` bytes can be grouped."""
+    return (Path(fname).suffix.lower() in batchable_extensions and
+            size is not None and size <= max_bytes)
+
+
+class MicroBatcher:
+    """Accumulate files in groups of at most `max_bytes` and `max_files`.
+
+    Arguments:
+        max_bytes (int): max total size (bytes) of the files of a group.
+        max_files (int): max number of files in a group.
+        max_wait (float): seconds after which an incomplete group is
+            returned by `flush()`.
+    """
+
+    def __init__(self, max_bytes=default_max_bytes,
+                 max_files=default_max_files, max_wait=default_max_wait):
+        self.max_bytes = max_bytes
+        self.max_files = max(1, max_files)
+        self.max_wait = max_wait
+        self._group = []
+        self._bytes = 0
+        self._since = None
+
+    @property
+    def num_pending(self):
+        """Number of files in the group being filled."""
+        return len(self._group)
+
+    def _close(self):
+        group = self._group
+        self._group, self._bytes, self._since = [], 0, None
+        return group
+
+    def add(self, key, size):
+        """Add the file `key` of `size` bytes. Returns the list of the
+        groups completed by this file (possibly empty)."""
+        groups = []
+        if self._group and self._bytes + size > self.max_bytes:
+            groups.append(self._close())
+        if not self._group:
+            self._since = time.time()
+        self._group.append(key)
+        self._bytes += size
+        if (len(self._group) >= self.max_files or
+                self._bytes >= self.max_bytes):
+            groups.append(self._close())
+        return groups
+
+    def flush(self, force=False):
+        """Return the incomplete group if it waited `max_wait` seconds
+        (or if `force`), else an empty list."""
+        if not self._group:
+            return []
+        if force or time.time() - self._since >= self.max_wait:
+            return [self._close()]
+        return []
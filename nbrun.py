@@ -13,10 +13,6 @@ notebooks.
 
 import time
 from pathlib import Path
-from IPython.display import display, FileLink
-import nbformat
-from nbconvert.preprocessors import ExecutePreprocessor
-from nbconvert import HTMLExporter
 
 __version__ = '0.2'
 
@@ -49,7 +45,8 @@ def run_notebook(notebook_path, nb_kwargs=None, suffix='-out',
                  timeout=3600, execute_kwargs=None,
                  save_ipynb=True, save_html=False,
                  insert_pos=1, hide_input=False, display_links=True,
-                 return_nb=False):
+                 return_nb=False, kernel_pool=None, html_queue=None,
+                 slim=None, profile=False):
     """Runs a notebook and saves the output in a new notebook.
 
     Executes a notebook, optionally passing "arguments"
@@ -107,7 +104,28 @@ def run_notebook(notebook_path, nb_kwargs=None, suffix='-out',
             In a text terminal, links are displayed as full file names.
         return_nb (bool): if True, returns the notebook object. If False
             returns None. Default False.
+        kernel_pool (kernelpool.KernelPool or None): if not None, execute
+            the notebook in a warm kernel borrowed from this pool instead
+            of starting a new kernel. `kernel_name` is ignored.
+        html_queue (multiprocessing.Queue or None): if not None and
+            `save_html` is True, the HTML is not rendered here: the tuple
+            (out_path_ipynb, out_path_html) is put in this queue, to be
+            rendered by another process (see `htmlexport.ExportService`).
+            Requires `save_ipynb`.
+        slim (dict or None): if not None, images of the output ipynb
+            notebook are moved to a sidecar folder and large outputs are
+            truncated, using this dict as arguments of
+            `nbslim.slim_notebook()`. The HTML notebook is not affected.
+        profile (bool): if True, record wall time, CPU time and peak memory
+            of each code cell in the cell metadata and in the sidecar file
+            `<out_path_ipynb stem>_profile.json` (see `cellprofile`).
     """
+    # Imported here so that importing this module is fast
+    from IPython.display import display, FileLink
+    import nbformat
+    from nbconvert.preprocessors import ExecutePreprocessor
+    from nbconvert import HTMLExporter
+
     timestamp_cell = ("**Executed:** %s\n\n**Duration:** %d seconds.\n\n"
                       "**Autogenerated from:** [%s](%s)")
     if nb_kwargs is None:
@@ -143,19 +161,33 @@ def run_notebook(notebook_path, nb_kwargs=None, suffix='-out',
     execute_kwargs.update(timeout=timeout)
     if kernel_name is not None:
         execute_kwargs.update(kernel_name=kernel_name)
-    ep = ExecutePreprocessor(**execute_kwargs)
+    if profile:
+        import cellprofile
+        ep = cellprofile.ProfilingPreprocessor(**execute_kwargs)
+    else:
+        ep = ExecutePreprocessor(**execute_kwargs)
     nb = nbformat.read(str(notebook_path), as_version=4)
 
     if hide_input:
         nb["metadata"].update({"hide_input": True})
 
+    inserted_pos = None
     if len(nb_kwargs) > 0:
-        nb['cells'].insert(insert_pos, nbformat.v4.new_code_cell(code_cell))
+        args_cell = nbformat.v4.new_code_cell(code_cell)
+        nb['cells'].insert(insert_pos, args_cell)
+        inserted_pos = [c is args_cell for c in nb['cells']].index(True)
 
     start_time = time.time()
+    error = False
     try:
         # Execute the notebook
-        ep.preprocess(nb, {'metadata': {'path': working_dir}})
+        resources = {'metadata': {'path': working_dir}}
+        if kernel_pool is None:
+            ep.preprocess(nb, resources)
+        else:
+            import kernelpool
+            with kernel_pool.kernel(working_dir) as km:
+                kernelpool.preprocess_in_kernel(ep, nb, resources, km)
     except:
         # Execution failed, print a message then raise.
         msg = ('Error executing the notebook "%s".\n'
@@ -163,23 +195,36 @@ def run_notebook(notebook_path, nb_kwargs=None, suffix='-out',
                'See notebook "%s" for the traceback.' %
                (notebook_path, str(nb_kwargs), out_path_ipynb))
         print(msg)
+        error = True
         timestamp_cell += '\n\nError occurred during execution. See below.'
         raise
     finally:
         # Add timestamping cell
         duration = time.time() - start_time
+        if profile and save_ipynb:
+            import cellprofile
+            cellprofile.write_profile(nb, notebook_path, out_path_ipynb,
+                                      start_time, duration, inserted_pos,
+                                      error=error)
         timestamp_cell = timestamp_cell % (time.ctime(start_time), duration,
                                            notebook_path, out_path_ipynb)
         nb['cells'].insert(0, nbformat.v4.new_markdown_cell(timestamp_cell))
+        queue_html = save_html and html_queue is not None and save_ipynb
+        if save_html and not queue_html:
+            # Render the HTML before slimming, with the images embedded
+            html_exporter = HTMLExporter()
+            body, resources = html_exporter.from_notebook_node(nb)
+            with open(str(out_path_html), 'w') as f:
+                f.write(body)
         # Save the executed notebook to disk
         if save_ipynb:
+            if slim is not None:
+                import nbslim
+                nbslim.slim_notebook(nb, out_path_ipynb, **slim)
             nbformat.write(nb, str(out_path_ipynb))
             if display_links:
                 display(FileLink(str(out_path_ipynb)))
-        if save_html:
-            html_exporter = HTMLExporter()
-            body, resources = html_exporter.from_notebook_node(nb)
-            with open(str(out_path_html), 'w') as f:
-                f.write(body)
+        if queue_html:
+            html_queue.put((str(out_path_ipynb), str(out_path_html)))
         if return_nb:
             return nb
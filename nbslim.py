@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+nbslim - Reduce the size of executed notebooks.
+
+Images embedded in the outputs (base64 PNG/JPEG) are moved to a sidecar
+folder next to the notebook, named by the hash of their content, so that
+identical images (in the same or in other notebooks of the folder) are
+stored once. In the notebook, each image is replaced by an HTML <img> tag
+with the relative path of the file, so the notebook still opens (and shows
+the images) in Jupyter.
+
+Optionally, images larger than a threshold are downsampled and/or
+re-encoded (requires Pillow) and large text outputs are truncated.
+
+`inline_images()` puts the images back into a notebook, for example
+before rendering it to a self-contained HTML file.
+"""
+
+import os
+import io
+import base64
+import hashlib
+from pathlib import Path
+
+
+default_images_folder = 'notebook_images'
+
+# Options used by the --slim option of the batch scripts
+default_options = dict(max_image_bytes=200 * 1024, max_width=1600,
+                       image_format=None, max_text=100000)
+
+image_mimetypes = {'image/png': '.png', 'image/jpeg': '.jpg'}
+text_mimetypes = ('text/plain', 'text/html', 'text/markdown', 'text/latex')
+
+
+def _source(data):
+    return ''.join(data) if isinstance(data, list) else data
+
+
+def _write_image(data, folder, ext):
+    """Save `data` (bytes) in `folder` with a content-addressed name."""
+    name = hashlib.sha1(data).hexdigest() + ext
+    path = Path(folder, name)
+    if not path.is_file():
+        folder.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(folder, '.' + name + '.tmp')
+        with open(str(tmp_path), 'wb') as f:
+            f.write(data)
+        os.replace(str(tmp_path), str(path))
+    return name
+
+
+def shrink_image(data, mimetype, max_width=None, image_format=None):
+    """Downsample and/or re-encode the image `data` (bytes) with Pillow.
+
+    Arguments:
+        data (bytes): PNG or JPEG image.
+        mimetype (string): mimetype of `data`.
+        max_width (int or None): images wider than this are resized
+            (keeping the aspect ratio).
+        image_format (string or None): 'png' or 'jpeg'. If None, keep the
+            original format.
+
+    Returns the new image data and mimetype. The original image is returned
+    if the result is not smaller or if Pillow is not installed.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return data, mimetype
+    img = Image.open(io.BytesIO(data))
+    if max_width is not None and img.width > max_width:
+        height = round(img.height * max_width / img.width)
+        img = img.resize((max_width, height), Image.LANCZOS)
+    if image_format is None:
+        image_format = mimetype.split('/')[1]
+    buffer = io.BytesIO()
+    if image_format == 'jpeg':
+        img.convert('RGB').save(buffer, format='JPEG', quality=85,
+                                optimize=True)
+    else:
+        img.save(buffer, format='PNG', optimize=True)
+    new_data = buffer.getvalue()
+    if len(new_data) >= len(data):
+        return data, mimetype
+    return new_data, 'image/' + image_format
+
+
+def _truncate(text, max_text):
+    dropped = len(text) - max_text
+    head = text[:max_text // 2]
+    tail = text[-max_text // 2:]
+    return '%s\n[... %d characters dropped ...]\n%s' % (head, dropped, tail)
+
+
+def slim_output(output, images_dir, rel_dir, stats, max_image_bytes=None,
+                max_width=None, image_format=None, max_text=None):
+    """Slim a single output of a code cell (in place)."""
+    if output.get('output_type') == 'stream':
+        text = _source(output.get('text', ''))
+        if max_text is not None and len(text) > max_text:
+            output['text'] = _truncate(text, max_text)
+            stats['text_dropped'] += len(text) - max_text
+        return
+    data = output.get('data')
+    if data is None:
+        return
+    metadata = output.setdefault('metadata', {})
+    for mimetype, ext in image_mimetypes.items():
+        if mimetype not in data:
+            continue
+        image = base64.b64decode(_source(data.pop(mimetype)))
+        stats['image_bytes'] += len(image)
+        if max_image_bytes is not None and len(image) > max_image_bytes:
+            image, new_mimetype = shrink_image(image, mimetype, max_width,
+                                               image_format)
+            ext = image_mimetypes[new_mimetype]
+        name = _write_image(image, images_dir, ext)
+        stats['images'] += 1
+        stats['saved_bytes'] += len(image)
+        size = metadata.pop(mimetype, {})
+        attrs = ''.join(' %s="%s"' % (k, size[k]) for k in ('width', 'height')
+                        if k in size)
+        src = '%s/%s' % (rel_dir, name)
+        html = data.get('text/html')
+        data['text/html'] = '<img src="%s"%s>' % (src, attrs)
+        metadata['nbslim'] = dict(path=src, size=size, html=html)
+        break
+    if max_text is not None:
+        for mimetype in text_mimetypes:
+            if mimetype not in data or 'nbslim' in metadata:
+                continue
+            text = _source(data[mimetype])
+            if len(text) <= max_text:
+                continue
+            if mimetype == 'text/plain':
+                data[mimetype] = _truncate(text, max_text)
+                stats['text_dropped'] += len(text) - max_text
+            else:
+                del data[mimetype]
+                stats['text_dropped'] += len(text)
+        if not data:
+            data['text/plain'] = '[output dropped]'
+
+
+def slim_notebook(nb, nb_path, images_folder=default_images_folder,
+                  max_image_bytes=None, max_width=None, image_format=None,
+                  max_text=None):
+    """Move images of notebook `nb` to a sidecar folder (in place).
+
+    Arguments:
+        nb (NotebookNode): the notebook (e.g. from `nbformat.read`).
+        nb_path (Path): file name where the notebook is (or will be) saved.
+        images_folder (string): folder (relative to the notebook folder)
+            where the images are saved.
+        max_image_bytes (int or None): images larger than this are
+            downsampled or re-encoded (see `shrink_image`).
+        max_width (int or None): max width (pixels) of resized images.
+        image_format (string or None): 'png' or 'jpeg' for re-encoded
+            images. If None, keep the original format.
+        max_text (int or None): text outputs longer than this (characters)
+            are truncated (text/plain) or dropped (HTML, markdown, LaTeX).
+
+    Returns:
+        A dict with the number of images, their original and saved size in
+        bytes, and the number of characters of text dropped.
+    """
+    images_dir = Path(Path(nb_path).parent, images_folder)
+    stats = dict(images=0, image_bytes=0, saved_bytes=0, text_dropped=0)
+    for cell in nb['cells']:
+        for output in cell.get('outputs', []):
+            slim_output(output, images_dir, images_folder, stats,
+                        max_image_bytes=max_image_bytes, max_width=max_width,
+                        image_format=image_format, max_text=max_text)
+    return stats
+
+
+def inline_images(nb, nb_path):
+    """Embed back the images moved by `slim_notebook()` (in place)."""
+    folder = Path(nb_path).parent
+    for cell in nb['cells']:
+        for output in cell.get('outputs', []):
+            info = output.get('metadata', {}).get('nbslim')
+            if info is None:
+                continue
+            path = Path(folder, info['path'])
+            if not path.is_file():
+                continue
+            ext = path.suffix
+            mimetype = [m for m, e in image_mimetypes.items() if e == ext][0]
+            with open(str(path), 'rb') as f:
+                output['data'][mimetype] = base64.b64encode(f.read()).decode()
+            if info['html'] is None:
+                del output['data']['text/html']
+            else:
+                output['data']['text/html'] = info['html']
+            del output['metadata']['nbslim']
+            if info['size']:
+                output['metadata'][mimetype] = info['size']
+    return nb
+
+
+def slim_file(nb_path, **kwargs):
+    """Slim the notebook file `nb_path` (in place). Returns the stats."""
+    import nbformat
+    nb = nbformat.read(str(nb_path), as_version=4)
+    stats = slim_notebook(nb, nb_path, **kwargs)
+    tmp_path = Path(Path(nb_path).parent, '.' + Path(nb_path).name + '.tmp')
+    nbformat.write(nb, str(tmp_path))
+    os.replace(str(tmp_path), str(nb_path))
+    return stats
+
+
+def format_stats(stats):
+    return ('%d images (%.1f MB -> %.1f MB), %d text characters dropped' %
+            (stats['images'], stats['image_bytes'] / 1024**2,
+             stats['saved_bytes'] / 1024**2, stats['text_dropped']))
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        Slim executed notebooks (in place), moving images to the sidecar
+        folder '%s' next to each notebook. Identical images are stored once.
+        """ % default_images_folder
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('notebooks', nargs='+', help='Notebooks to slim.')
+    parser.add_argument('--max-image-kb', metavar='KB', type=float,
+                        default=None,
+                        help='Downsample/re-encode images larger than KB '
+                             '(requires Pillow).')
+    parser.add_argument('--max-width', metavar='PIXELS', type=int,
+                        default=None, help='Max width of resized images.')
+    parser.add_argument('--format', default=None, choices=('png', 'jpeg'),
+                        help='Format of re-encoded images. Default: same as '
+                             'the original.')
+    parser.add_argument('--max-text', metavar='CHARS', type=int, default=None,
+                        help='Truncate or drop text outputs longer than '
+                             'CHARS characters.')
+    args = parser.parse_args()
+
+    max_image_bytes = None
+    if args.max_image_kb is not None:
+        max_image_bytes = int(args.max_image_kb * 1024)
+    for nb_path in args.notebooks:
+        stats = slim_file(nb_path, max_image_bytes=max_image_bytes,
+                          max_width=args.max_width, image_format=args.format,
+                          max_text=args.max_text)
+        print('%s: %s' % (nb_path, format_stats(stats)), flush=True)
@@ -0,0 +1,234 @@
+"""
+pipeline - Multi-stage executor with a separate pool of workers per stage.
+
+Each stage has an input queue and a number of worker processes. A job
+(a picklable object, usually a dict) is passed to the first stage function,
+the returned value is put in the queue of the next stage and so on.
+This way I/O-bound stages (e.g. network copies) and CPU-bound stages
+(e.g. conversion) run concurrently with independent levels of parallelism.
+
+When a stage raises an exception, the job is dropped from the pipeline
+and reported as failed. When a worker process dies (e.g. a segfault or the
+OOM killer), the job it was processing is reported as failed and the worker
+is replaced.
+"""
+
+import time
+import threading
+import traceback
+import multiprocessing as mp
+
+
+class Stage:
+    """A pipeline stage.
+
+    Arguments:
+        name (string): name of the stage (used in messages).
+        func (callable): module-level function called with the job as the
+            only argument. Its return value is passed to the next stage.
+            If it returns None, the job leaves the pipeline as completed.
+        nworkers (int): number of worker processes for this stage.
+        initializer (callable or None): function called once when each
+            worker process starts.
+    """
+
+    def __init__(self, name, func, nworkers=1, initializer=None):
+        assert nworkers > 0, 'Stage "%s" needs at least one worker.' % name
+        self.name = name
+        self.func = func
+        self.nworkers = nworkers
+        self.initializer = initializer
+
+
+def _stage_worker(stage_name, func, initializer, in_queue, out_queue,
+                  done_queue, worker_id):
+    # Messages are (status, stage_name, job, error, worker_id). 'started'
+    # and 'forwarded' track the job in progress in each worker.
+    if initializer is not None:
+        initializer()
+    while True:
+        job = in_queue.get()
+        if job is None:
+            break
+        done_queue.put(('started', stage_name, job, None, worker_id))
+        try:
+            result = func(job)
+        except Exception as e:
+            msg = '%s\n%s' % (e, traceback.format_exc())
+            done_queue.put(('failed', stage_name, job, msg, worker_id))
+            continue
+        if out_queue is None or result is None:
+            done_queue.put(('completed', stage_name,
+                            job if result is None else result, None,
+                            worker_id))
+        else:
+            done_queue.put(('forwarded', stage_name, None, None, worker_id))
+            out_queue.put(result)
+
+
+class Pipeline:
+    """Run jobs through a sequence of stages.
+
+    Arguments:
+        stages (list of Stage): the stages in order of execution.
+        callback (callable or None): function called in the main process
+            for each job leaving the pipeline, with arguments
+            `(status, stage_name, job, error)`. `status` is 'completed'
+            or 'failed'.
+
+    Use as a context manager, or call `start()` and `close()`.
+    """
+
+    def __init__(self, stages, callback=None):
+        assert len(stages) > 0, 'A pipeline needs at least one stage.'
+        self.stages = stages
+        self.callback = callback
+        self.queues = [mp.Queue() for _ in stages]
+        # Written without a feeder thread, so that the messages of a worker
+        # are not lost if it is killed
+        self.done_queue = mp.SimpleQueue()
+        self.workers = []
+        self.completed = []
+        self.failed = []
+        self.restarted = 0      # number of workers replaced after dying
+        self._pending = 0
+        self._running = {}      # (stage index, worker index) -> job
+        self._stopping = False
+        self._lock = threading.Condition()
+        self._collector = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def _start_worker(self, i, j):
+        """Start worker `j` of stage `i`."""
+        stage = self.stages[i]
+        out_queue = self.queues[i + 1] if i + 1 < len(self.stages) else None
+        p = mp.Process(target=_stage_worker,
+                       args=(stage.name, stage.func, stage.initializer,
+                             self.queues[i], out_queue, self.done_queue,
+                             (i, j)),
+                       daemon=True)
+        p.start()
+        return p
+
+    def start(self):
+        """Start the worker processes of all the stages."""
+        for i, stage in enumerate(self.stages):
+            self.workers.append([self._start_worker(i, j)
+                                 for j in range(stage.nworkers)])
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def _collect(self):
+        while True:
+            if self.done_queue.empty():
+                self._check_workers()
+                time.sleep(0.1)
+                continue
+            msg = self.done_queue.get()
+            if msg is None:
+                break
+            self._handle(*msg)
+            self._check_workers()
+
+    def _handle(self, status, stage_name, job, error, worker_id):
+        if status == 'started':
+            self._running[worker_id] = job
+            return
+        self._running.pop(worker_id, None)
+        if status == 'forwarded':
+            return
+        self._finish(status, stage_name, job, error)
+
+    def _finish(self, status, stage_name, job, error):
+        if status == 'completed':
+            self.completed.append(job)
+        else:
+            self.failed.append((stage_name, job, error))
+        if self.callback is not None:
+            try:
+                self.callback(status, stage_name, job, error)
+            except Exception as e:
+                print('Pipeline callback error: %s' % e, flush=True)
+        with self._lock:
+            self._pending -= 1
+            self._lock.notify_all()
+
+    def _check_workers(self):
+        """Fail the job of the dead workers and start new workers."""
+        if self._stopping:
+            return
+        dead = [(i, j) for i, workers in enumerate(self.workers)
+                for j, p in enumerate(workers)
+                if not p.is_alive() and p.exitcode != 0]
+        if not dead:
+            return
+        # Messages sent by the dead workers before dying
+        while not self.done_queue.empty():
+            msg = self.done_queue.get()
+            if msg is None:
+                self.done_queue.put(None)
+                break
+            self._handle(*msg)
+        for i, j in dead:
+            stage_name = self.stages[i].name
+            exitcode = self.workers[i][j].exitcode
+            print('Worker %d of stage "%s" died (exit code %s), restarting.'
+                  % (j, stage_name, exitcode), flush=True)
+            if (i, j) in self._running:
+                error = ('Worker of stage "%s" died (exit code %s).' %
+                         (stage_name, exitcode))
+                self._finish('failed', stage_name,
+                             self._running.pop((i, j)), error)
+            self.workers[i][j] = self._start_worker(i, j)
+            self.restarted += 1
+
+    def submit(self, job):
+        """Put `job` in the queue of the first stage."""
+        with self._lock:
+            self._pending += 1
+        self.queues[0].put(job)
+
+    @property
+    def pending(self):
+        """Number of submitted jobs not yet out of the pipeline."""
+        return self._pending
+
+    def join(self, timeout=None):
+        """Wait until all the submitted jobs leave the pipeline.
+
+        Returns True if no job is pending.
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self):
+        """Wait for all the submitted jobs, then stop the workers."""
+        for queue, workers in zip(self.queues, self.workers):
+            for _ in workers:
+                queue.put(None)
+            for p in workers:
+                p.join()
+        self.done_queue.put(None)
+        self._collector.join()
+
+    def terminate(self):
+        """Stop the workers immediately, dropping pending jobs."""
+        self._stopping = True
+        for workers in self.workers:
+            for p in workers:
+                p.terminate()
+        for workers in self.workers:
+            for p in workers:
+                p.join()
+        self.done_queue.put(None)
+        if self._collector is not None:
+            self._collector.join()
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+"""
+preview - Quick-look summary of a 48-spot DAT file, computed while copying.
+
+The first complete feedback on a measurement is the analysis notebook,
+executed after copy, conversion and archival. `DatPreview` decodes the
+words of a DAT file incrementally, chunk by chunk, while the file is being
+copied to the ramdisk (it is passed as `observer` to `fastcopy.copy_file`,
+see the `--preview` option of `batch_convert.py`). It computes:
+
+- the count rate of each spot (donor and acceptor channels),
+- the alternation histogram (timestamps modulo the alternation period)
+  of the donor and acceptor channels, summed over all the spots,
+- the acquisition duration (first to last timestamp).
+
+The summary is written as JSON every few seconds during the copy and at
+the end, together with a PNG figure (if matplotlib is installed), so that
+an operator can tell right away if a measurement is usable (e.g. dead
+spots, too short, no alternation).
+
+EXPERIMENTAL: the bit layout of the DAT words (position of the detector
+number and of the timestamp, detector of the overflow words) and the
+channel mapping (donor and acceptor channel of each spot) are not exposed
+by niconverter and have not been verified on real DAT files. Therefore
+the caller passes the `DatLayout` of the files: only the layout of the
+synthetic files of `synthdata` (`synthetic_layout()`) is defined here, and
+the batch scripts have no option to compute the preview. As a safeguard,
+the fraction of words outside the spot and overflow channels is saved in
+the summary ('unknown_fraction') and the summary is flagged as a possible
+layout mismatch when it exceeds `max_unknown_fraction`. After the
+conversion, `check_preview()` compares the donor and acceptor counts of
+each spot with the Photon-HDF5 file (decoded by niconverter) and flags the
+summary ('checked', 'count_mismatch', 'layout_mismatch') when they differ
+by more than `max_count_mismatch`.
+"""
+
+import os
+import json
+import time
+from pathlib import Path
+from collections import namedtuple
+
+import numpy as np
+
+
+num_spots = 48
+default_alex_period = 4000  # clock cycles, if not in the YAML metadata
+default_bins = 100          # bins of the alternation histogram
+write_interval = 5          # seconds between JSON updates during the copy
+dead_spot_fraction = 0.1    # spots below this fraction of median rate
+max_unknown_fraction = 0.01  # words outside the expected channels
+max_count_mismatch = 0.01   # relative difference from the converted counts
+
+# Layout of the DAT words of the synthetic files (written by `synthdata`)
+synthetic_clock_frequency = 80e6
+synthetic_timestamp_bits = 25
+synthetic_detector_bits = 7
+synthetic_overflow_detector = 127
+synthetic_byteorder = '>'
+
+
+DatLayout = namedtuple('DatLayout', ['word_dtype', 'header_size',
+                                     'clock_frequency', 'timestamp_bits',
+                                     'overflow_detector', 'donor_channels',
+                                     'acceptor_channels'])
+
+
+def synthetic_layout(num_spots=num_spots):
+    """Return the `DatLayout` of the synthetic DAT files of `synthdata`.
+
+    Each 32-bit word has the detector in the upper bits and the timestamp
+    in the lower `synthetic_timestamp_bits` bits. Channels `2 * spot` and
+    `2 * spot + 1` are the donor and acceptor of each spot.
+    """
+    spots = np.arange(num_spots)
+    return DatLayout(word_dtype=np.dtype(synthetic_byteorder + 'u4'),
+                     header_size=0,
+                     clock_frequency=synthetic_clock_frequency,
+                     timestamp_bits=synthetic_timestamp_bits,
+                     overflow_detector=synthetic_overflow_detector,
+                     donor_channels=2 * spots, acceptor_channels=2 * spots + 1)
+
+
+def alex_period_from_metadata(yaml_fname):
+    """Return the alternation period in the YAML metadata (or the default).
+    """
+    yaml_fname = Path(yaml_fname)
+    if yaml_fname.is_file():
+        import yaml
+        with open(str(yaml_fname)) as f:
+            metadata = yaml.safe_load(f) or {}
+        period = metadata.get('measurement_specs', {}).get('alex_period')
+        if period is not None:
+            return int(period)
+    return default_alex_period
+
+
+def preview_paths(out_folder, stem):
+    """Return the JSON and PNG file names of the preview of `stem`."""
+    return (Path(out_folder, stem + '_preview.json'),
+            Path(out_folder, stem + '_preview.png'))
+
+
+class DatPreview:
+    """Statistics of a DAT file computed incrementally from its data.
+
+    Call the instance (or `update()`) with each chunk of the file, in
+    order, then `finish()`. When called, errors are not raised but saved
+    in `error` (and the following chunks are ignored).
+
+    Arguments:
+        name (string): name of the data file (used in the summary).
+        out_folder (Path or None): folder where the JSON and PNG summaries
+            are saved. If None, nothing is saved.
+        alex_period (int): alternation period (clock cycles).
+        bins (int): bins of the alternation histogram.
+        num_spots (int): number of spots.
+        layout (DatLayout or None): layout of the words of the file. If
+            None, the layout of the synthetic files (`synthetic_layout`).
+    """
+
+    def __init__(self, name, out_folder=None, alex_period=default_alex_period,
+                 bins=default_bins, num_spots=num_spots, layout=None):
+        self.name = name
+        self.out_folder = None if out_folder is None else Path(out_folder)
+        self.alex_period = alex_period
+        self.bins = bins
+        self.num_spots = num_spots
+        if layout is None:
+            layout = synthetic_layout(num_spots)
+        self.layout = layout
+        num_channels = max(layout.donor_channels.max(),
+                           layout.acceptor_channels.max(),
+                           layout.overflow_detector) + 1
+        # Role of each channel: 0 donor, 1 acceptor, -1 not a spot channel
+        self._role = np.full(num_channels, -1, dtype='int8')
+        self._role[layout.donor_channels] = 0
+        self._role[layout.acceptor_channels] = 1
+        self.counts = np.zeros(num_channels, dtype='int64')
+        self.alternation = np.zeros((2, bins), dtype='int64')
+        self.first = None
+        self.last = None
+        self.nbytes = 0
+        self.num_words = 0
+        self.error = None
+        self._overflows = 0
+        self._rest = b''
+        self._header = layout.header_size
+        self._t_start = time.time()
+        self._last_write = self._t_start
+
+    def __call__(self, chunk):
+        # An error in the preview must not stop the copy
+        if self.error is not None:
+            return
+        try:
+            self.update(chunk)
+        except Exception as e:
+            self.error = '%s: %s' % (type(e).__name__, e)
+
+    def update(self, chunk):
+        """Add a chunk of data (bytes or memoryview) of the DAT file."""
+        layout = self.layout
+        self.nbytes += len(chunk)
+        if self._header:
+            skip = min(self._header, len(chunk))
+            chunk, self._header = chunk[skip:], self._header - skip
+        if self._rest:
+            chunk = self._rest + bytes(chunk)
+        itemsize = layout.word_dtype.itemsize
+        usable = len(chunk) - len(chunk) % itemsize
+        self._rest = bytes(chunk[usable:])
+        words = np.frombuffer(chunk[:usable], dtype=layout.word_dtype)
+        if words.size == 0:
+            return
+        self.num_words += words.size
+        bits = layout.timestamp_bits
+        detectors = (words >> bits).astype('int64')
+        known = detectors < self.counts.size
+        self.counts += np.bincount(detectors[known],
+                                   minlength=self.counts.size)
+        overflow = detectors == layout.overflow_detector
+        overflows = np.cumsum(overflow) + self._overflows
+        self._overflows = int(overflows[-1])
+        photons = ~overflow
+        mask = (1 << bits) - 1
+        times = ((overflows[photons].astype('int64') << bits) +
+                 (words[photons] & mask).astype('int64'))
+        if times.size == 0:
+            return
+        if self.first is None:
+            self.first = int(times[0])
+        self.last = int(times[-1])
+        phase = (times % self.alex_period) * self.bins // self.alex_period
+        role = np.full(times.size, -1, dtype='int8')
+        ph_known = known[photons]
+        role[ph_known] = self._role[detectors[photons][ph_known]]
+        self.alternation[0] += np.bincount(phase[role == 0],
+                                           minlength=self.bins)
+        self.alternation[1] += np.bincount(phase[role == 1],
+                                           minlength=self.bins)
+        if (self.out_folder is not None and
+                time.time() - self._last_write >= write_interval):
+            self.write_json()
+
+    @property
+    def duration(self):
+        """Acquisition duration (s) of the data read so far."""
+        if self.first is None:
+            return 0
+        return (self.last - self.first) / self.layout.clock_frequency
+
+    def summary(self):
+        """Return a dict with the statistics of the data read so far."""
+        duration = self.duration
+        spot_counts = np.stack([self.counts[self.layout.donor_channels],
+                                self.counts[self.layout.acceptor_channels]],
+                               axis=1)
+        rates = spot_counts / duration if duration > 0 else spot_counts * 0.
+        total = rates.sum(axis=1)
+        median = float(np.median(total))
+        dead = np.nonzero(total < dead_spot_fraction * median)[0]
+        # Words which are neither photons of a spot nor overflows
+        unknown = self.num_words - self._overflows - int(spot_counts.sum())
+        unknown_fraction = unknown / self.num_words if self.num_words else 0.
+        return dict(name=self.name, bytes=self.nbytes, error=self.error,
+                    num_photons=int(spot_counts.sum()),
+                    counts_donor=spot_counts[:, 0].tolist(),
+                    counts_acceptor=spot_counts[:, 1].tolist(),
+                    duration=duration,
+                    clock_frequency=self.layout.clock_frequency,
+                    rate_donor=rates[:, 0].round(1).tolist(),
+                    rate_acceptor=rates[:, 1].round(1).tolist(),
+                    median_rate=median, dead_spots=dead.tolist(),
+                    alex_period=self.alex_period,
+                    alternation_donor=self.alternation[0].tolist(),
+                    alternation_acceptor=self.alternation[1].tolist(),
+                    unknown_fraction=unknown_fraction,
+                    layout_mismatch=unknown_fraction > max_unknown_fraction,
+                    elapsed=time.time() - self._t_start)
+
+    def write_json(self, summary=None):
+        """Save the summary in the JSON file (atomically)."""
+        if summary is None:
+            summary = self.summary()
+        json_path, _ = preview_paths(self.out_folder, self.name)
+        save_summary(summary, json_path)
+        self._last_write = time.time()
+        return json_path
+
+    def finish(self):
+        """Save JSON and PNG summaries and return the summary dict."""
+        summary = self.summary()
+        if self.out_folder is not None:
+            self.write_json(summary)
+            _, png_path = preview_paths(self.out_folder, self.name)
+            plot_summary(summary, png_path)
+        return summary
+
+
+def save_summary(summary, json_path):
+    """Save the `summary` dict in `json_path` (atomically)."""
+    json_path = Path(json_path)
+    json_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(json_path.parent, '.' + json_path.name + '.tmp')
+    with open(str(tmp_path), 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+    os.replace(str(tmp_path), str(json_path))
+
+
+def photon_hdf5_counts(h5_fname):
+    """Return the donor and acceptor counts of each spot of `h5_fname`.
+
+    Returns an array of shape (num spots, 2), computed from the detectors
+    and the `detectors_specs` of each `photon_data` group of the
+    Photon-HDF5 file.
+    """
+    import tables
+    with tables.open_file(str(h5_fname)) as h5file:
+        groups = sorted((g for g in h5file.root
+                         if g._v_name.startswith('photon_data')),
+                        key=lambda g: int(g._v_name[len('photon_data'):] or 0))
+        counts = np.zeros((len(groups), 2), dtype='int64')
+        for spot, group in enumerate(groups):
+            specs = group.measurement_specs.detectors_specs
+            detectors = group.detectors.read()
+            for i, ch in enumerate((specs.spectral_ch1, specs.spectral_ch2)):
+                counts[spot, i] = np.in1d(detectors, ch.read()).sum()
+    return counts
+
+
+def check_preview(json_path, h5_fname):
+    """Compare the preview in `json_path` with the converted `h5_fname`.
+
+    The summary is updated with 'checked', 'count_mismatch' (max relative
+    difference of the donor and acceptor counts of a spot) and
+    'layout_mismatch' (also set when `count_mismatch` exceeds
+    `max_count_mismatch`), saved again and returned.
+    """
+    with open(str(json_path)) as f:
+        summary = json.load(f)
+    expected = photon_hdf5_counts(h5_fname)
+    counts = np.stack([summary['counts_donor'], summary['counts_acceptor']],
+                      axis=1)
+    if counts.shape != expected.shape:
+        mismatch = 1.
+    else:
+        mismatch = float((np.abs(counts - expected) /
+                          np.maximum(expected, 1)).max())
+    summary.update(checked=True, count_mismatch=mismatch)
+    if mismatch > max_count_mismatch:
+        summary['layout_mismatch'] = True
+    save_summary(summary, json_path)
+    return summary
+
+
+def plot_summary(summary, png_path):
+    """Save a figure of the `summary` in `png_path` (needs matplotlib).
+
+    Returns False if matplotlib is not installed.
+    """
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        return False
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 4))
+    spots = np.arange(len(summary['rate_donor']))
+    ax1.bar(spots, np.array(summary['rate_donor']) * 1e-3, label='D')
+    ax1.bar(spots, np.array(summary['rate_acceptor']) * 1e-3,
+            bottom=np.array(summary['rate_donor']) * 1e-3, label='A')
+    ax1.set_xlabel('Spot')
+    ax1.set_ylabel('Count rate (kcps)')
+    ax1.legend()
+    ax1.set_title('%s (%.0f s)' % (summary['name'], summary['duration']))
+    bins = len(summary['alternation_donor'])
+    phase = (np.arange(bins) + 0.5) * summary['alex_period'] / bins
+    ax2.step(phase, summary['alternation_donor'], where='mid', label='D')
+    ax2.step(phase, summary['alternation_acceptor'], where='mid', label='A')
+    ax2.set_xlabel('Timestamp modulo alternation period (clock cycles)')
+    ax2.set_ylabel('Counts')
+    ax2.legend()
+    fig.tight_layout()
+    png_path.parent.mkdir(parents=True, exist_ok=True)
+    fig.savefig(str(png_path), dpi=80)
+    plt.close(fig)
+    return True
+
+
+def format_summary(summary):
+    """Return a one-line description of the summary."""
+    msg = ('  [PREVIEW] %s: %.1f s, %d photons, median rate %.1f kcps/spot' %
+           (summary['name'], summary['duration'], summary['num_photons'],
+            summary['median_rate'] * 1e-3))
+    if summary.get('count_mismatch', 0) > max_count_mismatch:
+        msg += (', LAYOUT MISMATCH (counts differ up to %.0f%% from the '
+                'converted file, results not reliable)' %
+                (100 * summary['count_mismatch']))
+    elif summary['layout_mismatch']:
+        msg += (', LAYOUT MISMATCH? (%.0f%% unknown words, results not '
+                'reliable)' % (100 * summary['unknown_fraction']))
+    elif summary.get('checked'):
+        msg += ', counts match the converted file'
+    elif summary['dead_spots']:
+        msg += ', DEAD SPOTS: %s' % summary['dead_spots']
+    if summary['error'] is not None:
+        msg += ', ERROR: %s' % summary['error']
+    return msg
+
+
+def preview_file(dat_fname, out_folder=None, chunk_size=8 * 1024**2,
+                 layout=None):
+    """Compute the preview of the DAT file `dat_fname` (not copying it).
+
+    The file is decoded with `layout` (a `DatLayout`). If None, use the
+    layout of the synthetic files of `synthdata`.
+    """
+    dat_fname = Path(dat_fname)
+    preview = DatPreview(
+        dat_fname.stem, out_folder,
+        alex_period=alex_period_from_metadata(dat_fname.with_suffix('.yml')),
+        layout=layout)
+    with open(str(dat_fname), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            preview.update(chunk)
+    return preview.finish()
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        Compute the quick-look preview (count rate of each spot,
+        alternation histogram and duration) of synthetic 48-spot DAT files
+        (see synthdata.py). Experimental: the layout of the words of real
+        DAT files is not verified (see the module docstring).
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('datafiles', nargs='+', help='DAT files.')
+    parser.add_argument('--out', metavar='PATH', default=None,
+                        help='Folder for the JSON and PNG summaries. '
+                             'Default: next to each DAT file.')
+    args = parser.parse_args()
+
+    for datafile in args.datafiles:
+        datafile = Path(datafile)
+        out_folder = datafile.parent if args.out is None else args.out
+        print(format_summary(preview_file(datafile, out_folder)), flush=True)
@@ -0,0 +1,179 @@
+"""
+profiles - Named parameter sets for the 48-spot conversion.
+
+A profile sets the conversion strategy (inplace or tempfile) and, for the
+tempfile conversion, the chunk size used to read the DAT file and the
+compression of the raw temporary file and of the final Photon-HDF5 file:
+
+- 'fastest': large chunks, LZ4 temp file, light zlib compression.
+- 'balanced': medium chunks, LZ4 temp file, moderate zlib compression.
+- 'smallest-archive': strongest zlib compression of the archived file.
+- 'inplace': no temporary file (lowest ramdisk footprint).
+- 'legacy': the parameters of the tempfile conversion notebook.
+
+The final file always uses zlib, so that it can be read by any HDF5
+library. With 'auto', `choose_profile()` picks a profile for each file
+from its size, the free ramdisk space and the past conversion timings,
+which are appended to a JSON lines history file after each conversion.
+"""
+
+import time
+import statistics
+from pathlib import Path
+
+import admission
+import metrics
+
+
+default_history_path = Path('~', '.transfer_convert',
+                            'conversion_history.jsonl').expanduser()
+HISTORY_PATH = default_history_path  # history file of this process
+
+profiles = {
+    'fastest': dict(mode='tempfile', chunksize=2**20,
+                    raw_filter=dict(complevel=1, complib='blosc:lz4'),
+                    comp_filter=dict(complevel=1, complib='zlib')),
+    'balanced': dict(mode='tempfile', chunksize=2**19,
+                     raw_filter=dict(complevel=1, complib='blosc:lz4'),
+                     comp_filter=dict(complevel=4, complib='zlib')),
+    'smallest-archive': dict(mode='tempfile', chunksize=2**18,
+                             raw_filter=dict(complevel=1, complib='blosc'),
+                             comp_filter=dict(complevel=9, complib='zlib')),
+    'inplace': dict(mode='inplace'),
+    'legacy': dict(mode='tempfile', chunksize=262144,
+                   raw_filter=dict(complevel=1, complib='blosc'),
+                   comp_filter=dict(complevel=6, complib='zlib')),
+}
+
+# Profiles considered by 'auto', from the smallest archive to the fastest
+auto_profiles = ('smallest-archive', 'balanced', 'fastest', 'inplace')
+auto_default = 'balanced'     # used when there are no past timings
+auto_max_seconds = 600        # target conversion time per file
+min_samples = 3               # past conversions needed to estimate a rate
+# Typical conversion rate relative to 'balanced' (rough benchmark.py
+# figures), used to estimate the rate of the profiles without timings
+relative_rates = {'smallest-archive': 0.7, 'balanced': 1.0, 'fastest': 1.2,
+                  'inplace': 1.3}
+max_samples = 20              # only the most recent conversions are used
+
+
+def get_profile(name):
+    """Return the dict of parameters of profile `name`."""
+    if name not in profiles:
+        raise ValueError('Unknown conversion profile "%s". Valid profiles: '
+                         '%s.' % (name, ', '.join(profiles)))
+    return profiles[name]
+
+
+def conversion_kwargs(name):
+    """Return the mode and the `conversion.convert_file` arguments of `name`.
+    """
+    profile = dict(get_profile(name))
+    return profile.pop('mode'), profile
+
+
+def notebook_kwargs(name):
+    """Return the tempfile notebook arguments (`nb_kwargs`) of `name`."""
+    profile = get_profile(name)
+    if profile['mode'] != 'tempfile':
+        return {}
+    return dict(chunksize=profile['chunksize'],
+                raw_filter=profile['raw_filter'],
+                out_filter=profile['comp_filter'])
+
+
+def configure(path=default_history_path):
+    """Set the history file where this process reads and appends the
+    conversion timings."""
+    global HISTORY_PATH
+    HISTORY_PATH = Path(path)
+
+
+def record_timing(profile, engine, source_size, duration, output_size=None,
+                  path=None):
+    """Append the timing of a conversion to the history file `path`
+    (default: the file set by `configure()`)."""
+    if path is None:
+        path = HISTORY_PATH
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    metrics.write_record(dict(profile=profile, engine=engine,
+                              source_size=source_size, duration=duration,
+                              output_size=output_size, time=time.time()),
+                         path=path)
+
+
+def load_rates(engine, path=None):
+    """Return a dict of the median conversion rate (bytes/s) per profile.
+
+    Only profiles with at least `min_samples` conversions with `engine`
+    are included. The history file is `path` (default: the file set by
+    `configure()`).
+    """
+    path = Path(HISTORY_PATH if path is None else path)
+    if not path.is_file():
+        return {}
+    records, _ = metrics.read_records(path)
+    samples = {}
+    for r in records:
+        if r['engine'] == engine and r['duration'] > 0:
+            samples.setdefault(r['profile'], []).append(
+                r['source_size'] / r['duration'])
+    return {name: statistics.median(rates[-max_samples:])
+            for name, rates in samples.items() if len(rates) >= min_samples}
+
+
+def estimate_rates(rates):
+    """Return `rates` with an estimate for the profiles without timings.
+
+    The estimate is the median of the measured rates scaled by the ratio
+    of the `relative_rates` of the two profiles. Returns an empty dict if
+    no profile has timings.
+    """
+    measured = {name: rate for name, rate in rates.items()
+                if name in relative_rates}
+    if not measured:
+        return dict(rates)
+    estimated = dict(rates)
+    for name, relative in relative_rates.items():
+        if name not in estimated:
+            estimated[name] = statistics.median(
+                rate * relative / relative_rates[ref]
+                for ref, rate in measured.items())
+    return estimated
+
+
+def choose_profile(datafile, free_space, rates=None,
+                   max_seconds=auto_max_seconds):
+    """Return the profile name for converting `datafile` (auto mode).
+
+    Arguments:
+        datafile (Path): DAT file to be converted (already in the ramdisk).
+        free_space (int): free bytes in the ramdisk.
+        rates (dict or None): past conversion rates (see `load_rates`).
+        max_seconds (float): the profile giving the smallest archive with
+            an estimated conversion time below this value is chosen.
+            If none does, the profile with the shortest estimated time.
+
+    Profiles whose ramdisk footprint does not fit in `free_space` are
+    excluded. Without past timings, `auto_default` is used (if it fits).
+    The rate of the profiles without timings is estimated from the
+    measured ones (see `estimate_rates`), so that each profile is tried
+    when it is expected to fit in `max_seconds`.
+    """
+    size = Path(datafile).stat().st_size
+    # The DAT file is already in the ramdisk
+    needed = {name: admission.estimate_footprint(
+                  datafile, inplace=profiles[name]['mode'] == 'inplace',
+                  size=size) - size
+              for name in auto_profiles}
+    candidates = [name for name in auto_profiles
+                  if name == 'inplace' or needed[name] <= free_space]
+    rates = estimate_rates(rates or {})
+    estimated = {name: size / rates[name] for name in candidates
+                 if name in rates}
+    if not estimated:
+        return auto_default if auto_default in candidates else candidates[-1]
+    for name in candidates:
+        if name in estimated and estimated[name] <= max_seconds:
+            return name
+    return min(estimated, key=estimated.get)
@@ -0,0 +1,201 @@
+"""
+reclaim - Background removal of the temp files, with a grace period.
+
+Once a file is archived, the workers do not wait to remove its temp files
+(data file, Photon-HDF5 file, notebooks, ...) from the ramdisk. They put
+a removal request in the queue of a `Reclaimer` running in the main
+process and move on to the next file. The reclaimer keeps each request
+for a grace period, during which the removal can be canceled:
+
+- creating a marker file `<data file name>.keep` next to the temp files
+  (e.g. `touch /mnt/ramdisk/.../file.keep`),
+- calling `Reclaimer.cancel()`,
+- stopping the batch script with Ctrl-C (pending removals are canceled).
+
+Expired requests are then removed in batches. Before removing a file the
+reclaimer checks again that it is not in one of the protected (archive)
+folders. For each data file, the bytes reclaimed are passed to a callback,
+used by `batch_convert` to release the ramdisk reservation of the file in
+the admission scheduler (see `admission`). Canceled removals are reported
+with `kept=True`: their files stay in the ramdisk.
+"""
+
+import os
+import time
+import queue
+import threading
+import multiprocessing as mp
+from pathlib import Path
+
+
+default_grace = 5       # seconds before removing the files
+keep_suffix = '.keep'   # marker file canceling the removal
+
+
+def check_safe(path, protected):
+    """Raise an error if `path` is in one of the `protected` folders."""
+    for folder in protected:
+        assert folder not in str(Path(path).parent), \
+            'Refusing to remove "%s" (protected folder)' % path
+
+
+def keep_marker(dat_fname):
+    """Return the marker file canceling the removal of `dat_fname`."""
+    dat_fname = Path(dat_fname)
+    return Path(dat_fname.parent, dat_fname.stem + keep_suffix)
+
+
+def remove_files(files, protected=(), dry_run=False):
+    """Remove `files` (after the safety checks). Returns the bytes removed.
+    """
+    nbytes = 0
+    for path in files:
+        check_safe(path, protected)
+    for path in files:
+        path = Path(path)
+        if not path.is_file():
+            continue
+        size = path.stat().st_size
+        if not dry_run:
+            os.remove(str(path))
+        nbytes += size
+    return nbytes
+
+
+class Reclaimer:
+    """Thread removing the files of the requests put in `queue`.
+
+    Arguments:
+        callback (callable or None): called with the data file name and
+            the bytes removed after removing (or canceling the removal of)
+            the files of a request. Bytes are None for canceled or failed
+            requests, and canceled requests are called with `kept=True`.
+        grace (float): seconds between the request and the removal.
+        protected (sequence of strings): folders where files are never
+            removed.
+        interval (float): max time (seconds) between two batches.
+
+    A request is a tuple `(dat_fname, files, dry_run)`, see `request()`.
+    The queue can be passed to other processes (e.g. to the initializer of
+    the workers).
+    """
+
+    def __init__(self, callback=None, grace=default_grace, protected=(),
+                 interval=1):
+        self.callback = callback
+        self.grace = grace
+        self.protected = tuple(protected)
+        self.interval = interval
+        self.queue = mp.Queue()
+        self.removed_bytes = 0
+        self._pending = {}      # dat_fname -> (due time, files, dry_run)
+        self._canceled = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='reclaimer',
+                                        daemon=True)
+        self._thread.start()
+
+    @property
+    def num_pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def cancel(self, dat_fname):
+        """Cancel the removal of the temp files of `dat_fname`."""
+        with self._lock:
+            self._canceled.add(Path(dat_fname))
+
+    def _receive(self, timeout):
+        try:
+            dat_fname, files, dry_run = self.queue.get(timeout=timeout)
+            while True:
+                with self._lock:
+                    self._pending[Path(dat_fname)] = (
+                        time.time() + self.grace, files, dry_run)
+                dat_fname, files, dry_run = self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _due(self, now=None):
+        """Pop and return the requests to be processed in this batch."""
+        with self._lock:
+            due = [(k, v) for k, v in self._pending.items()
+                   if now is None or v[0] <= now]
+            for dat_fname, _ in due:
+                del self._pending[dat_fname]
+        return due
+
+    def _process(self, batch):
+        removed = []
+        for dat_fname, (_, files, dry_run) in batch:
+            with self._lock:
+                canceled = dat_fname in self._canceled
+                self._canceled.discard(dat_fname)
+            if canceled or keep_marker(dat_fname).exists():
+                print('- Removing files canceled: %s\n' % dat_fname.stem,
+                      flush=True)
+                self._done(dat_fname, None, kept=True)
+                continue
+            try:
+                nbytes = remove_files(files, self.protected, dry_run)
+            except Exception as e:
+                print('- Error removing temp files of "%s": %s' %
+                      (dat_fname, e), flush=True)
+                self._done(dat_fname, None)
+                continue
+            self.removed_bytes += nbytes
+            removed.append((dat_fname, nbytes))
+            self._done(dat_fname, nbytes)
+        if removed:
+            print('  [COMPLETED FILE REMOVAL] %s (%.1f MB).\n' %
+                  (', '.join(f.stem for f, _ in removed),
+                   sum(n for _, n in removed) / 1024**2), flush=True)
+
+    def _done(self, dat_fname, nbytes, kept=False):
+        if self.callback is not None:
+            try:
+                if kept:
+                    self.callback(dat_fname, nbytes, kept=True)
+                else:
+                    self.callback(dat_fname, nbytes)
+            except Exception as e:
+                print('Error in reclaim callback for "%s": %s' %
+                      (dat_fname, e), flush=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._receive(timeout=self.interval)
+            batch = self._due(time.time())
+            if batch:
+                self._process(batch)
+
+    def close(self):
+        """Wait for the removal of all the requests received so far."""
+        while True:
+            self._receive(timeout=0.1)
+            if self.num_pending == 0:
+                break
+            time.sleep(self.interval)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stop(self):
+        """Stop the thread canceling the pending removals."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._receive(timeout=0.1)
+        for dat_fname, _ in self._due():
+            print('- Removing files canceled: %s' % dat_fname.stem,
+                  flush=True)
+            self._done(dat_fname, None, kept=True)
+
+
+def request(dat_fname, files, dry_run=False):
+    """Return the request removing `files`, the temp files of `dat_fname`."""
+    return (Path(dat_fname), [Path(f) for f in files], dry_run)
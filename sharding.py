@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+sharding - Analyze a single 48-spot file in parallel, splitting the spots.
+
+The analysis notebook runs the background fit, the burst search and
+`calc_max_rate` for all the spots in one kernel (one core). With
+`run_sharded_analysis()` the spots are split in N shards and N kernels
+execute the notebook `default_shard_notebook` in parallel, each one on
+its subset of spots (passed in `nb_kwargs`). Each shard saves its per-spot
+results in a pickle file and the notebook `default_report_notebook`
+merges them in the per-spot tables (`make_df_spots`, `make_df_bursts`)
+of a single report, saved like the report of `analyze.run_analysis`.
+
+Each kernel loads the data of all the spots, so the memory used by the
+analysis of a file grows about N times; the shard notebook does not use
+the analysis cache (see `cachestore`) nor the warm kernels of the worker
+(see `kernelpool`). The batch scripts cap the shards of each file with
+`limit_shards()`, so that the parallel analyses do not start more kernels
+than CPUs.
+
+Kernels are separate processes, so the shards are executed by threads:
+this also works inside the (daemonic) processes of a multiprocessing Pool.
+The notebooks and results of the shards are saved in the folder
+`<data file name>_shards`, removed when the report is completed (kept if
+an error occurs, or with `profile_cells` for the cell profiles).
+"""
+
+import os
+import time
+import shutil
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import nbrun
+import htmlexport
+import nbslim
+
+
+default_shard_notebook = 'smFRET-Spots-Shard.ipynb'
+default_report_notebook = 'smFRET-Spots-Report.ipynb'
+num_spots = 48
+max_default_shards = 8    # each kernel loads the data of all the spots
+
+
+def split_spots(num_shards, num_spots=num_spots):
+    """Split the spots in `num_shards` lists of (almost) equal length.
+
+    Spots are assigned round-robin, so that each shard gets spots from
+    all the regions of the array (count rates vary across the array).
+    """
+    num_shards = max(1, min(num_shards, num_spots))
+    spots = list(range(num_spots))
+    return [spots[i::num_shards] for i in range(num_shards)]
+
+
+def default_num_shards():
+    """Return the number of shards used when not specified (CPU count,
+    at most `max_default_shards`)."""
+    return min(os.cpu_count() or 1, max_default_shards, num_spots)
+
+
+def limit_shards(num_shards, num_jobs=1):
+    """Return the number of shards of each of `num_jobs` parallel analyses.
+
+    Each shard is a kernel loading the whole file, so `num_jobs` analyses
+    with N shards run `num_jobs * N` kernels. The number of shards is
+    capped so that the total number of kernels does not exceed the CPU
+    count. Returns None (no sharding) if less than 2 shards are left.
+    """
+    if not num_shards:
+        return None
+    num_shards = min(num_shards, (os.cpu_count() or 1) // max(1, num_jobs))
+    return num_shards if num_shards >= 2 else None
+
+
+def shard_folder(data_filename):
+    """Return the folder for the notebooks and results of the shards."""
+    return Path(data_filename.parent, data_filename.stem + '_shards')
+
+
+def run_shard(data_filename, index, spots, shard_notebook, working_dir,
+              profile_cells=False):
+    """Execute the shard notebook on `spots`. Return the results file name.
+    """
+    folder = shard_folder(data_filename)
+    out_fname = Path(folder, 'shard_%02d.pickle' % index)
+    nbrun.run_notebook(shard_notebook, display_links=False,
+                       out_path_ipynb=Path(folder, 'shard_%02d.ipynb' % index),
+                       nb_kwargs={'fname': str(data_filename),
+                                  'spots': spots,
+                                  'out_fname': str(out_fname)},
+                       working_dir=working_dir, profile=profile_cells)
+    return out_fname
+
+
+def run_sharded_analysis(data_filename, num_shards=None, shard_notebook=None,
+                         report_notebook=None, save_html=False,
+                         working_dir=None, dry_run=False, slim=None,
+                         profile_cells=False):
+    """
+    Run the analysis of a 48-spot file in `num_shards` parallel kernels.
+
+    Arguments:
+        data_filename (Path): path data file to be analyzed.
+        num_shards (int or None): number of kernels. If None, use the
+            number of CPUs (at most `max_default_shards`).
+        shard_notebook (Path or None): notebook analyzing a subset of
+            spots. If None, use `default_shard_notebook`.
+        report_notebook (Path or None): notebook merging the results of the
+            shards. If None, use `default_report_notebook`.
+        save_html (bool): if True save a copy of the report in HTML.
+        working_dir (Path or None): working dir the kernels are started into.
+            If None (default), use the same folder as the data file.
+        dry_run (bool): just pretenting. Do not run or save any notebook.
+        slim (dict or None): options of `nbslim.slim_notebook` for the
+            report notebook. If None, the report is not slimmed.
+        profile_cells (bool): if True, save the execution profile of each
+            cell of the shard and report notebooks (see `cellprofile`).
+    """
+    if num_shards is None:
+        num_shards = default_num_shards()
+    if shard_notebook is None:
+        shard_notebook = default_shard_notebook
+    if report_notebook is None:
+        report_notebook = default_report_notebook
+    if working_dir is None:
+        working_dir = data_filename.parent
+    shards = split_spots(num_shards)
+    print(' * Running analysis for %s (%d shards)' %
+          (data_filename.stem, len(shards)), flush=True)
+    out_path_html = Path(working_dir, 'reports_html',
+                         data_filename.stem + '.html')
+    out_path_html.parent.mkdir(exist_ok=True, parents=True)
+    if dry_run:
+        print('   [COMPLETED ANALYSIS] %s' % (data_filename.stem), flush=True)
+        return
+    shard_folder(data_filename).mkdir(exist_ok=True)
+    t_start = time.time()
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        futures = [executor.submit(run_shard, data_filename, i, spots,
+                                   shard_notebook, working_dir, profile_cells)
+                   for i, spots in enumerate(shards)]
+        shard_files = [f.result() for f in futures]
+    print('   [COMPLETED SHARDS] %s (%.1f s)' %
+          (data_filename.stem, time.time() - t_start), flush=True)
+    nbrun.run_notebook(report_notebook, display_links=False,
+                       out_path_ipynb=data_filename.with_suffix('.ipynb'),
+                       out_path_html=out_path_html,
+                       nb_kwargs={'fname': str(data_filename),
+                                  'shards': [str(f) for f in shard_files]},
+                       save_html=save_html, working_dir=working_dir,
+                       html_queue=htmlexport.export_queue(), slim=slim,
+                       profile=profile_cells)
+    if not profile_cells:
+        shutil.rmtree(str(shard_folder(data_filename)), ignore_errors=True)
+    print('   [COMPLETED ANALYSIS] %s (%.1f s)' %
+          (data_filename.stem, time.time() - t_start), flush=True)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    descr = """\
+        This script analyzes a 48-spot HDF5 file splitting the spots in
+        several kernels executed in parallel, then merges the per-spot
+        results in a single report.
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('datafile', help='Data file to be analyzed.')
+    parser.add_argument('--shards', '-n', metavar='N', type=int, default=None,
+                        help='Number of kernels. Default: number of CPUs '
+                             '(at most %d).' % max_default_shards)
+    parser.add_argument('--save-html', action='store_true',
+                        help='Save a copy of the report in HTML.')
+    parser.add_argument('--working-dir', metavar='PATH', default=None,
+                        help='Working dir for the kernels executing the '
+                             'notebooks.')
+    parser.add_argument('--slim', action='store_true',
+                        help='Move the images of the report to the sidecar '
+                             'folder "%s" (see nbslim.py).'
+                             % nbslim.default_images_folder)
+    parser.add_argument('--profile-cells', action='store_true',
+                        help='Save wall time, CPU time and peak memory of '
+                             'each cell of the notebooks (see '
+                             'cellprofile.py).')
+    args = parser.parse_args()
+
+    datafile = Path(args.datafile)
+    assert datafile.is_file(), 'Data file not found: %s' % datafile
+    run_sharded_analysis(datafile, num_shards=args.shards,
+                         save_html=args.save_html,
+                         working_dir=args.working_dir,
+                         slim=nbslim.default_options if args.slim else None,
+                         profile_cells=args.profile_cells)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+startup - Start method of the worker processes and startup timings.
+
+The scripts import the heavy packages (numpy, tables, phconvert, nbformat,
+nbconvert, ...) only when needed, so that `--help`, `--dry-run` and the
+main process of the batch scripts start quickly. By default (start method
+'fork') each worker imports these packages again the first time it
+converts or analyzes a file. With `configure()` the workers can instead
+start warm:
+
+- 'preload': the main process imports `preload_modules` before creating
+  the workers, which inherit them when forked.
+- 'forkserver': a fork server process imports `preload_modules` once and
+  the workers are forked from it. The main process stays light and its
+  threads (watcher, metrics reporter) are not forked.
+
+Run this module as a script to measure the startup time of the CLIs, the
+import time of each preloaded module and the spin-up time of the workers
+with each start method.
+"""
+
+import sys
+import json
+import time
+import importlib
+import subprocess
+import multiprocessing as mp
+from pathlib import Path
+
+
+start_methods = ('fork', 'preload', 'forkserver')
+
+# Imported by the workers converting or analyzing files
+preload_modules = ('numpy', 'tables', 'yaml', 'phconvert', 'niconverter',
+                   'IPython.display', 'nbformat', 'nbconvert',
+                   'nbconvert.preprocessors', 'jupyter_client')
+
+cli_scripts = ('batch_convert.py', 'batch_analyze.py', 'transfer.py',
+               'analyze.py')
+
+
+def available_modules(modules=preload_modules):
+    """Return the modules of `modules` which are installed."""
+    from importlib.util import find_spec
+    available = []
+    for name in modules:
+        try:
+            if find_spec(name) is not None:
+                available.append(name)
+        except ImportError:
+            pass    # parent package missing
+    return available
+
+
+def preload(modules=preload_modules):
+    """Import `modules` (skipping the missing ones) in this process.
+
+    Returns a dict with the import time (s) of each module.
+    """
+    timings = {}
+    for name in modules:
+        t_start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        timings[name] = time.perf_counter() - t_start
+    return timings
+
+
+def configure(method='fork', modules=preload_modules):
+    """Set how the worker processes are started (see `start_methods`).
+
+    Must be called by the main process before creating any Pool, Process
+    or Queue.
+    """
+    if method not in start_methods:
+        raise ValueError('Unknown start method "%s". Valid methods: %s.'
+                         % (method, ', '.join(start_methods)))
+    if method == 'forkserver':
+        mp.set_start_method('forkserver', force=True)
+        mp.set_forkserver_preload(available_modules(modules))
+    else:
+        mp.set_start_method('fork', force=True)
+        if method == 'preload':
+            preload(modules)
+
+
+def _worker_task(modules):
+    """Import `modules` in a worker. Returns the time spent (s)."""
+    t_start = time.perf_counter()
+    preload(modules)
+    return time.perf_counter() - t_start
+
+
+def measure_workers(method, nproc=4, modules=preload_modules):
+    """Return the spin-up time (s) of `nproc` workers started with `method`.
+
+    The spin-up time is measured from the creation of the Pool to the
+    moment when all the workers imported `modules` (i.e. are ready to
+    process a file). Returns also the time spent importing in the workers.
+    Call it in a fresh process (see `__main__`), since preloaded modules
+    stay imported.
+    """
+    t_start = time.perf_counter()
+    configure(method, modules)
+    with mp.Pool(nproc) as pool:
+        import_times = pool.map(_worker_task, [modules] * nproc, chunksize=1)
+    return dict(method=method, nproc=nproc,
+                spinup=time.perf_counter() - t_start,
+                worker_import=max(import_times))
+
+
+def measure_cli(script, args=('--help',), repeat=3):
+    """Return the best wall time (s) of running `script` with `args`."""
+    script = Path(Path(__file__).parent, script)
+    timings = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        subprocess.run([sys.executable, str(script)] + list(args),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+        timings.append(time.perf_counter() - t_start)
+    return min(timings)
+
+
+def measure_imports(modules=preload_modules):
+    """Return the import time (s) of each module, in a fresh process."""
+    code = ('import json, startup; '
+            'print(json.dumps(startup.preload(%r)))' % (tuple(modules),))
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         cwd=str(Path(__file__).parent),
+                         stdout=subprocess.PIPE).stdout
+    return json.loads(out.decode())
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        Measure the startup time of the scripts (--help), the import time of
+        the modules preloaded for the workers and the spin-up time of the
+        workers with each start method.
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('--num-processes', '-n', metavar='N', type=int,
+                        default=4, help='Number of workers. Default 4.')
+    parser.add_argument('--worker', metavar='METHOD', default=None,
+                        choices=start_methods, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        # Measurement of a single start method, in a fresh process
+        print(json.dumps(measure_workers(args.worker, args.num_processes)))
+        sys.exit()
+
+    print('CLI startup (--help):')
+    for script in cli_scripts:
+        print('  %-20s %6.3f s' % (script, measure_cli(script)), flush=True)
+    print('Module import times:')
+    for name, duration in measure_imports().items():
+        print('  %-25s %6.3f s' % (name, duration), flush=True)
+    print('Worker spin-up (%d workers):' % args.num_processes)
+    for method in start_methods:
+        out = subprocess.run([sys.executable, __file__, '--worker', method,
+                              '-n', str(args.num_processes)], check=True,
+                             stdout=subprocess.PIPE).stdout
+        r = json.loads(out.decode())
+        print('  %-12s %6.3f s (import in worker %.3f s)' %
+              (method, r['spinup'], r['worker_import']), flush=True)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""
+synthdata - Generate synthetic data files for testing and benchmarking.
+
+Two kinds of files are generated, each one with a YAML metadata file
+(same name, extension .yml):
+
+- 48-spot DAT files (NI FPGA acquisition): a stream of 32-bit words,
+  each one with a detector number in the upper `dat_detector_bits` bits
+  and the timestamp (modulo 2**`dat_timestamp_bits`) in the lower bits.
+  A word with detector `dat_overflow_detector` marks a rollover of the
+  timestamps counter. Two channels (donor, acceptor) per spot.
+- us-ALEX SM files: the LabVIEW header decoded by `phconvert.smreader`,
+  then 12-byte records (64-bit timestamp, 32-bit detector, big-endian)
+  and the 26-byte trailer. Photons are emitted only during the
+  alternation periods of `conversion.default_measurement_specs_singlespot`.
+
+Photons are Poisson-distributed with the given count rate and files are
+written in chunks, so that files of any size can be generated with
+bounded memory. The layout of the DAT words is defined in `preview`
+(`synthetic_layout`) and must match the niconverter version in use.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+import preview
+
+
+# Layout of the NI FPGA DAT words (shared with `preview.synthetic_layout`)
+dat_clock_frequency = preview.synthetic_clock_frequency
+dat_timestamp_bits = preview.synthetic_timestamp_bits
+dat_detector_bits = preview.synthetic_detector_bits
+dat_overflow_detector = preview.synthetic_overflow_detector
+dat_byteorder = preview.synthetic_byteorder
+
+# us-ALEX SM timing (see conversion.default_measurement_specs_singlespot)
+sm_clock_frequency = 80e6
+sm_alex_period = 4000
+sm_alex_offset = 700
+sm_donor_period = (2180, 3900)
+sm_acceptor_period = (200, 1800)
+sm_labels = ('Donor', 'Acceptor')
+sm_dtype = np.dtype([('timestamp', '>i8'), ('detector', '>u4')])
+sm_trailer = b'\x00' * 4 + b'End Of Run' + b'\x00' * 12
+
+chunk_photons = 2**22    # photons generated at once
+
+
+def metadata_48spot(description='Synthetic 48-spot data'):
+    """Return the metadata dict saved in the YAML file of a DAT file."""
+    return dict(
+        description=description,
+        sample=dict(sample_name='Synthetic sample',
+                    dye_names='ATTO550, ATTO647N',
+                    buffer_name='TE50 + 0.05% TWEEN20',
+                    num_dyes=2),
+        identity=dict(author='transfer_convert benchmark',
+                      author_affiliation='synthetic'))
+
+
+def metadata_singlespot(description='Synthetic us-ALEX data'):
+    """Return the metadata dict saved in the YAML file of a SM file."""
+    metadata = metadata_48spot(description)
+    del metadata['sample']['num_dyes']
+    return metadata
+
+
+def write_metadata(datafile, metadata):
+    """Save `metadata` in the YAML file associated to `datafile`."""
+    with open(str(Path(datafile).with_suffix('.yml')), 'w') as f:
+        yaml.safe_dump(metadata, f, default_flow_style=False)
+
+
+def _num_photons(size_bytes, record_size):
+    return max(1, int(size_bytes) // record_size)
+
+
+def _fret_detectors(size, rng, fret_fraction):
+    """Return 0 (donor) or 1 (acceptor) for each photon."""
+    return (rng.random_sample(size) < fret_fraction).astype('uint32')
+
+
+def dat_words(timestamps, detectors, last_overflow=0):
+    """Return the DAT words for the photons and the last overflow count.
+
+    `timestamps` are absolute (int64, clock cycles) and sorted.
+    An overflow word is inserted for each rollover of the counter.
+    """
+    overflows = timestamps >> dat_timestamp_bits
+    num_ov = np.diff(np.concatenate(([last_overflow], overflows)))
+    positions = np.arange(timestamps.size) + np.cumsum(num_ov)
+    words = np.full(timestamps.size + int(num_ov.sum()),
+                    dat_overflow_detector << dat_timestamp_bits,
+                    dtype='uint32')
+    mask = (1 << dat_timestamp_bits) - 1
+    words[positions] = ((detectors.astype('uint32') << dat_timestamp_bits) |
+                        (timestamps & mask).astype('uint32'))
+    last = int(overflows[-1]) if overflows.size > 0 else last_overflow
+    return words, last
+
+
+def generate_dat(filename, size_mb=100, rate=2e5, num_spots=48,
+                 fret_fraction=0.4, seed=1, metadata=None):
+    """Write a synthetic 48-spot DAT file and its YAML metadata.
+
+    Arguments:
+        filename (Path): DAT file to be created.
+        size_mb (float): approximate file size in MB.
+        rate (float): count rate per spot (counts per second, donor plus
+            acceptor channels).
+        num_spots (int): number of active spots (1 to 48). Channels of the
+            other spots have no counts.
+        fret_fraction (float): fraction of photons in the acceptor channel.
+        seed (int): seed of the random number generator.
+        metadata (dict or None): YAML metadata. If None, use
+            `metadata_48spot()`.
+
+    Returns:
+        A dict with the number of photons, duration (s) and size (bytes).
+    """
+    assert 1 <= num_spots <= 48
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    num_photons = _num_photons(size_mb * 1024**2, 4)
+    mean_delay = dat_clock_frequency / (rate * num_spots)
+    t_last, last_ov, written = 0, 0, 0
+    with open(str(filename), 'wb') as f:
+        while written < num_photons:
+            n = min(chunk_photons, num_photons - written)
+            delays = rng.exponential(mean_delay, size=n).astype('int64') + 1
+            timestamps = t_last + np.cumsum(delays)
+            spots = rng.randint(0, num_spots, size=n).astype('uint32')
+            detectors = 2 * spots + _fret_detectors(n, rng, fret_fraction)
+            words, last_ov = dat_words(timestamps, detectors, last_ov)
+            f.write(words.astype(dat_byteorder + 'u4').tobytes())
+            t_last = int(timestamps[-1])
+            written += n
+    write_metadata(filename, metadata or metadata_48spot())
+    return dict(num_photons=num_photons, duration=t_last / dat_clock_frequency,
+                size=filename.stat().st_size)
+
+
+def _sm_string(text):
+    data = text.encode() if isinstance(text, str) else text
+    return np.array(len(data), dtype='>u4').tobytes() + data
+
+
+def sm_header(labels=sm_labels):
+    """Return the header of a SM file (decoded by `phconvert.smreader`)."""
+    u4 = lambda x: np.array(x, dtype='>u4').tobytes()
+    f8 = lambda x: np.array(x, dtype='>f8').tobytes()
+    header = u4(3) + _sm_string('Synthetic data') + _sm_string('Simple')
+    header += u4(0) + _sm_string('Arrival Time Counter') + u4(0) + u4(0)
+    header += _sm_string('Time') + f8(1 / sm_clock_frequency) + f8(0) + u4(0)
+    header += _sm_string('Counts') + f8(1) + f8(0) + u4(0)
+    header += _sm_string('Detector') + f8(1) + f8(0) + u4(len(labels))
+    header += b''.join(_sm_string(label) for label in labels)
+    return header
+
+
+def generate_sm(filename, size_mb=50, rate=5e4, fret_fraction=0.4,
+                donor_fraction=0.6, seed=1, metadata=None):
+    """Write a synthetic us-ALEX SM file and its YAML metadata.
+
+    Arguments:
+        filename (Path): SM file to be created.
+        size_mb (float): approximate file size in MB.
+        rate (float): count rate (counts per second, both detectors).
+        fret_fraction (float): fraction of photons in the acceptor
+            detector during donor excitation.
+        donor_fraction (float): fraction of photons emitted during the
+            donor excitation period.
+        seed (int): seed of the random number generator.
+        metadata (dict or None): YAML metadata. If None, use
+            `metadata_singlespot()`.
+
+    Returns:
+        A dict with the number of photons, duration (s) and size (bytes).
+    """
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    num_photons = _num_photons(size_mb * 1024**2, sm_dtype.itemsize)
+    period_s = sm_alex_period / sm_clock_frequency
+    counts_per_period = rate * period_s
+    first_period, written = 0, 0
+    with open(str(filename), 'wb') as f:
+        f.write(sm_header())
+        while written < num_photons:
+            n = min(chunk_photons, num_photons - written)
+            # Periods of this chunk, each one with a Poisson number of photons
+            num_periods = max(1, int(n / counts_per_period))
+            counts = rng.poisson(counts_per_period, size=num_periods)
+            periods = np.repeat(np.arange(first_period,
+                                          first_period + num_periods), counts)
+            periods = periods[:n]
+            n = periods.size
+            donor_ex = rng.random_sample(n) < donor_fraction
+            start = np.where(donor_ex, sm_donor_period[0],
+                             sm_acceptor_period[0])
+            stop = np.where(donor_ex, sm_donor_period[1],
+                            sm_acceptor_period[1])
+            phase = (start + rng.random_sample(n) * (stop - start)).astype('int64')
+            phase = (phase + sm_alex_offset) % sm_alex_period
+            records = np.zeros(n, dtype=sm_dtype)
+            records['timestamp'] = np.sort(periods * sm_alex_period + phase)
+            records['detector'] = np.where(
+                donor_ex, _fret_detectors(n, rng, fret_fraction), 1)
+            f.write(records.tobytes())
+            first_period += num_periods
+            written += n
+        f.write(sm_trailer)
+    write_metadata(filename, metadata or metadata_singlespot())
+    return dict(num_photons=written, duration=first_period * period_s,
+                size=filename.stat().st_size)
+
+
+def generate_files(folder, num_files=4, singlespot=False, size_mb=100,
+                   rate=None, num_spots=48, seed=1, prefix='synthetic'):
+    """Generate `num_files` DAT (or SM) files in `folder`.
+
+    Files already present are not generated again.
+    Returns the list of the data file names.
+    """
+    folder = Path(folder)
+    ext = '.sm' if singlespot else '.dat'
+    filenames = []
+    for i in range(num_files):
+        fname = Path(folder, '%s_%02d%s' % (prefix, i, ext))
+        filenames.append(fname)
+        if fname.is_file() and fname.with_suffix('.yml').is_file():
+            continue
+        print('- Generating %s (%.0f MB)' % (fname, size_mb), flush=True)
+        if singlespot:
+            generate_sm(fname, size_mb=size_mb, rate=rate or 5e4,
+                        seed=seed + i)
+        else:
+            generate_dat(fname, size_mb=size_mb, rate=rate or 2e5,
+                         num_spots=num_spots, seed=seed + i)
+    return filenames
+
+
+if __name__ == '__main__':
+    import argparse
+    descr = """\
+        Generate synthetic 48-spot DAT files (or us-ALEX SM files) with
+        their YAML metadata.
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('folder', help='Folder where files are created.')
+    parser.add_argument('--num-files', metavar='N', type=int, default=4,
+                        help='Number of files. Default 4.')
+    parser.add_argument('--size', metavar='MB', type=float, default=100,
+                        help='Size of each file in MB. Default 100.')
+    parser.add_argument('--rate', metavar='CPS', type=float, default=None,
+                        help='Count rate per spot. Default 2e5 for DAT '
+                             'files and 5e4 for SM files.')
+    parser.add_argument('--spots', metavar='N', type=int, default=48,
+                        help='Number of active spots (DAT files). '
+                             'Default 48.')
+    parser.add_argument('--singlespot', action='store_true',
+                        help='Generate us-ALEX SM files instead of DAT files.')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Seed of the random number generator.')
+    args = parser.parse_args()
+
+    generate_files(args.folder, num_files=args.num_files,
+                   singlespot=args.singlespot, size_mb=args.size,
+                   rate=args.rate, num_spots=args.spots, seed=args.seed)
@@ -1,13 +1,23 @@
 #!/usr/bin/env python
 
 import sys
-import os
 from pathlib import Path
-import subprocess as sp
 import time
+from functools import partial
+from contextlib import ExitStack
 
 from nbrun import run_notebook
-from analyze import run_analysis, default_notebook_name
+import kernelpool
+import fastcopy
+import manifest
+import metrics
+import admission
+import profiles
+import nbslim
+import cachestore
+import reclaim
+import cluster
+from analyze import run_analysis, analysis_notebooks, default_notebook_name
 
 
 convert_notebook_name_tempfile = 'Convert to Photon-HDF5 48-spot smFRET from YAML - tempfile.ipynb'
@@ -21,22 +31,137 @@ remote_archive_basedir = '/mnt/wAntonio/'         # Remote dir for archiving dat
 
 DRY_RUN = False     # Set to True for a debug dry-run
 
+copy_checksum = 'md5'                   # hashlib algorithm or None for zero-copy
+copy_chunk_size = 8 * 1024**2           # Buffer size for chunked copies
+copy_nthreads = 4                       # Threads for copying very large files
+copy_parallel_min_size = 2 * 1024**3    # Min file size for a parallel copy
 
-def timestamp():
-    print('\n-- TIMESTAMP %s\n' % time.ctime(), flush=True)
+RELEASE_QUEUE = None    # Queue notified when temp files are removed
+RECLAIM_QUEUE = None    # Queue of a reclaim.Reclaimer removing temp files
+CATALOG = None          # catalog.Catalog of the archived files
+PREVIEW = None          # Layout of the DAT files to preview while copying
+JOB_STORE = None        # jobstore.JobStore updated with the job states
 
 
 def replace_basedir(path, orig_basedir, new_basedir):
     return Path(str(path.parent).replace(orig_basedir, new_basedir), path.name)
 
 
-def filecopy(source, dest, msg=''):
+def temp_path(fname):
+    """Return the path of the copy of `fname` in the temp folder."""
+    return replace_basedir(fname, remote_origin_basedir, temp_basedir)
+
+
+def init_worker(release_queue=None, kernel_init=None, job_store_path=None,
+                metrics_path=None, export_queue=None, reclaim_queue=None,
+                catalog_path=None, preview=None, history_path=None):
+    """Initializer of the worker processes.
+
+    Arguments:
+        release_queue (multiprocessing.Queue or None): if not None,
+            the path of the data file in the temp folder and the bytes
+            removed are put in this queue when the temp files are removed.
+        kernel_init (callable or None): additional initializer, for example
+            from `kernelpool.worker_initializer()`.
+        job_store_path (Path or None): if not None, the job states are
+            updated in this `jobstore.JobStore` database.
+        metrics_path (Path or None): if not None, the metrics of each stage
+            are appended to this JSON lines file (see `metrics`).
+        export_queue (multiprocessing.Queue or None): if not None, the
+            analysis notebooks are rendered to HTML by the processes of
+            a `htmlexport.ExportService` reading this queue.
+        reclaim_queue (multiprocessing.Queue or None): if not None, the
+            temp files are removed in background by the `reclaim.Reclaimer`
+            reading this queue, instead of by the worker. If None, use the
+            queue of the reclaimer of the cluster worker running this
+            process (see `cluster.worker_reclaim_queue()`), if any.
+        catalog_path (Path or None): if not None, the archived files and
+            their analyses are added to this `catalog.Catalog` database.
+        preview (preview.DatLayout or None): if not None, compute the
+            quick-look preview of the DAT files, decoded with this layout,
+            while copying them to the temp folder (see `preview`).
+            Experimental: only the layout of the synthetic files is
+            defined (`preview.synthetic_layout()`).
+        history_path (Path or None): if not None, the conversion timings
+            are read from and appended to this JSON lines file (see
+            `profiles`).
+    """
+    global RELEASE_QUEUE, RECLAIM_QUEUE, JOB_STORE, CATALOG, PREVIEW
+    RELEASE_QUEUE = release_queue
+    if reclaim_queue is None:
+        reclaim_queue = cluster.worker_reclaim_queue()
+    RECLAIM_QUEUE = reclaim_queue
+    PREVIEW = preview
+    if metrics_path is not None:
+        metrics.configure(metrics_path)
+    if history_path is not None:
+        profiles.configure(history_path)
+    if export_queue is not None:
+        import htmlexport
+        htmlexport.init_worker(export_queue)
+    if job_store_path is not None:
+        import jobstore
+        JOB_STORE = jobstore.JobStore(job_store_path)
+    if catalog_path is not None:
+        import catalog
+        CATALOG = catalog.Catalog(catalog_path)
+    if kernel_init is not None:
+        kernel_init()
+
+
+def set_job_state(fname, state, error=None):
+    """Update the state of `fname` in the job store (if any)."""
+    if JOB_STORE is not None and not DRY_RUN:
+        JOB_STORE.set_state(fname, state, error=error)
+
+
+def filecopy(source, dest, msg='', observer=None):
+    """Copy `source` to `dest` and return a `fastcopy.CopyStats` tuple.
+
+    `observer` is passed to `fastcopy.copy_file`. Returns None in dry-run
+    mode.
+    """
     print('* Copying %s ...' % msg, flush=True)
-    if not DRY_RUN:
-        ret = sp.call(['cp', '-av', source, dest])
-    else:
-        ret = 'DRY RUN'
-    print('  [DONE]. Return code %s\n' % ret, flush=True)
+    if DRY_RUN:
+        print('  [DONE]. DRY RUN\n', flush=True)
+        return None
+    stats = fastcopy.copy_file(source, dest, checksum=copy_checksum,
+                               chunk_size=copy_chunk_size,
+                               nthreads=copy_nthreads,
+                               parallel_min_size=copy_parallel_min_size,
+                               observer=observer)
+    metrics.add_bytes(stats.bytes)
+    print("  [DONE]. '%s' -> '%s'\n"
+          '  %.1f MB in %.2f s (%.1f MB/s, %s) checksum %s\n' %
+          (source, dest, stats.bytes / 1024**2, stats.seconds, stats.mbps,
+           stats.method, stats.checksum), flush=True)
+    return stats
+
+
+def preview_folder(fname, basedir=remote_origin_basedir):
+    """Return the folder of the preview of `fname` (in the archive)."""
+    dest = replace_basedir(fname, basedir, local_archive_basedir)
+    return Path(dest.parent, 'preview')
+
+
+def check_preview(dat_fname, h5_fname, basedir):
+    """Compare the preview of `dat_fname` with the converted `h5_fname`.
+
+    The preview layout is partly assumed (see `preview`): a mismatch of
+    the per-spot counts flags the preview summary as not reliable.
+    """
+    import preview
+    json_path, _ = preview.preview_paths(preview_folder(dat_fname, basedir),
+                                         dat_fname.stem)
+    if not json_path.is_file():
+        return
+    try:
+        summary = preview.check_preview(json_path, h5_fname)
+    except Exception as e:
+        print('- Error checking the preview of "%s": %s' % (dat_fname, e),
+              flush=True)
+        return
+    print(preview.format_summary(summary), flush=True)
 
 
 def copy_files_to_ramdisk(fname, orig_basedir, dest_basedir=temp_basedir):
@@ -51,7 +176,25 @@ def copy_files_to_ramdisk(fname, orig_basedir, dest_basedir=temp_basedir):
     dest_fname.parent.mkdir(parents=True, exist_ok=True)
 
     # Copy data
-    filecopy(fname, dest_fname, msg='DAT file to ramdisk')
+    observer = None
+    if PREVIEW is not None and fname.suffix == '.dat' and not DRY_RUN:
+        import preview
+        try:
+            observer = preview.DatPreview(
+                fname.stem, preview_folder(fname),
+                alex_period=preview.alex_period_from_metadata(
+                    fname.with_suffix('.yml')),
+                layout=PREVIEW)
+        except Exception as e:
+            print('- Error starting the preview of "%s": %s' % (fname, e),
+                  flush=True)
+    filecopy(fname, dest_fname, msg='DAT file to ramdisk', observer=observer)
+    if observer is not None:
+        try:
+            print(preview.format_summary(observer.finish()), flush=True)
+        except Exception as e:
+            print('- Error saving the preview of "%s": %s' % (fname, e),
+                  flush=True)
 
     # Copy metadata
     filecopy(fname.with_suffix('.yml'), dest_fname.with_suffix('.yml'),
@@ -79,26 +222,49 @@ def copy_files_to_archive(h5_fname, orig_fname, nb_conv_fname):
     dest_orig_fname = replace_basedir(orig_fname, temp_basedir, local_archive_basedir)
 
     # Copy HDF5 file
-    filecopy(h5_fname, dest_h5_fname, msg='HDF5 file to archive')
+    h5_stats = filecopy(h5_fname, dest_h5_fname, msg='HDF5 file to archive')
 
     # Copy metadata
     filecopy(orig_fname.with_suffix('.yml'), dest_orig_fname.with_suffix('.yml'),
              msg='YAML file to archive')
 
     # Copy DAT file
-    filecopy(orig_fname, dest_orig_fname, msg='DAT file to archive')
+    orig_stats = filecopy(orig_fname, dest_orig_fname,
+                          msg='DAT file to archive')
 
     # Copy conversion notebook
     filecopy(nb_conv_fname, dest_nb_conv_fname,
              msg='conversion notebook to archive')
 
+    if CATALOG is not None and not DRY_RUN:
+        try:
+            CATALOG.add(dest_h5_fname, checksum=h5_stats.checksum,
+                        data_fname=dest_orig_fname,
+                        data_checksum=orig_stats.checksum)
+        except Exception as e:
+            print('- Error adding "%s" to the catalog: %s' %
+                  (dest_h5_fname, e), flush=True)
+
 
-def convert(filepath, basedir, inplace=False, singlespot=False):
+def convert(filepath, basedir, inplace=False, singlespot=False,
+            engine='notebook', profile=None):
     """
     Convert a DAT file to Photon-HDF5.
 
     Arguments:
         filepath (Path): full path of DAT file to be converted.
+        engine (string): 'notebook' to execute the conversion notebook,
+            'python' to call the `conversion` module in-process. With
+            'python', a JSON conversion record is saved instead of the
+            executed notebook.
+        profile (string or None): name of the conversion profile (see
+            `profiles`), or 'auto' to choose it from the file size, the
+            free ramdisk space and the past timings. The profile sets the
+            conversion mode, overriding `inplace`. Ignored for SM files.
+
+    Returns:
+        The Photon-HDF5 file name and the file name of the executed
+        notebook (or of the conversion record).
     """
     print('* Converting to Photon-HDF5: %s' % filepath.stem, flush=True)
     # Compute input file name relative to the basedir
@@ -106,37 +272,104 @@ def convert(filepath, basedir, inplace=False, singlespot=False):
     # 48-spot conversion notebook
     fname_nb_input = str(replace_basedir(filepath, basedir, ''))
 
+    convert_kws = {}
+    if profile is not None and not singlespot:
+        if profile == 'auto':
+            profile = profiles.choose_profile(
+                filepath, admission.ramdisk_capacity(filepath.parent),
+                rates=profiles.load_rates(engine))
+            print('  Auto-selected conversion profile: %s' % profile,
+                  flush=True)
+        mode, convert_kws = profiles.conversion_kwargs(profile)
+        inplace = mode == 'inplace'
+
     # Name of the output notebook
     if inplace:
         convert_notebook_name = convert_notebook_name_inplace
         suffix = '_inplace'
+        mode = 'inplace'
     else:
         convert_notebook_name = convert_notebook_name_tempfile
         suffix = '_tf'
+        mode = 'tempfile'
     if singlespot:
         convert_notebook_name = convert_notebook_name_singlespot
         suffix = ''
+        mode = 'singlespot'
         fname_nb_input = str(filepath)
+    ext = '.ipynb' if engine == 'notebook' else '.json'
     nb_out_path = Path(filepath.parent,
-                       filepath.stem + '%s_conversion.ipynb' % suffix)
+                       filepath.stem + '%s_conversion%s' % (suffix, ext))
+    h5_fname = Path(filepath.parent, filepath.stem + '%s.hdf5' % suffix)
 
     # Convert file to Photon-HDF5
     if not DRY_RUN:
-        run_notebook(convert_notebook_name, out_path_ipynb=nb_out_path,
-                     nb_kwargs={'fname': fname_nb_input}, hide_input=False)
+        source_size = filepath.stat().st_size
+        metrics.add_bytes(source_size)
+        t_start = time.time()
+        if engine == 'notebook':
+            nb_kwargs = {'fname': fname_nb_input}
+            if profile is not None and not singlespot:
+                nb_kwargs.update(profiles.notebook_kwargs(profile))
+            run_notebook(convert_notebook_name, out_path_ipynb=nb_out_path,
+                         nb_kwargs=nb_kwargs, hide_input=False,
+                         kernel_pool=kernelpool.worker_pool())
+        else:
+            import conversion
+            _, stats = conversion.convert_file(filepath, mode=mode,
+                                               **convert_kws)
+            stats['profile'] = profile
+            # The output in the temp folder is removed after archival
+            stats['archived_output'] = str(replace_basedir(
+                h5_fname, temp_basedir, local_archive_basedir))
+            conversion.write_record(stats, nb_out_path)
+            print('  Conversion time %.1f s (%.1f MB/s)' %
+                  (stats['duration'], stats['mbps']), flush=True)
+        if not singlespot:
+            if profile is None:
+                profile = 'inplace' if inplace else 'legacy'
+            profiles.record_timing(profile, engine, source_size,
+                                   time.time() - t_start,
+                                   output_size=h5_fname.stat().st_size)
+            if PREVIEW is not None:
+                check_preview(filepath, h5_fname, basedir)
 
     print('  [COMPLETED CONVERSION] %s.\n' % filepath.stem, flush=True)
-
-    h5_fname = Path(filepath.parent, filepath.stem + '%s.hdf5' % suffix)
     return h5_fname, nb_out_path
 
 
+temp_extensions = ('_tf.hdf5', '_inplace.hdf5', '_raw_temp.hdf5', '.yml',
+                   '_tf_conversion.ipynb', '_inplace_conversion.ipynb',
+                   '_tf.ipynb', '_inplace.ipynb',
+                   '_tf_conversion.json', '_inplace_conversion.json')
+
+
+def temp_files(dat_fname):
+    """Return the list of the temp files of `dat_fname` (including it)."""
+    files = [dat_fname] + [Path(dat_fname.parent, dat_fname.stem + ext)
+                           for ext in temp_extensions]
+    return [f for f in files if f.is_file()]
+
+
 def remove_temp_files(dat_fname):
-    """Remove temporary files."""
+    """Remove temporary files.
+
+    With a reclaim queue (see `init_worker`) the files are removed in
+    background after a grace period and this function returns immediately.
+    """
     # Safety checks
     folder = dat_fname.parent
-    assert remote_archive_basedir not in str(folder)
-    assert local_archive_basedir not in str(folder)
+    protected = (remote_archive_basedir, local_archive_basedir)
+    reclaim.check_safe(dat_fname, protected)
+    files = temp_files(dat_fname)
+    for curr_file in files:
+        metrics.add_bytes(curr_file.stat().st_size)
+    if RECLAIM_QUEUE is not None:
+        RECLAIM_QUEUE.put(reclaim.request(dat_fname, files, DRY_RUN))
+        print('* Temp files of "%s" queued for removal (create "%s" to '
+              'cancel)' % (dat_fname.stem, reclaim.keep_marker(dat_fname)),
+              flush=True)
+        return
     print('* Removing temp files in "%s" (waiting 5 seconds to cancel) ' % folder,
           end='', flush=True)
     try:
@@ -148,74 +381,242 @@ def remove_temp_files(dat_fname):
     except KeyboardInterrupt:
         print('\n- Removing files canceled!\n', flush=True)
     else:
-        # Remove files
-        if not DRY_RUN:
-            os.remove(dat_fname)
-            extensions = ('_tf.hdf5', '_inplace.hdf5', '.yml',
-                          '_tf_conversion.ipynb', '_inplace_conversion.ipynb',
-                          '_tf.ipynb', '_inplace.ipynb')
-            for ext in extensions:
-                curr_file = Path(dat_fname.parent, dat_fname.stem + ext)
-                if curr_file.is_file():
-                    os.remove(curr_file)
-
+        nbytes = reclaim.remove_files(files, protected, dry_run=DRY_RUN)
         print('  [COMPLETED FILE REMOVAL] %s. \n' % dat_fname.stem, flush=True)
+        if RELEASE_QUEUE is not None:
+            RELEASE_QUEUE.put((dat_fname, nbytes))
 
 
-def process(fname, dry_run=False, inplace=False, analyze=True, remove=True,
-            analyze_kws=None, singlespot=False):
+def archive_outputs(fname, inplace=False, analyze=True, singlespot=False,
+                    profile=None):
+    """Return the archived outputs of the data file `fname`.
+
+    These are the Photon-HDF5 file of the conversion mode set by the
+    arguments (as in `process_int`) and, if `analyze`, its analysis
+    notebook. With profile 'auto', the mode is chosen for each file during
+    the conversion: the most recent archived Photon-HDF5 file is used.
     """
-    This is the main function for copying the input DAT file to the temp
-    folder, converting it to Photon-HDF5, copying all the files to the
-    archive folder and (optionally) running the smFRET analysis.
+    archived = replace_basedir(fname, remote_origin_basedir,
+                               local_archive_basedir)
+    if singlespot:
+        suffixes = ['']
+    elif profile == 'auto':
+        suffixes = ['_inplace', '_tf']
+    else:
+        if profile is not None:
+            inplace = profiles.get_profile(profile)['mode'] == 'inplace'
+        suffixes = ['_inplace' if inplace else '_tf']
+    h5_fnames = [Path(archived.parent, archived.stem + '%s.hdf5' % suffix)
+                 for suffix in suffixes]
+    if len(h5_fnames) > 1:
+        existing = [f for f in h5_fnames if f.exists()]
+        if existing:
+            h5_fnames = [max(existing, key=lambda f: f.stat().st_mtime)]
+    outputs = []
+    for h5_fname in h5_fnames[:1]:
+        outputs.append(h5_fname)
+        if analyze:
+            outputs.append(h5_fname.with_suffix('.ipynb'))
+    return outputs
+
+
+def get_inputs(fname, inplace=False, analyze=True, analyze_kws=None,
+               singlespot=False, engine='notebook', profile=None):
+    """Return the dict of inputs used to process `fname` (see `manifest`)."""
+    if profile not in (None, 'auto'):
+        inplace = profiles.get_profile(profile)['mode'] == 'inplace'
+    if engine == 'notebook':
+        if singlespot:
+            converter = convert_notebook_name_singlespot
+        else:
+            converter = (convert_notebook_name_inplace if inplace else
+                         convert_notebook_name_tempfile)
+    else:
+        converter = Path(Path(__file__).parent, 'conversion.py')
+    notebooks = [converter]
+    if profile is not None:
+        notebooks.append(Path(Path(__file__).parent, 'profiles.py'))
+    packages = list(manifest.convert_packages)
+    if analyze:
+        analyze_kws = analyze_kws or {}
+        notebooks += analysis_notebooks(analyze_kws.get('input_notebook'),
+                                        analyze_kws.get('shards'))
+        packages += manifest.analysis_packages
+    return manifest.get_inputs(
+        datafiles=[fname, fname.with_suffix('.yml')], notebooks=notebooks,
+        packages=sorted(set(packages)),
+        extra=dict(inplace=inplace, singlespot=singlespot, analyze=analyze,
+                   profile=profile))
+
+
+def make_job(fname, dry_run=False, inplace=False, analyze=True, remove=True,
+             analyze_kws=None, singlespot=False, engine='notebook',
+             profile=None):
+    """Return the dict describing the processing of file `fname`.
+
+    The job dict is passed through the stage functions (see `get_stages`),
+    each one adding the names of the files it creates.
     """
-    global DRY_RUN
-    DRY_RUN = DRY_RUN or dry_run
+    return dict(fname=fname, dry_run=dry_run, inplace=inplace,
+                analyze=analyze, remove=remove, analyze_kws=analyze_kws,
+                singlespot=singlespot, engine=engine, profile=profile)
 
-    assert fname.is_file(), 'File not found: %s' % fname
 
-    title_msg = 'PROCESSING: %s' % fname.name
-    print('\n\n%s' % title_msg, flush=True)
+def _set_dry_run(job):
+    global DRY_RUN
+    DRY_RUN = DRY_RUN or job['dry_run']
 
-    timestamp()
+
+def copy_stage(job):
+    """Copy the data and metadata files to the temp folder."""
+    _set_dry_run(job)
+    fname = job['fname']
+    set_job_state(fname, 'copying')
+    assert fname.is_file(), 'File not found: %s' % fname
     assert remote_origin_basedir in str(fname)
-    copied_fname = copy_files_to_ramdisk(fname, remote_origin_basedir, temp_basedir)
+    job['copied_fname'] = copy_files_to_ramdisk(fname, remote_origin_basedir,
+                                                temp_basedir)
+    return job
 
-    timestamp()
+
+def convert_stage(job):
+    """Convert the copied data file to Photon-HDF5."""
+    _set_dry_run(job)
+    set_job_state(job['fname'], 'converting')
+    copied_fname = job['copied_fname']
     assert temp_basedir in str(copied_fname)
-    h5_fname, nb_conv_fname = convert(copied_fname, temp_basedir,
-                                      inplace=inplace, singlespot=singlespot)
+    job['h5_fname'], job['nb_conv_fname'] = convert(
+        copied_fname, temp_basedir, inplace=job['inplace'],
+        singlespot=job['singlespot'], engine=job['engine'],
+        profile=job['profile'])
+    return job
+
+
+def archive_stage(job):
+    """Copy data, Photon-HDF5 and conversion notebook to the archive."""
+    _set_dry_run(job)
+    copy_files_to_archive(job['h5_fname'], job['copied_fname'],
+                          job['nb_conv_fname'])
+    set_job_state(job['fname'], 'archived')
+    return job
+
+
+def remove_stage(job):
+    """Remove the files from the temp folder."""
+    _set_dry_run(job)
+    remove_temp_files(job['copied_fname'])
+    return job
+
+
+def analyze_stage(job):
+    """Run the analysis notebook on the archived Photon-HDF5 file."""
+    _set_dry_run(job)
+    h5_fname_archive = replace_basedir(job['h5_fname'], temp_basedir,
+                                       local_archive_basedir)
+    assert h5_fname_archive.is_file()
+    metrics.add_bytes(h5_fname_archive.stat().st_size)
+    analyze_kws = job['analyze_kws'] or {}
+    run_analysis(h5_fname_archive, dry_run=job['dry_run'], **analyze_kws)
+    set_job_state(job['fname'], 'analyzed')
+    if CATALOG is not None and not DRY_RUN:
+        for notebook in analysis_notebooks(analyze_kws.get('input_notebook'),
+                                           analyze_kws.get('shards')):
+            CATALOG.record_analysis(h5_fname_archive, notebook)
+    return job
+
+
+def run_stage(name, func, job):
+    """Run the stage `func` on `job` recording its metrics (see `metrics`).
+    """
+    if job['dry_run']:
+        return func(job)
+    with metrics.measure(job['fname'], name, verbose=True):
+        return func(job)
 
-    timestamp()
-    copy_files_to_archive(h5_fname, copied_fname, nb_conv_fname)
 
-    if remove:
-        timestamp()
-        remove_temp_files(copied_fname)
+def get_stages(remove=True, analyze=True):
+    """Return the list of (name, function) of the processing stages.
 
+    Each function records the metrics of the stage (see `run_stage`).
+    """
+    stages = [('copy', copy_stage), ('convert', convert_stage),
+              ('archive', archive_stage)]
+    if remove:
+        stages.append(('remove', remove_stage))
     if analyze:
-        timestamp()
-        h5_fname_archive = replace_basedir(h5_fname, temp_basedir, local_archive_basedir)
-        assert h5_fname_archive.is_file()
-        run_analysis(h5_fname_archive, dry_run=dry_run, **analyze_kws)
+        stages.append(('analyze', analyze_stage))
+    return [(name, partial(run_stage, name, func)) for name, func in stages]
+
+
+def process(fname, dry_run=False, inplace=False, analyze=True, remove=True,
+            analyze_kws=None, singlespot=False, engine='notebook',
+            profile=None):
+    """
+    This is the main function for copying the input DAT file to the temp
+    folder, converting it to Photon-HDF5, copying all the files to the
+    archive folder and (optionally) running the smFRET analysis.
+    """
+    job = make_job(fname, dry_run=dry_run, inplace=inplace, analyze=analyze,
+                   remove=remove, analyze_kws=analyze_kws,
+                   singlespot=singlespot, engine=engine, profile=profile)
+
+    title_msg = 'PROCESSING: %s' % fname.name
+    print('\n\n%s' % title_msg, flush=True)
+
+    for _, stage in get_stages(remove=remove, analyze=analyze):
+        job = stage(job)
 
-    timestamp()
     return fname
 
 
 def process_int(fname, dry_run=False, inplace=False, analyze=True, remove=True,
-                analyze_kws=None, singlespot=False):
+                analyze_kws=None, singlespot=False, engine='notebook',
+                profile=None):
     ret = None
     try:
         ret = process(fname, dry_run=dry_run, inplace=inplace, analyze=analyze,
                       remove=remove, analyze_kws=analyze_kws,
-                      singlespot=singlespot)
+                      singlespot=singlespot, engine=engine,
+                      profile=profile)
     except Exception as e:
         print('Worker for "%s" got exception:\n%s' % (fname, str(e)), flush=True)
+        set_job_state(fname, 'failed', error=str(e))
     print('Completed processing for "%s" (worker)' % fname, flush=True)
     return ret
 
 
+def process_group(fnames, dry_run=False, inplace=False, analyze=True,
+                  remove=True, analyze_kws=None, singlespot=False,
+                  engine='notebook', profile=None):
+    """Process a group of small files in a single call (see `microbatch`).
+
+    Each file is processed as by `process_int`, with its own outputs,
+    archive copies, metrics and errors, but all the notebooks of the group
+    are executed in the same kernel (see `kernelpool.temporary_pool`),
+    when the installed nbconvert supports it (see
+    `kernelpool.execution_mode`).
+
+    Returns the list of the return values of `process_int` (None for the
+    files which failed), in the order of `fnames`.
+    """
+    print('\n\nPROCESSING GROUP of %d files: %s' %
+          (len(fnames), ', '.join(f.name for f in fnames)), flush=True)
+    t_start = time.time()
+    results = []
+    with ExitStack() as stack:
+        if not dry_run and kernelpool.execution_mode() is not None:
+            stack.enter_context(kernelpool.temporary_pool())
+        for fname in fnames:
+            results.append(process_int(
+                fname, dry_run=dry_run, inplace=inplace, analyze=analyze,
+                remove=remove, analyze_kws=analyze_kws,
+                singlespot=singlespot, engine=engine, profile=profile))
+    print('Completed processing of the group (%d files, %d failed) in '
+          '%.1f s (worker)' % (len(fnames), results.count(None),
+                               time.time() - t_start), flush=True)
+    return results
+
+
 if __name__ == '__main__':
     import argparse
     descr = """\
@@ -239,6 +640,16 @@ if __name__ == '__main__':
                         help=('Convert SM files of 1-spot smFRET-usALEX data. '
                               'Without this option, convert DAT files of '
                               ' 48-spot smFRET [pax or 1-laser] data.'))
+    parser.add_argument('--engine', default='notebook',
+                        choices=('notebook', 'python'),
+                        help="Run the conversion notebook ('notebook', "
+                             "default) or convert in-process ('python').")
+    parser.add_argument('--profile', default=None,
+                        choices=sorted(profiles.profiles) + ['auto'],
+                        help="Conversion profile (see profiles.py) setting "
+                             "mode, chunk size and compression. 'auto' "
+                             "chooses it from file size, free ramdisk space "
+                             "and past timings. Overrides --tempfile.")
     parser.add_argument('--analyze', action='store_true',
                         help='Run smFRET analysis after files are converted.')
     msg = ("Notebook used for smFRET data analysis. If not specified, the "
@@ -247,6 +658,38 @@ if __name__ == '__main__':
                         default=default_notebook_name, help=msg)
     parser.add_argument('--working-dir', metavar='PATH', default=None,
                         help='Working dir for the kernel executing the notebook.')
+    parser.add_argument('--slim', action='store_true',
+                        help='Move the images of the output notebooks to the '
+                             'sidecar folder "%s" and truncate very large '
+                             'outputs (see nbslim.py).'
+                             % nbslim.default_images_folder)
+    parser.add_argument('--profile-cells', action='store_true',
+                        help='Save wall time, CPU time and peak memory of '
+                             'each cell of the analysis notebooks (see '
+                             'cellprofile.py).')
+    parser.add_argument('--cache-dir', metavar='PATH', default=None,
+                        help='Keep the analysis caches (_cache.hdf5) in this '
+                             'folder instead of next to the data files '
+                             '(see cachestore.py). Suggested: "%s".'
+                             % cachestore.default_cache_dir)
+    parser.add_argument('--cache-size', metavar='GB', type=float,
+                        default=cachestore.default_max_bytes / 1024**3,
+                        help='Size budget of the cache folder (least '
+                             'recently used caches are removed). '
+                             'Default %(default)g.')
+    parser.add_argument('--shards', metavar='N', type=int, default=None,
+                        help='Analyze the spots of each 48-spot file in N '
+                             'kernels in parallel (see sharding.py).')
+    parser.add_argument('--metrics', metavar='PATH',
+                        default=str(metrics.default_metrics_path),
+                        help='JSON lines file where the metrics of each stage '
+                             'are appended. Default "%s".'
+                             % metrics.default_metrics_path)
+    parser.add_argument('--history', metavar='PATH',
+                        default=str(profiles.default_history_path),
+                        help='JSON lines file of the conversion timings used '
+                             "by '--profile auto'. Default \"%s\"."
+                             % profiles.default_history_path)
     args = parser.parse_args()
 
     datafile = Path(args.datafile)
@@ -254,8 +697,15 @@ if __name__ == '__main__':
         sys.exit('\nData file not found: %s\n' % datafile)
 
     analyze_kws = dict(input_notebook=args.notebook, save_html=args.save_html,
-                       working_dir=args.working_dir)
+                       working_dir=args.working_dir, slim=args.slim,
+                       shards=None if args.singlespot else args.shards,
+                       cache_dir=args.cache_dir,
+                       cache_size=int(args.cache_size * 1024**3),
+                       profile_cells=args.profile_cells)
+    metrics.configure(args.metrics)
+    profiles.configure(args.history)
     process_int(datafile, dry_run=args.dry_run, inplace=not args.tempfile,
                 analyze=args.analyze, analyze_kws=analyze_kws,
-                singlespot=args.singlespot)
+                singlespot=args.singlespot, engine=args.engine,
+                profile=args.profile)
     print('Terminated processing of "%s"' % datafile, flush=True)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+validate - Check that timestamps in HDF5 files are monotonic.
+
+Timestamps arrays are read in chunks of fixed size, carrying over the last
+timestamp of each chunk, so that memory usage is bounded regardless of the
+file size. Different arrays (e.g. spots or channels) are checked in
+parallel by separate processes or, in daemonic processes (e.g. the
+workers of a multiprocessing Pool, which cannot have children), by
+threads. The HDF5 library is not thread-safe, so the threads read the
+chunks one at a time and only the checks run concurrently.
+
+Works on any PyTables file with arrays named 'timestamps*', including
+Photon-HDF5 files (`/photon_data*/timestamps`) and the raw temporary
+files of the tempfile conversion (`/timestamps<ch>`).
+"""
+
+import re
+import threading
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tables
+
+
+default_chunk_size = 2**22     # timestamps per chunk (32 MB for int64)
+
+_hdf5_lock = threading.Lock()  # serializes HDF5 calls of the threads
+
+
+def find_timestamps_nodes(filename):
+    """Return the paths of the arrays named 'timestamps*' in `filename`."""
+    with tables.open_file(str(filename), mode='r') as h5file:
+        nodes = [node._v_pathname for node in h5file.walk_nodes('/')
+                 if isinstance(node, tables.Array) and
+                 node._v_name.startswith('timestamps')]
+    return sorted(nodes, key=_natural_key)
+
+
+def _natural_key(path):
+    # '/photon_data10/timestamps' -> ['/photon_data', 10, '/timestamps']
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', path)]
+
+
+def check_timestamps(timestamps, chunk_size=default_chunk_size,
+                     overflow=None):
+    """Check monotonicity of a timestamps array reading it in chunks.
+
+    Arguments:
+        timestamps (array-like): a PyTables array or a numpy array.
+        chunk_size (int): number of timestamps read at once.
+        overflow (int or None): period of the timestamps counter.
+            If not None, negative jumps larger than half this value are
+            counted as missed overflow corrections.
+
+    Returns:
+        A dict with the number of timestamps, the number of negative jumps,
+        the number of missed overflow corrections, the most negative jump
+        and the index of the first negative jump (or None).
+    """
+    size = len(timestamps)
+    num_neg = 0
+    num_missed_ov = 0
+    min_jump = None
+    first_index = None
+    last = None
+    for start in range(0, size, chunk_size):
+        chunk = np.asarray(timestamps[start:start + chunk_size])
+        if last is not None:
+            chunk_with_last = np.concatenate(([last], chunk))
+            offset = start - 1
+        else:
+            chunk_with_last = chunk
+            offset = start
+        diff = np.diff(chunk_with_last.astype('int64', copy=False))
+        neg = np.nonzero(diff < 0)[0]
+        if neg.size > 0:
+            jumps = diff[neg]
+            num_neg += int(neg.size)
+            if overflow is not None:
+                num_missed_ov += int((jumps < -overflow // 2).sum())
+            chunk_min = int(jumps.min())
+            min_jump = chunk_min if min_jump is None else min(min_jump,
+                                                              chunk_min)
+            if first_index is None:
+                first_index = int(offset + neg[0] + 1)
+        if chunk.size > 0:
+            last = chunk[-1]
+    if overflow is None:
+        num_missed_ov = num_neg
+    return dict(num_timestamps=size, neg_jumps=num_neg,
+                missed_overflows=num_missed_ov, min_jump=min_jump,
+                first_neg_index=first_index)
+
+
+class _LockedArray:
+    """Array whose reads hold `_hdf5_lock` (for `check_node_locked`)."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        with _hdf5_lock:
+            return self.array[index]
+
+
+def check_node(filename, node_path, chunk_size=default_chunk_size,
+               overflow=None):
+    """Check monotonicity of array `node_path` in file `filename`."""
+    with tables.open_file(str(filename), mode='r') as h5file:
+        result = check_timestamps(h5file.get_node(node_path),
+                                  chunk_size=chunk_size, overflow=overflow)
+    result['node'] = node_path
+    return result
+
+
+def check_node_locked(filename, node_path, chunk_size=default_chunk_size,
+                      overflow=None):
+    """Like `check_node`, with the HDF5 calls serialized (for threads)."""
+    with _hdf5_lock:
+        h5file = tables.open_file(str(filename), mode='r')
+    try:
+        with _hdf5_lock:
+            node = h5file.get_node(node_path)
+        result = check_timestamps(_LockedArray(node), chunk_size=chunk_size,
+                                  overflow=overflow)
+    finally:
+        with _hdf5_lock:
+            h5file.close()
+    result['node'] = node_path
+    return result
+
+
+def _check_node_args(args):
+    return check_node(*args)
+
+
+def _check_node_locked_args(args):
+    return check_node_locked(*args)
+
+
+def validate_file(filename, nodes=None, nproc=None,
+                  chunk_size=default_chunk_size, overflow=None):
+    """Check monotonicity of all the timestamps arrays in `filename`.
+
+    Arguments:
+        filename (Path): HDF5 file to be checked.
+        nodes (list or None): paths of the arrays to be checked. If None,
+            check all the arrays named 'timestamps*'.
+        nproc (int or None): number of processes. If None, use the number
+            of CPUs. When called from a daemonic process (e.g. a Pool
+            worker) arrays are checked by `nproc` threads.
+        chunk_size (int): number of timestamps read at once by each process.
+        overflow (int or None): period of the timestamps counter
+            (see `check_timestamps`).
+
+    Returns:
+        A list of dicts (see `check_timestamps`), one per array, with the
+        additional key 'node'.
+    """
+    if nodes is None:
+        nodes = find_timestamps_nodes(filename)
+    args = [(str(filename), node, chunk_size, overflow) for node in nodes]
+    if nproc is None:
+        nproc = mp.cpu_count()
+    nproc = min(nproc, len(args))
+    if nproc <= 1:
+        return [_check_node_args(a) for a in args]
+    if mp.current_process().daemon:
+        with ThreadPoolExecutor(max_workers=nproc) as executor:
+            return list(executor.map(_check_node_locked_args, args))
+    with mp.Pool(processes=nproc) as pool:
+        return pool.map(_check_node_args, args)
+
+
+def is_valid(results):
+    """Return True if no array in `results` has negative jumps."""
+    return all(r['neg_jumps'] == 0 for r in results)
+
+
+def print_report(results):
+    """Print a summary of the results of `validate_file()`."""
+    total = sum(r['num_timestamps'] for r in results)
+    print('Checked %d arrays, %d timestamps.' % (len(results), total))
+    for r in results:
+        if r['neg_jumps'] > 0:
+            print('  %s: %d negative jumps (%d missed overflows), '
+                  'min jump %d, first at index %d' %
+                  (r['node'], r['neg_jumps'], r['missed_overflows'],
+                   r['min_jump'], r['first_neg_index']))
+    print('Timestamps are %smonotonic.' % ('' if is_valid(results) else 'NOT '),
+          flush=True)
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    descr = """\
+        Check that all the timestamps arrays in a HDF5 file (Photon-HDF5 or
+        raw temp file) are monotonic.
+        """
+    parser = argparse.ArgumentParser(description=descr, epilog='\n')
+    parser.add_argument('datafile', help='HDF5 file to be checked.')
+    parser.add_argument('--num-processes', '-n', metavar='N', type=int,
+                        default=None,
+                        help='Number of processes. Default: number of CPUs.')
+    parser.add_argument('--chunk-size', metavar='N', type=int,
+                        default=default_chunk_size,
+                        help='Timestamps read at once. Default %d.'
+                             % default_chunk_size)
+    parser.add_argument('--overflow', metavar='N', type=int, default=None,
+                        help='Period of the timestamps counter, used to '
+                             'identify missed overflow corrections.')
+    args = parser.parse_args()
+
+    results = validate_file(args.datafile, nproc=args.num_processes,
+                            chunk_size=args.chunk_size,
+                            overflow=args.overflow)
+    print_report(results)
+    sys.exit(0 if is_valid(results) else 1)
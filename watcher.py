@@ -0,0 +1,273 @@
+"""
+watcher - Detect new data files appearing in a folder.
+
+A data file (e.g. DAT or SM) is "ready" when the metadata file with the same
+name (extension .yml) is also present and both files have not been modified
+for at least `settle_time` seconds (i.e. they are not being written anymore).
+Ready files are put in `FolderWatcher.queue`, each file only once.
+
+Two backends are available:
+
+- 'inotify': uses Linux inotify (through ctypes) to be notified of new or
+  modified files. It does not work on network file systems (CIFS, NFS)
+  where files are written by a remote host.
+- 'scan': incremental scanner. Only directories whose mtime changed are
+  listed again, and only files not yet ready are checked with `stat()`.
+  A full listing is performed every `full_scan_interval` seconds as
+  a safety net.
+
+With `backend='auto'` inotify is used unless the folder is on a network
+file system.
+"""
+
+import os
+import time
+import queue
+import select
+import struct
+import threading
+from pathlib import Path
+
+
+network_fstypes = ('cifs', 'smb', 'smbfs', 'smb3', 'nfs', 'nfs4',
+                   'fuse.sshfs')
+
+# inotify constants (from <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_event_header = struct.Struct('iIII')
+
+
+def get_fstype(path):
+    """Return the file system type of the mount containing `path`."""
+    path = os.path.realpath(str(path))
+    best, fstype = '', None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if ((path == mount_point or
+                     path.startswith(mount_point.rstrip('/') + '/')) and
+                        len(mount_point) >= len(best)):
+                    best, fstype = mount_point, fields[2]
+    except OSError:
+        pass
+    return fstype
+
+
+def inotify_available(path):
+    """Return True if inotify can be used to watch `path`."""
+    if not hasattr(os, 'O_NONBLOCK') or not Path('/proc/mounts').exists():
+        return False
+    return get_fstype(path) not in network_fstypes
+
+
+class Inotify:
+    """Minimal ctypes wrapper of the Linux inotify API."""
+
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+
+    def add_watch(self, folder):
+        import ctypes
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(folder)),
+                                          self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(),
+                          'inotify_add_watch failed for %s' % folder)
+        self.dirs[wd] = Path(folder)
+
+    def read_events(self, timeout):
+        """Return a list of (path, mask) for the events within `timeout`."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, pos = [], 0
+        while pos + _event_header.size <= len(buf):
+            wd, mask, _, size = _event_header.unpack_from(buf, pos)
+            pos += _event_header.size
+            name = buf[pos:pos + size].rstrip(b'\0')
+            pos += size
+            if wd in self.dirs and name:
+                events.append((Path(self.dirs[wd], os.fsdecode(name)), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """Watch a folder and queue data files when they are ready.
+
+    Arguments:
+        folder (Path): folder to be watched.
+        ext (string): extension of the data files (e.g. '.dat' or '.sm').
+        recursive (bool): if True, watch also all the subfolders.
+        settle_time (float): seconds without modifications after which
+            a DAT/YML pair is considered complete.
+        poll_interval (float): seconds between checks of pending files.
+        full_scan_interval (float): seconds between full listings of the
+            watched folders (scan backend only).
+        backend (string): 'auto', 'inotify' or 'scan'.
+        skip_existing (bool): if True, DAT/YML pairs already present when
+            the watcher is created are never queued.
+    """
+
+    def __init__(self, folder, ext='.dat', recursive=False, settle_time=5,
+                 poll_interval=1, full_scan_interval=60, backend='auto',
+                 skip_existing=True):
+        self.folder = Path(folder)
+        self.ext = ext
+        self.recursive = recursive
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.full_scan_interval = full_scan_interval
+        if backend == 'auto':
+            backend = 'inotify' if inotify_available(self.folder) else 'scan'
+        assert backend in ('inotify', 'scan'), 'Invalid backend: %s' % backend
+        self.backend = backend
+        self.queue = queue.Queue()
+        self._seen = set()        # files already queued (or skipped)
+        self._pending = {}        # file -> (size, mtime) of last check
+        self._dir_mtimes = {}     # folder -> mtime of last listing
+        self._last_full_scan = 0
+        self._inotify = None
+        self._stop = threading.Event()
+        self._thread = None
+
+        if backend == 'inotify':
+            self._inotify = Inotify()
+            self._inotify.add_watch(self.folder)
+        existing = self._scan(full=True)
+        self.existing = sorted(f for f in existing if self._is_pair(f))
+        if skip_existing:
+            self._seen.update(self.existing)
+        self._add_candidates(existing)
+
+    def _scan(self, folders=None, full=False):
+        """Return data files in folders changed since the last scan.
+
+        If `full` is True, list all the folders even if not changed.
+        """
+        if folders is None:
+            folders = [self.folder] if full else list(self._dir_mtimes)
+        folders = list(folders)
+        found = []
+        while folders:
+            folder = folders.pop()
+            try:
+                mtime = os.stat(folder).st_mtime
+            except FileNotFoundError:
+                self._dir_mtimes.pop(folder, None)
+                continue
+            if not full and self._dir_mtimes.get(folder) == mtime:
+                continue
+            self._dir_mtimes[folder] = mtime
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if not self.recursive:
+                            continue
+                        path = Path(entry.path)
+                        if path not in self._dir_mtimes:
+                            if self._inotify is not None:
+                                self._inotify.add_watch(path)
+                            folders.append(path)
+                        elif full:
+                            folders.append(path)
+                    elif entry.name.endswith(self.ext):
+                        found.append(Path(entry.path))
+        return found
+
+    def _is_pair(self, datafile):
+        return datafile.with_suffix('.yml').is_file()
+
+    def _add_candidates(self, files):
+        for f in files:
+            if f not in self._seen and f not in self._pending:
+                self._pending[f] = None
+
+    def _check_pending(self):
+        """Queue the pending files which are complete."""
+        now = time.time()
+        for f, last in list(self._pending.items()):
+            try:
+                st_data = os.stat(f)
+                st_meta = os.stat(f.with_suffix('.yml'))
+            except FileNotFoundError:
+                if not f.exists():
+                    del self._pending[f]
+                continue
+            current = (st_data.st_size, st_meta.st_size,
+                       max(st_data.st_mtime, st_meta.st_mtime))
+            self._pending[f] = current
+            if current == last and now - current[2] >= self.settle_time:
+                del self._pending[f]
+                self._seen.add(f)
+                self.queue.put(f)
+
+    def _process_events(self, timeout):
+        for path, mask in self._inotify.read_events(timeout):
+            if mask & IN_ISDIR:
+                if self.recursive and path not in self._dir_mtimes:
+                    self._inotify.add_watch(path)
+                    self._add_candidates(self._scan([path], full=True))
+            elif path.name.endswith(self.ext):
+                self._add_candidates([path])
+            elif path.suffix == '.yml':
+                self._add_candidates([path.with_suffix(self.ext)])
+
+    def poll(self):
+        """Perform a single check, queueing the files that became ready."""
+        if self.backend == 'inotify':
+            self._process_events(self.poll_interval)
+        else:
+            now = time.time()
+            full = now - self._last_full_scan >= self.full_scan_interval
+            if full:
+                self._last_full_scan = now
+            self._add_candidates(self._scan(full=full))
+            time.sleep(self.poll_interval)
+        self._check_pending()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print('Watcher error: %s' % e, flush=True)
+                time.sleep(self.poll_interval)
+
+    def start(self):
+        """Start watching in a background thread."""
+        self._last_full_scan = time.time()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._inotify is not None:
+            self._inotify.close()